@@ -0,0 +1,108 @@
+"""
+Compares the JSON encoding of GET /api, the fastjson module against the snapshot path it replaced.
+
+An INDI client, which is not connected, is populated with a number of
+devices, each of number vectors, parsed from def elements by the client's own
+parser. The whole client is then encoded as JSON repeatedly, both by the
+former path, which took a snapshot copy of the client, called its dictdump()
+method and encoded the dictionary with the Litestar encoder, and by
+fastjson.clientjson(), whose member cache is warm after the first call. The
+two results are checked to decode equal, before and after the timed calls,
+and the median times printed.
+
+Between each timed call a tenth of the vectors are given a new value, as a
+running instrument would, so the fastjson cache is not entirely warm.
+
+    python benchmarks/apijson.py [--devices 2] [--vectors 500] [--runs 50] [--changed 0.1]
+"""
+
+import sys, argparse, json, statistics, time, pathlib, logging
+
+import xml.etree.ElementTree as ET
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent))
+
+from litestar.serialization import encode_json
+
+from indipyclient import IPyClient
+from indipyclient.ipyclient import Device
+
+from indipyweb.web import fastjson
+
+logging.getLogger("indipyclient").setLevel("ERROR")
+
+
+def definition(devicename, v):
+    "Returns the def element of number vector v of the device"
+    return ET.fromstring(f'<defNumberVector device="{devicename}" name="NUM{v}" label="Number {v}" group="Group{v%4}" '
+                         f'state="Ok" perm="rw" timestamp="2026-01-01T00:00:00.000">'
+                         f'<defNumber name="V" label="Value" format="%.2f" min="0" max="1000" step="0">0</defNumber>'
+                         f'</defNumberVector>')
+
+
+def populate(iclient, devices, vectors):
+    "Defines the vectors of each device in the client"
+    for d in range(devices):
+        devicename = f"Device{d}"
+        deviceobj = Device(devicename, iclient)
+        for v in range(vectors):
+            deviceobj.rxvector(definition(devicename, v))
+        iclient.data[devicename] = deviceobj
+
+
+def change(iclient, fraction, count):
+    "Sets a new value in the given fraction of the vectors"
+    if not fraction:
+        return
+    step = max(1, round(1 / fraction))
+    for deviceobj in iclient.data.values():
+        for vectorobj in list(deviceobj.data.values())[count % step::step]:
+            vectorobj.data["V"].membervalue = str(count)
+
+
+def snapshotjson(iclient):
+    "The former GET /api encoding, a snapshot copy, its dictdump, then the Litestar encoder"
+    return encode_json(iclient.snapshot().dictdump())
+
+
+def timeit(function, iclient, runs, fraction):
+    "Returns the median seconds of function(iclient), changing values before each call"
+    times = []
+    for count in range(runs):
+        change(iclient, fraction, count)
+        start = time.perf_counter()
+        function(iclient)
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+
+def check(iclient):
+    "Exits with code 1 if the encoders give different JSON"
+    if json.loads(fastjson.clientjson(iclient)) != json.loads(snapshotjson(iclient)):
+        print("Error: the encoders give different JSON")
+        sys.exit(1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the /api JSON encoders.")
+    parser.add_argument("--devices", type=int, default=2, help="Number of devices.")
+    parser.add_argument("--vectors", type=int, default=500, help="Number of number vectors of each device.")
+    parser.add_argument("--runs", type=int, default=50, help="Number of timed calls of each encoder.")
+    parser.add_argument("--changed", type=float, default=0.1, help="Fraction of vectors changed before each call.")
+    args = parser.parse_args()
+
+    iclient = IPyClient(indihost="localhost", indiport=7624)
+    populate(iclient, args.devices, args.vectors)
+    check(iclient)
+
+    encoder = "msgspec" if fastjson.msgspec else "orjson" if fastjson.orjson else "json"
+    print(f"{args.devices} devices of {args.vectors} number vectors, fastjson using {encoder}")
+    for name, function in (("snapshot", snapshotjson), ("fastjson", fastjson.clientjson)):
+        median = timeit(function, iclient, args.runs, args.changed)
+        print(f"{name:>10}  median {median*1000:8.2f} ms")
+    # the cached members, after the changes, still match
+    check(iclient)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,230 @@
+"""
+Measures the steady state memory of indipyweb serving a reference installation.
+
+A minimal INDI service is run in the same process, with a number of devices,
+each with number vectors updated, and a message sent, every tick. The app is
+served by uvicorn on a free port, a number of SSE connections are opened to
+the device pages, and after the run time, the memory traced by tracemalloc,
+and the resident set size of the process, are printed.
+
+    python benchmarks/memory.py [--lowmemory] [--devices 4] [--vectors 50]
+                                [--connections 8] [--seconds 30] [--limit MB]
+
+If --limit is given, the exit code is 1 if the resident set size, in MB,
+exceeds it, so this can be used in a CI job.
+
+With --lowmemory, which limits the number of SSE connections, the limit is
+then checked. Once the measured connections have closed, the count of open
+connections should return to zero. As many connections as the limit allows
+are opened, a further connection should be sent only an SSE retry field,
+and closing one connection should lower the count by one. The exit code is
+1 if any of these fail.
+"""
+
+import sys, argparse, asyncio, tracemalloc, tempfile, socket, pathlib, logging
+
+tracemalloc.start()
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent))
+
+import uvicorn
+
+import indipyweb
+
+from indipyweb.web.userdata import get_indiclient
+from indipyweb.web import sendqueue
+
+logging.getLogger("indipyclient").setLevel("ERROR")
+
+
+def rss():
+    "Returns the resident set size of this process in MB, read from /proc, or None if not available"
+    try:
+        with open("/proc/self/status") as status:
+            for line in status:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        return None
+
+
+def freeport():
+    "Returns a free TCP port on localhost"
+    with socket.socket() as sock:
+        sock.bind(("localhost", 0))
+        return sock.getsockname()[1]
+
+
+class ReferenceService:
+    "A minimal INDI service, with devices of number vectors, each updated every tick"
+
+    def __init__(self, devices, vectors, tick=0.5):
+        self.devices = [f"Device{d}" for d in range(devices)]
+        self.vectors = vectors
+        self.tick = tick
+        self.running = True
+
+    def definitions(self):
+        for devicename in self.devices:
+            for v in range(self.vectors):
+                yield (f'<defNumberVector device="{devicename}" name="NUM{v}" label="Number {v}" group="Group{v%4}" '
+                       f'state="Ok" perm="rw"><defNumber name="V" format="%.2f" min="0" max="1000" step="0">0</defNumber>'
+                       f'</defNumberVector>')
+
+    async def handle(self, reader, writer):
+        await reader.read(1000)
+        for definition in self.definitions():
+            writer.write(definition.encode())
+        await writer.drain()
+        count = 0
+        try:
+            while self.running:
+                await asyncio.sleep(self.tick)
+                count += 1
+                tick = []
+                for devicename in self.devices:
+                    for v in range(self.vectors):
+                        tick.append(f'<setNumberVector device="{devicename}" name="NUM{v}" state="Ok">'
+                                    f'<oneNumber name="V">{count}</oneNumber></setNumberVector>')
+                    tick.append(f'<message device="{devicename}" message="tick {count}"/>')
+                # a single write, so if the client has just disconnected only one write fails
+                writer.write("".join(tick).encode())
+                await writer.drain()
+        except (ConnectionError, asyncio.CancelledError):
+            # the connection has closed, or the benchmark has ended
+            pass
+
+
+async def sseconnection(port, path):
+    "Opens an SSE connection, and reads events until cancelled"
+    reader, writer = await asyncio.open_connection("localhost", port)
+    writer.write(f"GET {path} HTTP/1.1\r\nHost: localhost\r\nAccept: text/event-stream\r\n\r\n".encode())
+    await writer.drain()
+    try:
+        while await reader.read(10000):
+            pass
+    finally:
+        writer.close()
+
+
+async def refusedconnection(port, path):
+    "Opens an SSE connection, and returns the text received before the server closes it"
+    reader, writer = await asyncio.open_connection("localhost", port)
+    writer.write(f"GET {path} HTTP/1.1\r\nHost: localhost\r\nAccept: text/event-stream\r\n\r\n".encode())
+    await writer.drain()
+    received = b""
+    try:
+        # the final empty chunk ends the response
+        while not received.endswith(b"\r\n0\r\n\r\n"):
+            data = await reader.read(10000)
+            if not data:
+                break
+            received += data
+    finally:
+        writer.close()
+    return received.decode()
+
+
+async def waitfor(condition, seconds=5.0):
+    "Returns True once condition() is true, or False if it is not within the given seconds"
+    for n in range(int(seconds * 10)):
+        if condition():
+            return True
+        await asyncio.sleep(0.1)
+    return condition()
+
+
+async def checkconnections(port, path):
+    "Checks the limit on SSE connections, returns a list of failures, empty if all pass"
+    failures = []
+    if not await waitfor(lambda: sendqueue.SendQueue.connections == 0):
+        failures.append(f"{sendqueue.SendQueue.connections} connections remain open after closing them all")
+    limit = sendqueue.MAXCONNECTIONS
+    connections = [asyncio.create_task(sseconnection(port, path)) for n in range(limit)]
+    if not await waitfor(lambda: sendqueue.SendQueue.connections == limit):
+        failures.append(f"{sendqueue.SendQueue.connections} connections open rather than {limit}")
+    try:
+        received = await asyncio.wait_for(refusedconnection(port, path), timeout=5)
+    except asyncio.TimeoutError:
+        failures.append(f"connection {limit+1} was not closed by the server")
+    else:
+        if f"retry: {sendqueue.RETRYLATER}" not in received or "data:" in received:
+            failures.append(f"connection {limit+1} was not sent only the retry field:\n{received}")
+    connections.pop().cancel()
+    if not await waitfor(lambda: sendqueue.SendQueue.connections == limit - 1):
+        failures.append(f"{sendqueue.SendQueue.connections} connections open after one of {limit} closed")
+    for connection in connections:
+        connection.cancel()
+    return failures
+
+
+async def run(args):
+    indiport = freeport()
+    webport = freeport()
+    service = ReferenceService(args.devices, args.vectors)
+    indiserver = await asyncio.start_server(service.handle, "localhost", indiport)
+
+    with tempfile.TemporaryDirectory() as dbfolder:
+        app = indipyweb.make_app(dbfolder=dbfolder, lowmemory=args.lowmemory)
+        iclient = get_indiclient()
+        iclient.indiport = indiport
+        server = uvicorn.Server(uvicorn.Config(app=app, host="localhost", port=webport, log_level="error"))
+        servertask = asyncio.create_task(server.serve())
+        # wait for the devices to be learnt
+        for n in range(100):
+            await asyncio.sleep(0.1)
+            if len(iclient) == args.devices:
+                break
+        else:
+            print("The devices were not received")
+        deviceids = [deviceobj.itemid for deviceobj in iclient.values()]
+        connections = [asyncio.create_task(sseconnection(webport, f"/device/devicechange/{deviceids[n % len(deviceids)]}"))
+                       for n in range(args.connections)]
+        connections.append(asyncio.create_task(sseconnection(webport, "/instruments")))
+        await asyncio.sleep(args.seconds)
+        current, peak = tracemalloc.get_traced_memory()
+        residentsize = rss()
+        for connection in connections:
+            connection.cancel()
+        failures = []
+        if sendqueue.MAXCONNECTIONS:
+            failures = await checkconnections(webport, "/instruments")
+        service.running = False
+        server.should_exit = True
+        await servertask
+        indiserver.close()
+
+    print(f"devices {args.devices}, vectors per device {args.vectors}, SSE connections {args.connections + 1}, "
+          f"low memory {args.lowmemory}")
+    print(f"traced memory  current {current/2**20:7.1f} MB   peak {peak/2**20:7.1f} MB")
+    if residentsize is not None:
+        print(f"resident set size      {residentsize:7.1f} MB")
+    snapshot = tracemalloc.take_snapshot()
+    print("\nLargest allocations by file:")
+    for stat in snapshot.statistics("filename")[:args.top]:
+        print(f"{stat.size/2**20:7.2f} MB  {stat.traceback[0].filename}")
+    if sendqueue.MAXCONNECTIONS:
+        print(f"\nConnection limit of {sendqueue.MAXCONNECTIONS}: " + ("\n".join(failures) if failures else "passed"))
+    return residentsize, failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure the steady state memory of indipyweb.")
+    parser.add_argument("--lowmemory", action="store_true", help="Use the low memory profile.")
+    parser.add_argument("--devices", type=int, default=4, help="Number of devices of the reference service.")
+    parser.add_argument("--vectors", type=int, default=50, help="Number of vectors of each device.")
+    parser.add_argument("--connections", type=int, default=8, help="Number of device page SSE connections.")
+    parser.add_argument("--seconds", type=float, default=30.0, help="Seconds to run before measuring.")
+    parser.add_argument("--top", type=int, default=10, help="Number of files with the largest allocations to list.")
+    parser.add_argument("--limit", type=float, help="Fail if the resident set size, in MB, exceeds this.")
+    args = parser.parse_args()
+    residentsize, failures = asyncio.run(run(args))
+    if failures:
+        sys.exit(1)
+    if args.limit is not None and residentsize is not None and residentsize > args.limit:
+        print(f"\nThe resident set size exceeds the limit of {args.limit} MB")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
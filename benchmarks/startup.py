@@ -0,0 +1,87 @@
+"""
+Measures the cold start of indipyweb, to track regressions.
+
+Each run is a fresh interpreter, which times importing indipyweb, creating
+the app with make_app, and compiling every template. The median of the
+runs is printed, with the slowest imported modules of the last run.
+
+    python benchmarks/startup.py [--runs 5] [--limit SECONDS]
+
+If --limit is given, the exit code is 1 if the median import time exceeds it,
+so this can be used in a CI job.
+"""
+
+import sys, argparse, json, statistics, subprocess, tempfile, pathlib
+
+
+# run in each fresh interpreter, prints a JSON object of the timings
+CHILD = """
+import sys, time, json, pathlib
+t0 = time.perf_counter()
+import indipyweb
+t1 = time.perf_counter()
+app = indipyweb.make_app(dbfolder=sys.argv[1])
+t2 = time.perf_counter()
+from mako.lookup import TemplateLookup
+from indipyweb.web.app import TEMPLATEFILES
+lookup = TemplateLookup(directories=[TEMPLATEFILES], default_filters=["h"])
+for path in TEMPLATEFILES.rglob("*.html"):
+    lookup.get_template(path.relative_to(TEMPLATEFILES).as_posix())
+t3 = time.perf_counter()
+print(json.dumps({"import":t1-t0, "make_app":t2-t1, "templates":t3-t2}))
+"""
+
+
+def runonce(dbfolder, root):
+    "Returns a tuple of (timings dictionary, importtime report lines) of a fresh interpreter"
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", CHILD, dbfolder],
+                            capture_output=True, text=True, cwd=root, check=True)
+    return json.loads(result.stdout.strip().splitlines()[-1]), result.stderr.splitlines()
+
+
+def slowest(report, count):
+    "Returns a list of (self microseconds, module) of the imports which took longest, excluding those they import"
+    modules = []
+    for line in report:
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        parts = line.split("|")
+        try:
+            selftime = int(parts[0].removeprefix("import time:"))
+        except ValueError:
+            continue
+        modules.append((selftime, parts[2].strip()))
+    modules.sort(reverse=True)
+    return modules[:count]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure the cold start time of indipyweb.")
+    parser.add_argument("--runs", type=int, default=5, help="Number of fresh interpreters to time.")
+    parser.add_argument("--limit", type=float, help="Fail if the median import time, in seconds, exceeds this.")
+    parser.add_argument("--top", type=int, default=10, help="Number of slowest imports to list.")
+    args = parser.parse_args()
+
+    root = pathlib.Path(__file__).resolve().parent.parent
+    timings = {"import":[], "make_app":[], "templates":[]}
+    with tempfile.TemporaryDirectory() as dbfolder:
+        # the first run creates the database, which is not a typical startup, so is not counted
+        runonce(dbfolder, root)
+        for run in range(args.runs):
+            result, report = runonce(dbfolder, root)
+            for key, value in result.items():
+                timings[key].append(value)
+
+    for key, values in timings.items():
+        print(f"{key:>10}  median {statistics.median(values)*1000:8.1f} ms   max {max(values)*1000:8.1f} ms")
+    print("\nSlowest imports, excluding the modules they import:")
+    for selftime, name in slowest(report, args.top):
+        print(f"{selftime/1000:8.1f} ms  {name}")
+
+    if args.limit is not None and statistics.median(timings["import"]) > args.limit:
+        print(f"\nMedian import time exceeds the limit of {args.limit} seconds")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
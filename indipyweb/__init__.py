@@ -6,7 +6,7 @@ In which case it creates an app and runs it with uvicorn.
 
 However if indipyweb is imported into your own script, then three functions are available
 
-indipyweb.make_app(dbfolder=None, securecookie = False, basepath = '')
+indipyweb.make_app(dbfolder=None, securecookie = False, basepath = '', templatecache=None, warmup=False, lowmemory=False, public=False)
 
 Which returns an app, ready to be run with uvicorn
 
@@ -40,8 +40,11 @@ from .web.userdata import getconfig
 
 
 
-def make_app(dbfolder=None, securecookie = False, basepath = ''):
-    "Sets the database folder, securecookie flag, and any required basepath subdirectory, returns the ASGI app"
+def make_app(dbfolder=None, securecookie = False, basepath = '', templatecache=None, warmup=False, lowmemory=False, public=False):
+    """Sets the database folder, securecookie flag, and any required basepath subdirectory, returns the ASGI app
+       templatecache is an optional folder for compiled templates, and if warmup is True, templates are
+       compiled in the background once the app has started. If lowmemory is True, smaller buffers are used.
+       If public is True, the device pages of viewers who are not logged in are shared"""
     if dbfolder:
         try:
             dbfolder = pathlib.Path(dbfolder).expanduser().resolve()
@@ -62,8 +65,11 @@ def make_app(dbfolder=None, securecookie = False, basepath = ''):
     else:
         basepath = None
 
+    if templatecache:
+        templatecache = pathlib.Path(templatecache).expanduser().resolve()
+
     # create the asgi app
-    return ipywebclient('', '', dbfolder, securecookie, basepath)
+    return ipywebclient('', '', dbfolder, securecookie, basepath, templatecache, warmup, lowmemory, public)
 
 
 def get_dbhost():
@@ -40,6 +40,15 @@ to ensure loggedin cookies can only pass over https.
 The basepath argument can be set to a path segment which will be prepended
 to the site path. So a string such as '/instruments/' will cause the web
 site to be served beneath the /instruments/ path.
+The templatecache argument sets a folder, created if it does not exist, where
+compiled templates are kept, so they are not compiled again on the next startup.
+With the warmup option, once the server is listening, rarely used routes are
+loaded and every template compiled in the background, so the first use of each
+page is not delayed.
+The lowmemory option lowers the limits of the buffers held by the server, and
+of the number of concurrent browser connections, for small boards.
+With the public option, the device pages shown to viewers who are not logged
+in are rendered once per change and shared, for sites with many such viewers.
 """)
 
     parser.add_argument("--port", type=int, help="Listening port of the web server.")
@@ -47,6 +56,10 @@ site to be served beneath the /instruments/ path.
     parser.add_argument("--dbfolder", help="Folder where the database will be set.")
     parser.add_argument("--securecookie", default="False", help="Set True to enforce https only for cookies.")
     parser.add_argument("--basepath", default="", help="Set a path segment which will be prepended to the URL path.")
+    parser.add_argument("--templatecache", help="Folder where compiled templates will be kept.")
+    parser.add_argument("--warmup", action="store_true", help="Compile templates in the background after startup.")
+    parser.add_argument("--lowmemory", action="store_true", help="Use smaller buffers, for hosts with little memory.")
+    parser.add_argument("--public", action="store_true", help="Share the pages shown to viewers not logged in.")
     parser.add_argument("--version", action="version", version=version)
     args = parser.parse_args()
 
@@ -78,8 +91,15 @@ site to be served beneath the /instruments/ path.
     else:
         basepath = None
 
+    templatecache = None
+    if args.templatecache:
+        templatecache = pathlib.Path(args.templatecache).expanduser().resolve()
+        if templatecache.exists() and not templatecache.is_dir():
+            print("Error: If given, the templatecache should be a directory")
+            sys.exit(1)
+
     # create the client, store it for later access with get_indiclient()
-    app = ipywebclient(args.host, args.port, dbfolder, securecookie, basepath)
+    app = ipywebclient(args.host, args.port, dbfolder, securecookie, basepath, templatecache, args.warmup, args.lowmemory, args.public)
     host = getconfig('host')
     port = getconfig('port')
     return app, host, port
@@ -3,30 +3,62 @@
 Provides ipywebclient, version
 """
 
-import asyncio
+import asyncio, pathlib
+
+from functools import partial
+
+from collections import Counter
 
 import indipyclient as ipc
 
 from .web.app import ipywebapp
-from .web.userdata import LANDING_EVENT, setupdbase, get_indiclient, getconfig, setconfig, get_device_event
+from .web.looplag import LoopMonitor
+from .web.userdata import (LANDING_STATE, setupdbase, get_indiclient, getconfig, setconfig, get_device_event,
+                           get_groupindex, reset_device_events, setblobretention)
+
+from .web.fastjson import clear_cache
+from .web.publiccache import clear_publiccache
+from .web.messagelog import MessageLog, MESSAGELOGNAME
+from .web.blobstore import BlobSink
+from .web.liveview import newframe, clear_liveframes
+from .web.commandqueue import clear_commandqueues, remove_commandqueue
+from .web.sequencer import stop_sequences
+from .web import warmstart
+from .web.lowmemory import apply as lowmemoryprofile
 
 version = "0.2.0"
 
 
+# seconds after the BLOBs of a device cease to be needed before enableBLOB Never is
+# sent, so a viewer reloading the live view does not turn BLOBs off and on again
+BLOBLINGER = 10.0
+
 
-def ipywebclient(host, port, dbfolder, securecookie, basepath):
+def ipywebclient(host, port, dbfolder, securecookie, basepath, templatecache=None, warmup=False, lowmemory=False, public=False):
     "Create an instance of IPyWebClient, return the asgi app"
 
+    if lowmemory:
+        # lower the buffer limits, before the objects using them are created
+        lowmemoryprofile()
+    setconfig('lowmemory', lowmemory)
     setconfig('securecookie', securecookie)
     setconfig('basepath', basepath)
+    setconfig('templatecache', templatecache)
+    setconfig('warmup', warmup)
+    setconfig('public', public)
 
     setupdbase(host, port, dbfolder)
+    setconfig("messagelog", MessageLog(dbfolder / MESSAGELOGNAME))
 
     indihost = getconfig("indihost")
     indiport = getconfig("indiport")
     indiclient = IPyWebClient(indihost=indihost, indiport=indiport)
     indiclient.BLOBfolder = getconfig("blobfolder")
+    setblobretention(indiclient)
     setconfig("indiclient", indiclient)
+    # show the last known devices and vectors until the INDI service defines them
+    warmstart.load(indiclient)
+    setconfig("loopmonitor", LoopMonitor())
     # create and return the asgi app
     return ipywebapp(do_startup, do_shutdown)
 
@@ -37,38 +69,351 @@ def do_startup():
     iclient = get_indiclient()
     runclient = asyncio.create_task(iclient.asyncrun())
     setconfig("runclient", runclient)
+    # and start the event loop lag monitor
+    looplagtask = asyncio.create_task(getconfig("loopmonitor").run())
+    setconfig("looplagtask", looplagtask)
+    # and the writer of the message log
+    messagelogtask = asyncio.create_task(getconfig("messagelog").run())
+    setconfig("messagelogtask", messagelogtask)
+    # and the writers of received BLOBs
+    blobsinktask = asyncio.create_task(iclient.blobsink.run())
+    setconfig("blobsinktask", blobsinktask)
+    # and the writer of the snapshot of the last known state
+    snapshottask = asyncio.create_task(warmstart.run(iclient))
+    setconfig("snapshottask", snapshottask)
 
 
 async def do_shutdown():
     "Stop the client, called from Litestar app"
+    getconfig("loopmonitor").stop()
     iclient = get_indiclient()
+    await warmstart.save(iclient)
     iclient.shutdown()
     await iclient.stopped.wait()
+    await getconfig("messagelog").close()
+    await iclient.blobsink.close()
 
 
 class IPyWebClient(ipc.IPyClient):
 
+    def __init__(self, indihost="localhost", indiport=7624, **clientdata):
+        # received BLOBs are written to the BLOB folder by the sink
+        self.blobsink = BlobSink()
+        # devicenames whose BLOBs an admin has asked to receive
+        self.blobsubscribed = set()
+        # devicename to number of live views of its BLOB members
+        self._blobviewers = Counter()
+        # devicename to scheduled call sending enableBLOB Never, once BLOBLINGER has passed
+        self._blobnever = {}
+        # enableBLOB tasks, held so a strong reference to each remains
+        self._blobtasks = set()
+        # itemids of the devices and vectors of the last known state, not yet defined by the INDI service
+        self.stale = set()
+        # set True when a vector changes, so the next snapshot is written
+        self.snapshotchanged = False
+        # event loop time of the last definition received
+        self.lastdefine = 0.0
+        # the task deleting the vectors not defined again after the connection is made
+        self._reconciletask = None
+        super().__init__(indihost=indihost, indiport=indiport, **clientdata)
+
+        # Events received within this window, in seconds, are gathered into a single
+        # notification to waiting SSE connections. If zero, the notification is
+        # sent as soon as the current burst of received data has been handled.
+        self.event_window = 0.05
+
+        # set True if the landing page needs updating on the next flush
+        self._landing_pending = False
+        # dictionary of devicename to set of changed vector itemids, awaiting the next flush
+        self._devices_pending = {}
+        # set of devicenames which have had vectors defined or deleted, awaiting the next flush
+        self._structure_pending = set()
+        # the scheduled flush, None if no flush is pending
+        self._flush_handle = None
+        # every message received is appended to the persistent message log
+        self.messagelog = getconfig("messagelog")
+
+
+    def clear(self):
+        """Called by the parent IPyClient as the connection is made or lost. Rather than
+           deleting the devices, they are kept as the last known state, marked stale"""
+        self.markstale()
+
+
+    def markstale(self):
+        "Marks the enabled devices and vectors as stale"
+        for deviceobj in self.data.values():
+            if deviceobj.enable:
+                self.stale.add(deviceobj.itemid)
+                self.stale.update(vectorobj.itemid for vectorobj in deviceobj.values() if vectorobj.enable)
+
+
+    # The BLOB folder and enableBLOB handling below set attributes private to indipyclient,
+    # its _enableBLOBdefault and _blobfolderchanged, and the _enableBLOB of each device and
+    # BLOB vector, so the dependency is limited to indipyclient 0.9, see pyproject.toml.
+    # Check these are unchanged before raising that limit.
+
+    def _get_BLOBfolder(self):
+        return self.blobsink.folder
+
+    def _set_BLOBfolder(self, value):
+        """Setting a folder causes every device to be sent enableBLOB Also, and None sends
+           Never to devices whose BLOBs are not otherwise needed. The folder is given to the
+           BLOB sink rather than set in self._BLOBfolder, so the parent IPyClient does not
+           write each file before reading further data"""
+        if value:
+            if isinstance(value, pathlib.Path):
+                blobpath = value
+            else:
+                blobpath = pathlib.Path(value).expanduser().resolve()
+            if not blobpath.is_dir():
+                raise KeyError("If given, the BLOB's folder should be an existing directory")
+        else:
+            blobpath = None
+            if self.blobsink.folder is None:
+                # no change
+                return
+        self.blobsink.setfolder(blobpath)
+        # devices defined later take the default
+        self._enableBLOBdefault = "Also" if blobpath else "Never"
+        for device in self.values():
+            self._setenableBLOB(device, self.blobenable(device.devicename))
+        # the parent sends enableBLOB to all devices when this is set
+        self._blobfolderchanged = True
+
+    BLOBfolder = property(fget=_get_BLOBfolder, fset=_set_BLOBfolder)
+
+
+    def blobreasons(self, devicename):
+        "Returns a list of the reasons the BLOBs of the device are needed, empty if they are not"
+        reasons = []
+        if self.blobsink.folder:
+            reasons.append("the BLOB folder is set")
+        if self._blobviewers.get(devicename):
+            reasons.append("a live view is open")
+        if devicename in self.blobsubscribed:
+            reasons.append("an administrator has subscribed")
+        return reasons
+
+
+    def blobenable(self, devicename):
+        """Returns the enableBLOB value for the device, Also if its BLOBs are needed, otherwise
+           Never, or Also while a Never is waiting to be sent. Only is not used, as that would
+           stop every other property of the device arriving on this single connection"""
+        if devicename in self._blobnever or self.blobreasons(devicename):
+            return "Also"
+        return "Never"
+
+
+    def _setenableBLOB(self, device, value):
+        "Sets the enableBLOB value held by the device and its BLOB vectors, returns True if changed"
+        changed = device._enableBLOB != value
+        device._enableBLOB = value
+        for vector in device.values():
+            if vector.vectortype == "BLOBVector":
+                if vector._enableBLOB != value:
+                    changed = True
+                vector._enableBLOB = value
+        return changed
+
+
+    def updateblobenable(self, devicename):
+        """Called whenever the need for the BLOBs of a device may have changed. Also is sent
+           at once, Never only once BLOBLINGER seconds pass with the BLOBs still not needed"""
+        handle = self._blobnever.pop(devicename, None)
+        if handle is not None:
+            handle.cancel()
+        if not self.blobreasons(devicename):
+            loop = asyncio.get_running_loop()
+            self._blobnever[devicename] = loop.call_later(BLOBLINGER, self._sendblobenable, devicename)
+        else:
+            self._sendblobenable(devicename)
+
+
+    def _sendblobenable(self, devicename):
+        "Sends enableBLOB to the device, if its value has changed"
+        self._blobnever.pop(devicename, None)
+        device = self.get(devicename)
+        if device is None or not self._setenableBLOB(device, self.blobenable(devicename)):
+            return
+        task = asyncio.create_task(self.resend_enableBLOB(devicename))
+        self._blobtasks.add(task)
+        task.add_done_callback(self._blobtasks.discard)
+
+
+    def addblobviewer(self, devicename):
+        "Called as a live view of a BLOB member of the device starts"
+        self._blobviewers[devicename] += 1
+        self.updateblobenable(devicename)
+
+
+    def removeblobviewer(self, devicename):
+        "Called as a live view of a BLOB member of the device ends"
+        self._blobviewers[devicename] -= 1
+        if self._blobviewers[devicename] <= 0:
+            del self._blobviewers[devicename]
+        self.updateblobenable(devicename)
+
+
+    def subscribeblobs(self, devicename, subscribe):
+        "Called as an admin subscribes to, or unsubscribes from, the BLOBs of the device"
+        if subscribe:
+            self.blobsubscribed.add(devicename)
+        else:
+            self.blobsubscribed.discard(devicename)
+        self.updateblobenable(devicename)
+
+
+    async def resend_enableBLOB(self, devicename, vectorname=None):
+        """Called by the parent as each BLOB vector is defined, and as the BLOB folder changes,
+           sets the value for the device from blobenable() before it is sent"""
+        device = self.get(devicename)
+        if device is not None:
+            self._setenableBLOB(device, self.blobenable(devicename))
+        await super().resend_enableBLOB(devicename, vectorname)
+
+
+    def _blobsaved(self, memberobj, devicename, itemid, outstanding, filename):
+        """Called by the BLOB sink as each file is complete, sets the member filename, and
+           once every file of the vector is written, notifies the device page"""
+        if filename is not None:
+            memberobj.filename = filename
+        outstanding.discard(memberobj.name)
+        if not outstanding:
+            self._pending(devicename, itemid)
+
+
+    def _pending(self, devicename=None, itemid=None, landing=False, structure=False):
+        "Record a change, and schedule a flush if one is not already due"
+        if landing:
+            self._landing_pending = True
+        if devicename:
+            changed = self._devices_pending.setdefault(devicename, set())
+            if itemid is not None:
+                changed.add(itemid)
+            if structure:
+                self._structure_pending.add(devicename)
+        if self._flush_handle is None:
+            loop = asyncio.get_running_loop()
+            if self.event_window:
+                self._flush_handle = loop.call_later(self.event_window, self._flush)
+            else:
+                self._flush_handle = loop.call_soon(self._flush)
+
+
+    def _flush(self):
+        "Send the gathered changes as one notification to the landing page and to each changed device"
+        self._flush_handle = None
+        if self._landing_pending:
+            self._landing_pending = False
+            LANDING_STATE.update(self)
+        devices_pending = self._devices_pending
+        self._devices_pending = {}
+        structure_pending = self._structure_pending
+        self._structure_pending = set()
+        for devicename, changed in devices_pending.items():
+            get_device_event(devicename).notify(changed, devicename in structure_pending)
+
+
     async def rxevent(self, event):
 
         if event.eventtype == "getProperties":
             return
 
+        if event.eventtype == "Message":
+            self.messagelog.add(event.timestamp, event.devicename, event.message)
+
         if event.eventtype in ("ConnectionMade", "ConnectionLost"):
-            LANDING_EVENT.set()
-            LANDING_EVENT.clear()
+            # devices are kept, marked stale, see clear(), which the parent
+            # only calls after the ConnectionLost event
+            self.markstale()
+            reset_device_events()
+            clear_cache()
+            clear_publiccache()
+            clear_liveframes()
+            clear_commandqueues()
+            stop_sequences("Stopped, as the connection to the INDI service changed")
+            if event.eventtype == "ConnectionMade":
+                # vectors which the INDI service does not define again are deleted
+                self.lastdefine = asyncio.get_running_loop().time()
+                if self._reconciletask is not None:
+                    self._reconciletask.cancel()
+                self._reconciletask = asyncio.create_task(warmstart.reconcile(self))
+                if self.enabledlen():
+                    # the parent only asks for the properties if it holds no devices
+                    await self.send_getProperties()
+            self._pending(landing=True)
+            # show the stale markers
+            for deviceobj in self.data.values():
+                for vectorobj in deviceobj.values():
+                    if vectorobj.itemid in self.stale:
+                        self._pending(deviceobj.devicename, vectorobj.itemid)
             return
 
-        if event.eventtype in ("Define", "Delete"):
-            # for the landing page
-            LANDING_EVENT.set()
-            LANDING_EVENT.clear()
-            # for the page showing a device
-            if event.devicename:
-                de = get_device_event(event.devicename)
-                de.set()
-                de.clear()
+        itemid = event.vector.itemid if event.vector is not None else None
+
+        if event.devicename and event.vectorname:
+            self.snapshotchanged = True
+
+        if event.eventtype in ("Define", "DefineBLOB"):
+            self.lastdefine = asyncio.get_running_loop().time()
+            groupindex = get_groupindex(event.devicename)
+            regrouped = groupindex.groupof(event.vector) != event.vector.group
+            groupindex.add(event.vector)
+            devicestale = event.device.itemid in self.stale
+            self.stale.discard(event.device.itemid)
+            if itemid in self.stale and not regrouped:
+                # a vector of the last known state, defined again, the page structure
+                # is unchanged, so only its values and stale marker are updated
+                self.stale.discard(itemid)
+                self._pending(event.devicename, itemid, landing=devicestale)
+                return
+            self.stale.discard(itemid)
+            # for the landing page, and for the page showing a device
+            self._pending(event.devicename, itemid, landing=True, structure=True)
+            return
+
+        if event.eventtype == "Delete":
+            if event.message:
+                # a message with the deletion of a whole device is also shown as a system message
+                self.messagelog.add(event.timestamp, event.devicename, event.message, system=not event.vectorname)
+            groupindex = get_groupindex(event.devicename)
+            if event.vectorname:
+                vectorobj = event.device.get(event.vectorname)
+                if vectorobj is not None:
+                    groupindex.remove(vectorobj)
+                    remove_commandqueue(vectorobj.itemid)
+                    self.stale.discard(vectorobj.itemid)
+            else:
+                # the whole device is deleted
+                groupindex.clear()
+                for vectorobj in event.device.values():
+                    remove_commandqueue(vectorobj.itemid)
+                self.stale.discard(event.device.itemid)
+                self.stale.difference_update(vectorobj.itemid for vectorobj in event.device.values())
+            # for the landing page, and for the page showing a device
+            self._pending(event.devicename, itemid, landing=True, structure=True)
             return
 
+        if event.eventtype == "SetBLOB":
+            # each image is held in memory as the latest frame for live viewers
+            for membername, membervalue in event.items():
+                if membervalue:
+                    newframe(event.vector.member(membername), membervalue, event.sizeformat[membername][1])
+
+        if event.eventtype == "SetBLOB" and self.blobsink.folder:
+            # queue each BLOB to be written, waiting if the queue is full, so no further data is
+            # read from the INDI service until there is space. The device is notified when written
+            outstanding = set(membername for membername, membervalue in event.items() if membervalue)
+            if outstanding:
+                event.vector.user_string = ""
+                sizeformat = event.sizeformat
+                for membername in list(outstanding):
+                    done = partial(self._blobsaved, event.vector.member(membername), event.devicename, itemid, outstanding)
+                    await self.blobsink.put(event.devicename, membername, event.timestamp,
+                                            sizeformat[membername][1], event[membername], done)
+                return
+
         if event.devicename:
             if event.vectorname:
                 if event.eventtype == "TimeOut":
@@ -77,10 +422,7 @@ class IPyWebClient(ipc.IPyClient):
                     event.vector.timestamp = event.timestamp
                 else:
                     event.vector.user_string = ""
-            de = get_device_event(event.devicename)
-            de.set()
-            de.clear()
+            self._pending(event.devicename, itemid)
         else:
             # no devicename, may be a system message
-            LANDING_EVENT.set()
-            LANDING_EVENT.clear()
+            self._pending(landing=True)
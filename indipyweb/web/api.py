@@ -0,0 +1,234 @@
+"""
+Handles all routes beneath /api
+
+GET requests return the INDI client, a device or a vector as JSON,
+these do not require the user to be logged in. The JSON is created by
+the fastjson module, which caches the encoded members.
+
+POST /api/{device}/{vector} sets a vector, this requires the token
+cookie of a logged in user. The body is a JSON object such as
+
+{"members": {"membername": value, ...}, "wait": 10}
+
+Values are validated as they are for the web forms, numbers being limited
+to the member minimum, maximum and step. If wait is given, the response is
+delayed, for at most that number of seconds, until the vector state is no
+longer Busy, so the final state is returned in one call.
+
+GET /api/stream returns newline delimited JSON, a line for each vector,
+so large installations are streamed rather than built in memory.
+
+GET /api/wait?device=...&vector=... is a long poll, which returns as soon as
+a condition on the vector holds, or a timeout expires. The request waits on
+the device notifications, so uses no CPU while waiting.
+"""
+
+from typing import Any, Annotated
+
+from litestar import get, post, Request, Router, MediaType
+from litestar.response import Response, Stream
+from litestar.datastructures import State
+from litestar.params import Parameter
+from litestar.exceptions import HTTPException, NotAuthorizedException, NotFoundException, \
+                                PermissionDeniedException, ValidationException
+
+from .userdata import get_indiclient, waitfor
+from .vector import checkswitches, checknumbers
+from .fastjson import clientjson, devicejson, vectorjson
+
+
+# maximum number of seconds a POST may wait for a vector to leave the Busy state
+MAXWAIT = 60.0
+
+
+def api_error_handler(request: Request, exc: HTTPException) -> Response:
+    """Errors from the api routes are returned as JSON, rather than redirecting
+       to the login or notfound pages as the web pages do"""
+    return Response({"status_code":exc.status_code, "detail":exc.detail}, status_code=exc.status_code)
+
+
+@get(["/", "/{device:str}", "/{device:str}/{vector:str}"], exclude_from_auth=True, sync_to_thread=False)
+def api(device:str="", vector:str="") -> Response:
+    "Returns the client, a device or a vector as JSON, or an empty object if not found"
+    iclient = get_indiclient()
+    if not device:
+        # return whole client
+        return Response(clientjson(iclient), media_type=MediaType.JSON)
+    deviceobj = iclient.get(device)
+    if deviceobj is None:
+        return Response(b"{}", media_type=MediaType.JSON)
+    if vector:
+        vectorobj = deviceobj.data.get(vector)
+        if vectorobj is None:
+            return Response(b"{}", media_type=MediaType.JSON)
+        return Response(vectorjson(vectorobj), media_type=MediaType.JSON)
+    return Response(devicejson(deviceobj), media_type=MediaType.JSON)
+
+
+async def vectorlines(iclient, device):
+    "Yields each vector, of the named device or of all devices, as a line of JSON"
+    if device:
+        deviceobj = iclient.get(device)
+        devices = [] if deviceobj is None else [deviceobj]
+    else:
+        devices = list(iclient.data.values())
+    for deviceobj in devices:
+        # take a list, as vectors may be defined while the response is being sent
+        for vectorobj in list(deviceobj.data.values()):
+            yield vectorjson(vectorobj) + b"\n"
+
+
+@get("/stream", exclude_from_auth=True, sync_to_thread=False)
+def apistream(device:str="") -> Stream:
+    """Returns newline delimited JSON, one line per vector, optionally of a single device.
+       Each line is sent as it is created, so the response starts immediately,
+       and memory does not grow with the number of devices"""
+    return Stream(vectorlines(get_indiclient(), device), media_type="application/x-ndjson")
+
+
+def get_apivector(device, vector):
+    """Returns the enabled vector object, or raises NotFoundException, or HTTPException 409
+       if the vector is of the last known state, not yet defined by the INDI service"""
+    iclient = get_indiclient()
+    deviceobj = iclient.get(device)
+    if deviceobj is None or not deviceobj.enable:
+        raise NotFoundException(detail=f"Device {device} not found")
+    vectorobj = deviceobj.data.get(vector)
+    if vectorobj is None or not vectorobj.enable:
+        raise NotFoundException(detail=f"Vector {vector} not found")
+    if vectorobj.itemid in iclient.stale:
+        raise HTTPException(status_code=409, detail="Vector is stale, not yet defined by the INDI service")
+    return vectorobj
+
+
+def apimembers(vectorobj, members):
+    """Checks the members given in a POST, returns a dictionary of member name to value
+       to send, or raises ValidationException"""
+    if not isinstance(members, dict) or not members:
+        raise ValidationException(detail="members should be an object of member names to values")
+    vectormembers = vectorobj.members()
+    for name in members:
+        if name not in vectormembers:
+            raise ValidationException(detail=f"Vector {vectorobj.name} has no member {name}")
+
+    if vectorobj.vectortype == "SwitchVector":
+        given = {}
+        for name, value in members.items():
+            if value is True or value == "On":
+                given[name] = "On"
+            elif value is False or value == "Off":
+                given[name] = "Off"
+            else:
+                raise ValidationException(detail="Switch values should be 'On' or 'Off'")
+        # the switches not given keep their current values, unless one is set On and
+        # the vector rule allows only one On switch, in which case the others are Off
+        if vectorobj.rule != 'AnyOfMany' and "On" in given.values():
+            switches = {name:"Off" for name in vectormembers}
+        else:
+            switches = {name:mbr.membervalue for name, mbr in vectormembers.items()}
+        switches.update(given)
+        error = checkswitches(vectorobj, switches)
+        if error:
+            raise ValidationException(detail=error)
+        return switches
+
+    if vectorobj.vectortype == "NumberVector":
+        try:
+            return checknumbers(vectorobj, members)
+        except Exception:
+            raise ValidationException(detail="Unable to parse number value")
+
+    # text vector
+    return {name:str(value) for name, value in members.items()}
+
+
+@post("/{device:str}/{vector:str}", status_code=200)
+async def apiset(device:str, vector:str, data:dict[str, Any], request: Request[str, str, State]) -> dict:
+    "Set a vector, and optionally wait until its state is no longer Busy"
+    iclient = get_indiclient()
+    if not iclient.connected:
+        raise HTTPException(status_code=503, detail="Not connected to the INDI service")
+    vectorobj = get_apivector(device, vector)
+    if vectorobj.perm == "ro":
+        raise PermissionDeniedException(detail="This is a Read Only vector")
+    if vectorobj.vectortype not in ("SwitchVector", "NumberVector", "TextVector"):
+        raise ValidationException(detail=f"A {vectorobj.vectortype} cannot be set by this api")
+    members = apimembers(vectorobj, data.get("members"))
+    try:
+        wait = min(max(float(data.get("wait", 0)), 0.0), MAXWAIT)
+    except (TypeError, ValueError):
+        raise ValidationException(detail="wait should be a number of seconds")
+
+    # and send the vector, this sets the vector state to Busy
+    await iclient.send_newVector(vectorobj.devicename, vectorobj.name, members=members)
+
+    timedout = False
+    if wait:
+        # each device notification may be the response from the driver
+        timedout = not await waitfor(vectorobj, lambda v: v.state != "Busy", wait)
+
+    return {"sent":members,
+            "state":vectorobj.state,
+            "timedout":timedout,
+            "vector":vectorobj.snapshot().dictdump()}
+
+
+def memberreader(vectorobj, member):
+    """Returns a function giving the current value of the named member, as a float for
+       number vectors, raises ValidationException if the member does not exist"""
+    memberobj = vectorobj.members().get(member)
+    if memberobj is None:
+        raise ValidationException(detail=f"Vector {vectorobj.name} has no member {member}")
+    if vectorobj.vectortype == "NumberVector":
+        return lambda: memberobj.getfloat(memberobj.membervalue)
+    return lambda: memberobj.membervalue
+
+
+@get("/wait", exclude_from_auth=True)
+async def apiwait(device:str, vector:str, member:str="",
+                  vectorstate:Annotated[str, Parameter(query="state")]="", value:str|None=None,
+                  tolerance:float=0.0, changed:bool=False, timeout:float=30.0) -> dict:
+    """Waits until every condition given holds, and returns the vector.
+       state - the vector state equals this, such as Ok
+       value - the member value equals this, for numbers within tolerance
+       changed - the member value, or if no member is given, the vector timestamp, changes
+       timeout - seconds to wait, at most MAXWAIT"""
+    vectorobj = get_apivector(device, vector)
+    if value is not None and not member:
+        raise ValidationException(detail="A member is required to test a value")
+    conditions = []
+    if vectorstate:
+        if vectorstate not in ('Idle','Ok','Busy','Alert'):
+            raise ValidationException(detail="state should be one of Idle, Ok, Busy or Alert")
+        conditions.append(lambda v: v.state == vectorstate)
+    if member:
+        readvalue = memberreader(vectorobj, member)
+    if value is not None:
+        if vectorobj.vectortype == "NumberVector":
+            try:
+                target = vectorobj.member(member).getfloat(value)
+            except Exception:
+                raise ValidationException(detail="Unable to parse number value")
+            conditions.append(lambda v: abs(readvalue() - target) <= tolerance)
+        else:
+            conditions.append(lambda v: readvalue() == value)
+    if changed:
+        if member:
+            initial = readvalue()
+            conditions.append(lambda v: readvalue() != initial)
+        else:
+            initial = vectorobj.timestamp
+            conditions.append(lambda v: v.timestamp != initial)
+    if not conditions:
+        raise ValidationException(detail="At least one of state, value or changed is required")
+    timeout = min(max(timeout, 0.0), MAXWAIT)
+    met = await waitfor(vectorobj, lambda v: all(condition(v) for condition in conditions), timeout)
+    return {"met":met,
+            "vector":vectorobj.snapshot().dictdump()}
+
+
+api_router = Router(path="/api",
+                    route_handlers=[apiwait, apistream, api, apiset],
+                    exception_handlers={HTTPException: api_error_handler,
+                                        NotAuthorizedException: api_error_handler,
+                                        NotFoundException: api_error_handler})
@@ -4,12 +4,14 @@ and authentication functions, including setting and testing cookies
 
 Note, edit routes are set under edit.edit_router
 
-"""
+The edit, setup, BLOB folder and sequence pages are rarely used, so their modules are only
+imported, and their routers registered, on the first request to one of their
+routes, or by the optional warmup, which also compiles every template once the
+server is running.
 
-import asyncio
+"""
 
-from os import listdir, remove
-from os.path import isfile, join
+import asyncio, importlib
 
 from pathlib import Path
 
@@ -18,12 +20,12 @@ from collections.abc import AsyncGenerator
 from asyncio.exceptions import TimeoutError
 
 from litestar import Litestar, get, post, Request
-from litestar.plugins.htmx import HTMXPlugin, HTMXTemplate, ClientRedirect, ClientRefresh
+from litestar.plugins.htmx import HTMXPlugin, HTMXTemplate, ClientRedirect
 from litestar.contrib.mako import MakoTemplateEngine
 from litestar.template.config import TemplateConfig
-from litestar.response import Template, Redirect, File
-from litestar.static_files import create_static_files_router
+from litestar.response import Template, Redirect, File, Response
 from litestar.datastructures import Cookie, State
+from litestar.config.compression import CompressionConfig
 
 from litestar.middleware import AbstractAuthenticationMiddleware, AuthenticationResult, DefineMiddleware
 from litestar.connection import ASGIConnection
@@ -31,7 +33,11 @@ from litestar.exceptions import NotAuthorizedException, NotFoundException
 
 from litestar.response import ServerSentEvent, ServerSentEventMessage
 
-from . import userdata, edit, device, vector, setup
+from mako.lookup import TemplateLookup
+
+from . import userdata, device, vector, api, messagelog, liveview, staticfiles, warmstart
+
+from .sendqueue import SendQueue
 
 
 # location of static files, for CSS and javascript
@@ -40,14 +46,51 @@ STATICFILES = Path(__file__).parent.resolve() / "static"
 # location of template files
 TEMPLATEFILES = Path(__file__).parent.resolve() / "templates"
 
+# number of system messages shown on the landing page
+LANDINGLINES = 8
+
+# Routes of rarely used pages, which are registered on the first request to them.
+# Dictionary of the first path segment to (module name, router name)
+LAZYROUTES = {"edit": ("edit", "edit_router"),
+              "setup": ("setup", "setup_router"),
+              "blobs": ("blobpages", "blobpages_router"),
+              "getblob": ("blobpages", "blobpages_router"),
+              "viewblob": ("blobpages", "blobpages_router"),
+              "viewimage": ("blobpages", "blobpages_router"),
+              "delblob": ("blobpages", "blobpages_router"),
+              "sequences": ("sequencer", "sequences_router")}
+
+# set of the module names whose routers have been registered
+LAZYREGISTERED = set()
+
+# query parameter added to a request repeated after its lazy route is registered, so it is only repeated once
+LAZYREPEAT = "lazyrepeat"
+
+# seconds after startup before the warmup begins, so the server is listening first
+WARMUPDELAY = 1.0
+
+# number of compiled templates held, the least recently used being discarded, -1 for no limit
+TEMPLATECACHESIZE = -1
+
+
+def registerlazy(app, modulename, routername):
+    "Imports the module and registers its router, returns False if this has already been done"
+    if modulename in LAZYREGISTERED:
+        return False
+    module = importlib.import_module(f".{modulename}", __package__)
+    app.register(getattr(module, routername))
+    LAZYREGISTERED.add(modulename)
+    return True
+
 
 class LandingPageChange:
     """Iterate whenever an instrument change happens or a system message received."""
 
+    __slots__ = ("instruments_version", "messages_version", "iclient")
+
     def __init__(self):
-        self.instruments = set()              # record instrument names
-        self.lasttimestamp = None             # lasttimestamp records last system message changed
-        self.connected = False
+        self.instruments_version = None       # records the landing state versions last sent
+        self.messages_version = None
         self.iclient = userdata.get_indiclient()
 
     def __aiter__(self):
@@ -58,32 +101,23 @@ class LandingPageChange:
         while True:
             if self.iclient.stop:
                 raise StopAsyncIteration
-            if self.iclient.connected != self.connected:
-                self.connected = self.iclient.connected
-                return ServerSentEventMessage(event="newinstruments")
-            # get current set of instrument names for enabled devices
-            newinstruments = set(name for name,value in self.iclient.items() if value.enable)
-            if newinstruments != self.instruments:
+            # the landing state is shared by all connections, and maintained by the client rxevent
+            state = userdata.LANDING_STATE
+            if state.instruments_version != self.instruments_version:
                 # There has been a change, send a newinstruments to the users browser
-                self.instruments = newinstruments
+                self.instruments_version = state.instruments_version
                 return ServerSentEventMessage(event="newinstruments")
-            # no change in the instruments, check for new system message
-            if self.iclient.messages:
-                lasttimestamp = self.iclient.messages[0][0]
-                if (self.lasttimestamp is None) or (lasttimestamp != self.lasttimestamp):
-                    # a new message is received
-                    self.lasttimestamp = lasttimestamp
-                    return ServerSentEventMessage(event="newmessages")
-            elif self.lasttimestamp is not None:
-                # There are no self.iclient.messages, but self.lasttimestamp
-                # has a value, so there has been a change
-                self.lasttimestamp = None
+            if state.messages_version != self.messages_version:
+                # a new message is received
+                self.messages_version = state.messages_version
                 return ServerSentEventMessage(event="newmessages")
             # No change, wait, at most 5 seconds, for a LANDING_EVENT
             try:
                 await asyncio.wait_for(userdata.LANDING_EVENT.wait(), timeout=5.0)
             except TimeoutError:
-                pass
+                # check the state has not changed without an event, this is
+                # done at most once every five seconds, however many connections exist
+                state.refresh(self.iclient)
             # either a LANDING_EVENT has occurred, or 5 seconds since the last has passed
             # so continue the while loop to check for any new devices or messages
 
@@ -91,7 +125,7 @@ class LandingPageChange:
 # SSE Handler
 @get(path="/instruments", exclude_from_auth=True, sync_to_thread=False)
 def instruments() -> ServerSentEvent:
-    return ServerSentEvent(LandingPageChange())
+    return ServerSentEvent(SendQueue(LandingPageChange()).messages())
 
 
 class LoggedInAuth(AbstractAuthenticationMiddleware):
@@ -132,8 +166,20 @@ def gotologin_error_handler(request: Request, exc: Exception) -> ClientRedirect|
 
 def gotonotfound_error_handler(request: Request, exc: Exception) -> ClientRedirect|Redirect:
     """If a NotFoundException is raised, this handles it, and redirects
-       the caller to the not found page"""
+       the caller to the not found page. If the path is of a lazy route, it is registered
+       if not already, and the caller redirected to repeat the request once, as a request
+       arriving while another registers the route may not have been matched against it"""
     basepath = userdata.getconfig("basepath")
+    path = request.url.path
+    if basepath and path.startswith(basepath):
+        path = path[len(basepath):]
+    lazy = LAZYROUTES.get(path.lstrip("/").split("/")[0])
+    if lazy is not None and LAZYREPEAT not in request.query_params:
+        registerlazy(request.app, *lazy)
+        query = request.url.query
+        query = f"{query}&{LAZYREPEAT}=1" if query else f"{LAZYREPEAT}=1"
+        # 307 so a POST is repeated with its body
+        return Redirect(str(request.url.with_replacements(query=query)), status_code=307)
     if basepath:
         redirectpath = basepath + "notfound"
     else:
@@ -194,27 +240,26 @@ def indipyweb(request: Request) -> Template:
     return Template("landing.html", context={"hostname":userdata.connectedtext(),
                                              "loggedin":loggedin,
                                              "blobfolder":blobfolder,
-                                             "apipath":apipath})
+                                             "apipath":apipath,
+                                             "landinglines":LANDINGLINES})
 
 
 @get("/updateinstruments", exclude_from_auth=True, sync_to_thread=False )
 def updateinstruments(request: Request) -> Template:
     "Updates the instruments on the main public page"
-    iclient = userdata.get_indiclient()
-    instruments = list(deviceobj for deviceobj in iclient.values() if deviceobj.enable)
-    instruments.sort(key=lambda x: x.devicename)
+    # the enabled instruments are held sorted in the shared landing state
+    instruments = userdata.LANDING_STATE.instruments
     return HTMXTemplate(template_name="instruments.html", context={"instruments":instruments})
 
 
 @get("/updatemessages", exclude_from_auth=True, sync_to_thread=False )
-def updatemessages() -> Template:
-    "Updates the messages on the main public page"
+def updatemessages(after:int=0) -> Template:
+    """Updates the messages on the main public page, only the messages with an id greater
+       than after are returned, and these are appended to those already shown"""
     iclient = userdata.get_indiclient()
     if iclient.stop:
-        return HTMXTemplate(template_name="messages.html", context={"messages":["Error: client application has stopped"]})
-    messages = list(iclient.messages)
-    messagelist = list(userdata.localtimestring(t) + "  " + m for t,m in messages)
-    messagelist.reverse()
+        return HTMXTemplate(template_name="messages.html", context={"messages":[(0, "Error: client application has stopped")]})
+    messagelist = messagelog.livelines("", after, LANDINGLINES)
     return HTMXTemplate(template_name="messages.html", context={"messages":messagelist})
 
 
@@ -295,154 +340,81 @@ def getbackup(backupfile:str, request: Request[str, str, State]) -> File:
         )
 
 
-@get("/blobs", sync_to_thread=False )
-def blobs(request: Request[str, str, State]) -> Template:
-    "Shows a page of blob files"
-    iclient = userdata.get_indiclient()
-    blobfolder = iclient.BLOBfolder
-    if blobfolder:
-        blobfiles = [f for f in listdir(blobfolder) if (not f.startswith(".") and isfile(join(blobfolder, f)))]
-        blobfiles.sort()
+@get("/static/{filename:str}", exclude_from_auth=True, sync_to_thread=False)
+def static(filename:str, request: Request) -> Response:
+    "Serve a static file from memory, precompressed if the browser accepts it"
+    asset = staticfiles.HASHED.get(filename)
+    if asset is not None:
+        # a content hashed name never changes content, so can be cached indefinitely
+        cachecontrol = "public, max-age=31536000, immutable"
     else:
-        blobfiles = []
-    images = []
-    for bfile in blobfiles:
-        bsuffix = Path(bfile).suffix.lower()
-        if bsuffix in ('.jpeg', '.jpg', '.png', 'apng', '.gif', '.webp', '.avif', '.svg', '.jxl'):
-            images.append(True)
-        else:
-            images.append(False)
-    admin = True if request.auth == "admin" else False
-    context = {'blobfiles':blobfiles,
-               'images':images,
-               'admin':admin}
-    return Template("blobs.html", context=context)
-
-
-@get("/getblob/{blobfile:str}", media_type="application/octet", sync_to_thread=False )
-def getblob(blobfile:str, request: Request[str, str, State]) -> File:
-    "Download a BLOB to the browser client"
-    if blobfile.startswith("."):
-        raise NotFoundException()
-    iclient = userdata.get_indiclient()
-    blobfolder = iclient.BLOBfolder
-    if not blobfolder:
-        raise NotFoundException()
-    blobpath = iclient.BLOBfolder / blobfile
-    if not blobpath.is_file():
-        raise NotFoundException()
-    return File(
-        path=blobpath,
-        filename=blobfile
-        )
-
-
-@get("/viewblob/{blobfile:str}", sync_to_thread=False )
-def viewblob(blobfile:str, request: Request[str, str, State]) -> Template:
-    "Show the image page"
-    if blobfile.startswith("."):
-        raise NotFoundException()
-    iclient = userdata.get_indiclient()
-    blobfolder = iclient.BLOBfolder
-    if not blobfolder:
-        raise NotFoundException()
-    blobpath = iclient.BLOBfolder / blobfile
-    if not blobpath.is_file():
-        raise NotFoundException()
-    suffix = blobpath.suffix.lower()
-    if suffix not in ('.jpeg', '.jpg', '.png', 'apng', '.gif', '.webp', '.avif', '.svg', '.jxl'):
-        raise NotFoundException()
-    return Template("image.html", context={"blob":blobfile})
+        asset = staticfiles.ASSETS.get(filename)
+        if asset is None:
+            raise NotFoundException()
+        # a plain name should be revalidated using the ETag
+        cachecontrol = "no-cache"
+    headers = {"ETag": asset.etag, "Vary": "Accept-Encoding", "Cache-Control": cachecontrol}
+    if request.headers.get("if-none-match") == asset.etag:
+        return Response(content=b"", status_code=304, headers=headers)
+    content, encoding = asset.encoded(request.headers.get("accept-encoding", ""))
+    if encoding:
+        headers["Content-Encoding"] = encoding
+    return Response(content=content, media_type=asset.media_type, headers=headers)
 
 
-@get("/viewimage/{blobfile:str}", sync_to_thread=False )
-def viewimage(blobfile:str, request: Request[str, str, State]) -> File:
-    "Show a BLOB image page"
-    if blobfile.startswith("."):
-        raise NotFoundException()
-    iclient = userdata.get_indiclient()
-    blobfolder = iclient.BLOBfolder
-    if not blobfolder:
-        raise NotFoundException()
-    blobpath = iclient.BLOBfolder / blobfile
-    if not blobpath.is_file():
-        raise NotFoundException()
-    suffix = blobpath.suffix.lower()
-    if suffix == '.jpeg' or suffix == '.jpg':
-         blobmedia = 'image/jpeg'
-    elif suffix == '.png':
-         blobmedia = 'image/png'
-    elif suffix == '.apng':
-         blobmedia = 'image/apng'
-    elif suffix == '.gif':
-         blobmedia = 'image/gif'
-    elif suffix == '.webp':
-         blobmedia = 'image/webp'
-    elif suffix == '.avif':
-         blobmedia = 'image/avif'
-    elif suffix == '.svg':
-         blobmedia = 'image/svg+xml'
-    elif suffix == '.jxl':
-         blobmedia = 'image/jxl'
-    else:
-        raise NotFoundException()
-    return File(
-        path=blobpath,
-        filename=blobfile,
-        media_type=blobmedia
-        )
+# This defines LoggedInAuth as middleware and also
+# excludes certain paths from authentication.
+# In this case it excludes all routes mounted at or under `/static*`
+# This allows CSS and javascript libraries to be placed there, which
+# therefore do not need authentication to be accessed
+auth_mw = DefineMiddleware(LoggedInAuth, exclude="static")
 
 
+# HTML, JSON and SSE responses are compressed with brotli if the optional
+# brotli package is installed, otherwise with gzip.
+# Static files are already compressed, and BLOBs, live frames and backup files
+# are typically images or binary data, so these are not compressed again.
+compression_config = CompressionConfig(backend="brotli" if staticfiles.brotli else "gzip",
+                                       gzip_fallback=True,
+                                       minimum_size=500,
+                                       exclude=["static", "getblob", "viewimage", "getbackup", "live/frame", "live/mjpeg"])
 
-@get("/delblob/{blobfile:str}", sync_to_thread=False )
-def delblob(blobfile:str, request: Request[str, str, State]) -> ClientRefresh:
-    "Deletes a blob"
-    auth = request.auth
-    if auth != "admin":
-        raise NotAuthorizedException()
-    if blobfile.startswith("."):
-        raise NotFoundException()
-    iclient = userdata.get_indiclient()
-    blobfolder = iclient.BLOBfolder
-    if not blobfolder:
-        raise NotFoundException()
-    blobpath = iclient.BLOBfolder / blobfile
-    if not blobpath.is_file():
-        raise NotFoundException()
-    remove(blobpath)
-    return ClientRefresh()
 
+async def warmup(app):
+    """Registers the lazily imported routes, and compiles every template, each in turn
+       so requests are answered between them. Templates are compiled in a thread, and
+       if a template cache folder is set, are written there for the next startup"""
+    await asyncio.sleep(WARMUPDELAY)
+    for modulename, routername in set(LAZYROUTES.values()):
+        registerlazy(app, modulename, routername)
+        await asyncio.sleep(0)
+    lookup = app.template_engine.engine
+    for path in sorted(TEMPLATEFILES.rglob("*.html")):
+        await asyncio.to_thread(lookup.get_template, path.relative_to(TEMPLATEFILES).as_posix())
 
 
-@get(["/api", "/api/{device:str}", "/api/{device:str}/{vector:str}"], exclude_from_auth=True, sync_to_thread=False)
-def api(device:str="", vector:str="") -> dict:
-    iclient = userdata.get_indiclient()
-    if not device:
-        # return whole client dict
-        shot = iclient.snapshot()
-        return shot.dictdump()
-    deviceobj = iclient.get(device)
-    if deviceobj is None:
-        return {}
-    if vector:
-        vectorobj = deviceobj.data.get(vector)
-        if vectorobj is None:
-            return {}
-        shot = vectorobj.snapshot()
-        return shot.dictdump()
-    shot = deviceobj.snapshot()
-    return shot.dictdump()
+def startwarmup(app):
+    "If the warmup option is set, start the warmup task, held in the config for a strong reference"
+    if userdata.getconfig("warmup"):
+        userdata.setconfig("warmuptask", asyncio.create_task(warmup(app)))
 
 
-# This defines LoggedInAuth as middleware and also
-# excludes certain paths from authentication.
-# In this case it excludes all routes mounted at or under `/static*`
-# This allows CSS and javascript libraries to be placed there, which
-# therefore do not need authentication to be accessed
-auth_mw = DefineMiddleware(LoggedInAuth, exclude="static")
+def register_callables(engine):
+    "Set as the template engine_callback, so templates can call static() and stale()"
+    staticfiles.register_callables(engine)
+    engine.register_template_callable(key="stale", template_callable=warmstart.stale)
 
 
 def ipywebapp(do_startup, do_shutdown):
+    # read and compress the static files
+    staticfiles.loadassets(STATICFILES)
+    LAZYREGISTERED.clear()
+    # As the Litestar default, every expression is html escaped. If a template cache folder
+    # is set, compiled templates are kept there, and reused on startup if not changed
+    templatecache = userdata.getconfig("templatecache")
+    lookup = TemplateLookup(directories=[TEMPLATEFILES], default_filters=["h"],
+                            module_directory=str(templatecache) if templatecache else None,
+                            collection_size=TEMPLATECACHESIZE)
     # Initialize the Litestar app with a Mako template engine and register the routes
     app = Litestar( path = userdata.getconfig("basepath"),
         route_handlers=[publicroot,
@@ -455,25 +427,24 @@ def ipywebapp(do_startup, do_shutdown):
                         logout,
                         instruments,
                         getbackup,
-                        blobs,
-                        getblob,
-                        viewblob,
-                        viewimage,
-                        delblob,
-                        api,
-                        edit.edit_router,     # This router in edit.py deals with routes below /edit
+                        # edit.edit_router, setup.setup_router, blobpages.blobpages_router and
+                        # sequencer.sequences_router
+                        # are registered when first requested, see LAZYROUTES
                         device.device_router, # This router in device.py deals with routes below /device
                         vector.vector_router, # This router in vector.py deals with routes below /vector
-                        setup.setup_router,   # This router in setup.py deals with routes below /setup
-                        create_static_files_router(path="/static", directories=[STATICFILES]),
+                        api.api_router,       # This router in api.py deals with routes below /api
+                        messagelog.messages_router, # This router in messagelog.py deals with routes below /messages
+                        liveview.live_router, # This router in liveview.py deals with routes below /live
+                        static,
                        ],
         exception_handlers={ NotAuthorizedException: gotologin_error_handler, NotFoundException: gotonotfound_error_handler},
         plugins=[HTMXPlugin()],
         middleware=[auth_mw],
-        template_config=TemplateConfig(directory=TEMPLATEFILES,
-                                       engine=MakoTemplateEngine,
+        compression_config=compression_config,
+        template_config=TemplateConfig(engine=MakoTemplateEngine.from_template_lookup(lookup),
+                                       engine_callback=register_callables
                                       ),
-        on_startup=[do_startup],
+        on_startup=[do_startup, startwarmup],
         on_shutdown=[do_shutdown],
         openapi_config=None
         )
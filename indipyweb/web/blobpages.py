@@ -0,0 +1,142 @@
+"""
+Handles the pages listing, showing, downloading and deleting the files in the BLOB folder,
+routes /blobs, /getblob, /viewblob, /viewimage and /delblob
+
+These are rarely used, so this module is only imported, and its router registered,
+on the first request to one of these routes, see app.LAZYROUTES
+"""
+
+from os import remove
+
+from pathlib import Path
+
+from litestar import get, Request, Router
+from litestar.plugins.htmx import ClientRefresh
+from litestar.response import Template, File
+from litestar.datastructures import State
+from litestar.exceptions import NotAuthorizedException, NotFoundException
+
+from . import userdata
+
+
+@get("/blobs", sync_to_thread=False )
+def blobs(request: Request[str, str, State]) -> Template:
+    "Shows a page of blob files"
+    iclient = userdata.get_indiclient()
+    if iclient.BLOBfolder:
+        # the BLOB index is kept up to date as files are written, so the folder is not listed
+        blobfiles = iclient.blobsink.index.names()
+    else:
+        blobfiles = []
+    images = []
+    for bfile in blobfiles:
+        bsuffix = Path(bfile).suffix.lower()
+        if bsuffix in ('.jpeg', '.jpg', '.png', 'apng', '.gif', '.webp', '.avif', '.svg', '.jxl'):
+            images.append(True)
+        else:
+            images.append(False)
+    admin = True if request.auth == "admin" else False
+    context = {'blobfiles':blobfiles,
+               'images':images,
+               'admin':admin}
+    return Template("blobs.html", context=context)
+
+
+@get("/getblob/{blobfile:str}", media_type="application/octet", sync_to_thread=False )
+def getblob(blobfile:str, request: Request[str, str, State]) -> File:
+    "Download a BLOB to the browser client"
+    if blobfile.startswith("."):
+        raise NotFoundException()
+    iclient = userdata.get_indiclient()
+    blobfolder = iclient.BLOBfolder
+    if not blobfolder:
+        raise NotFoundException()
+    blobpath = iclient.BLOBfolder / blobfile
+    if not blobpath.is_file():
+        raise NotFoundException()
+    return File(
+        path=blobpath,
+        filename=blobfile
+        )
+
+
+@get("/viewblob/{blobfile:str}", sync_to_thread=False )
+def viewblob(blobfile:str, request: Request[str, str, State]) -> Template:
+    "Show the image page"
+    if blobfile.startswith("."):
+        raise NotFoundException()
+    iclient = userdata.get_indiclient()
+    blobfolder = iclient.BLOBfolder
+    if not blobfolder:
+        raise NotFoundException()
+    blobpath = iclient.BLOBfolder / blobfile
+    if not blobpath.is_file():
+        raise NotFoundException()
+    suffix = blobpath.suffix.lower()
+    if suffix not in ('.jpeg', '.jpg', '.png', 'apng', '.gif', '.webp', '.avif', '.svg', '.jxl'):
+        raise NotFoundException()
+    return Template("image.html", context={"blob":blobfile})
+
+
+@get("/viewimage/{blobfile:str}", sync_to_thread=False )
+def viewimage(blobfile:str, request: Request[str, str, State]) -> File:
+    "Show a BLOB image page"
+    if blobfile.startswith("."):
+        raise NotFoundException()
+    iclient = userdata.get_indiclient()
+    blobfolder = iclient.BLOBfolder
+    if not blobfolder:
+        raise NotFoundException()
+    blobpath = iclient.BLOBfolder / blobfile
+    if not blobpath.is_file():
+        raise NotFoundException()
+    suffix = blobpath.suffix.lower()
+    if suffix == '.jpeg' or suffix == '.jpg':
+         blobmedia = 'image/jpeg'
+    elif suffix == '.png':
+         blobmedia = 'image/png'
+    elif suffix == '.apng':
+         blobmedia = 'image/apng'
+    elif suffix == '.gif':
+         blobmedia = 'image/gif'
+    elif suffix == '.webp':
+         blobmedia = 'image/webp'
+    elif suffix == '.avif':
+         blobmedia = 'image/avif'
+    elif suffix == '.svg':
+         blobmedia = 'image/svg+xml'
+    elif suffix == '.jxl':
+         blobmedia = 'image/jxl'
+    else:
+        raise NotFoundException()
+    return File(
+        path=blobpath,
+        filename=blobfile,
+        media_type=blobmedia
+        )
+
+
+
+@get("/delblob/{blobfile:str}", sync_to_thread=False )
+def delblob(blobfile:str, request: Request[str, str, State]) -> ClientRefresh:
+    "Deletes a blob"
+    auth = request.auth
+    if auth != "admin":
+        raise NotAuthorizedException()
+    if blobfile.startswith("."):
+        raise NotFoundException()
+    iclient = userdata.get_indiclient()
+    blobfolder = iclient.BLOBfolder
+    if not blobfolder:
+        raise NotFoundException()
+    blobpath = iclient.BLOBfolder / blobfile
+    if not blobpath.is_file():
+        # the file may have been removed other than by this server
+        iclient.blobsink.index.remove(blobfile)
+        raise NotFoundException()
+    remove(blobpath)
+    iclient.blobsink.index.remove(blobfile)
+    return ClientRefresh()
+
+
+blobpages_router = Router(path="/", route_handlers=[blobs, getblob, viewblob, viewimage, delblob])
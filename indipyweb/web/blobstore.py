@@ -0,0 +1,313 @@
+"""
+Writes received BLOBs to the BLOB folder without blocking the event loop.
+
+The client passes each received BLOB to the BlobSink, which queues it for
+a small pool of writer threads. Each file is first written to a hidden
+'.part' file, and renamed to its final name once complete, so a partly
+written file is never listed or served.
+
+The queue is bounded, when it is full the INDI client waits before reading
+further data, so a camera sending BLOBs faster than the disk can take them
+is slowed, rather than filling memory.
+
+A BlobIndex holds the name, size, time and device of every file in the
+folder, oldest first, and is updated as each file is completed or deleted,
+so the folder does not need to be listed on every request.
+
+The retention limits set on the setup page, a maximum folder size, a
+maximum file age, and a number of files to keep for each device, are
+applied by a background task, which uses the index to choose the oldest
+files to delete, and deletes them a few at a time in a writer thread.
+"""
+
+import asyncio, os, time, logging
+
+from collections import Counter
+
+from concurrent.futures import ThreadPoolExecutor
+
+from dataclasses import dataclass
+
+
+logger = logging.getLogger("indipyweb")
+
+
+# number of threads writing BLOB files
+WRITERS = 2
+
+# number of received BLOBs which may wait to be written, further BLOBs
+# are not read from the INDI service until there is space
+MAXINFLIGHT = 4
+
+# seconds between checks of the retention limits, checks are also made as files are written
+RETENTIONINTERVAL = 60.0
+
+# maximum number of files deleted in each step, the event loop is free between steps
+EVICTBATCH = 20
+
+
+@dataclass
+class BlobFile:
+    "An entry in the BlobIndex"
+    size: int
+    mtime: float
+    devicename: str
+
+
+class BlobIndex:
+    """Dictionary of filename to BlobFile, for the files in the BLOB folder,
+       in order of modification time, oldest first"""
+
+    def __init__(self):
+        self.files = {}
+        self.totalbytes = 0
+
+    def __contains__(self, filename):
+        return filename in self.files
+
+    def __len__(self):
+        return len(self.files)
+
+    def get(self, filename):
+        return self.files.get(filename)
+
+    def add(self, filename, size, mtime, devicename=""):
+        "Adds a new file, which is expected to be the newest"
+        self.remove(filename)
+        self.files[filename] = BlobFile(size, mtime, devicename)
+        self.totalbytes += size
+
+    def remove(self, filename):
+        "Removes the file from the index, returns the BlobFile or None if not present"
+        blobfile = self.files.pop(filename, None)
+        if blobfile is not None:
+            self.totalbytes -= blobfile.size
+        return blobfile
+
+    def clear(self):
+        self.files.clear()
+        self.totalbytes = 0
+
+    def names(self):
+        "Returns a sorted list of the file names"
+        return sorted(self.files)
+
+    def oldest(self):
+        "Returns an iterator of (filename, BlobFile), oldest first"
+        return iter(list(self.files.items()))
+
+    def expired(self, maxbytes=0, maxage=0, keeplast=0, limit=EVICTBATCH):
+        """Returns a list of up to limit file names, oldest first, which exceed the limits.
+           maxbytes is the total size of the folder, maxage is in seconds, and keeplast
+           is the number of newest files kept for each device, any of which may be zero
+           for no limit. Files which were present before the server started are of an
+           unknown device, and are counted together"""
+        if not (maxbytes or maxage or keeplast):
+            return []
+        excess = self.totalbytes - maxbytes if maxbytes else 0
+        cutoff = time.time() - maxage if maxage else 0
+        counts = Counter(blobfile.devicename for blobfile in self.files.values()) if keeplast else None
+        expired = []
+        for filename, blobfile in self.files.items():
+            if len(expired) >= limit:
+                break
+            if excess > 0 or blobfile.mtime < cutoff or (keeplast and counts[blobfile.devicename] > keeplast):
+                expired.append(filename)
+                excess -= blobfile.size
+                if keeplast:
+                    counts[blobfile.devicename] -= 1
+            elif not keeplast:
+                # files are oldest first, so no later file is too old, and the size is within the limit
+                break
+        return expired
+
+
+def scanfolder(folder):
+    """Called in a writer thread, returns a list of (filename, size, mtime) of the
+       files in folder, oldest first, ignoring hidden files"""
+    found = []
+    with os.scandir(folder) as entries:
+        for entry in entries:
+            if entry.name.startswith(".") or not entry.is_file():
+                continue
+            stat = entry.stat()
+            found.append((entry.name, stat.st_size, stat.st_mtime))
+    found.sort(key=lambda x: x[2])
+    return found
+
+
+def deletefiles(folder, filenames):
+    "Called in a writer thread, deletes the files, returns a list of those deleted or already missing"
+    deleted = []
+    for filename in filenames:
+        try:
+            (folder / filename).unlink(missing_ok=True)
+        except OSError:
+            logger.exception(f"Unable to delete BLOB file {filename}")
+        else:
+            deleted.append(filename)
+    return deleted
+
+
+def writeblob(folder, filename, payload):
+    """Called in a writer thread, writes payload to a hidden part file, then renames it
+       to filename, or if a file of that name already exists, to a numbered variant.
+       Returns (filename, size, mtime) of the completed file"""
+    partpath = folder / f".{filename}.part"
+    try:
+        partpath.write_bytes(payload)
+    except OSError:
+        partpath.unlink(missing_ok=True)
+        raise
+    stem, dot, suffix = filename.rpartition(".")
+    if not dot:
+        stem, suffix = filename, ""
+    counter = 0
+    while (folder / filename).exists():
+        counter += 1
+        filename = f"{stem}_{counter}.{suffix}" if dot else f"{stem}_{counter}"
+    os.replace(partpath, folder / filename)
+    stat = (folder / filename).stat()
+    return filename, stat.st_size, stat.st_mtime
+
+
+class BlobSink:
+    "Queues received BLOBs, and writes them to the BLOB folder with a pool of threads"
+
+    def __init__(self, writers=None, maxinflight=None):
+        self.folder = None
+        self.index = BlobIndex()
+        self.writers = writers or WRITERS
+        self.executor = ThreadPoolExecutor(max_workers=self.writers, thread_name_prefix="blobwriter")
+        self.queue = asyncio.Queue(maxsize=maxinflight or MAXINFLIGHT)
+        # file names given to BLOBs which are queued or being written
+        self._reserved = set()
+        self._scanning = None
+        # set as each file is written, so the retention limits are checked
+        self._written = asyncio.Event()
+        # retention limits, maximum total bytes, maximum age in seconds, files kept per device
+        self.maxbytes = 0
+        self.maxage = 0
+        self.keeplast = 0
+
+    def setfolder(self, folder):
+        "Sets the folder, and if the event loop is running, rebuilds the index from its contents"
+        self.folder = folder
+        self.index.clear()
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            # not yet running, the index is built when run() is awaited
+            return
+        self._scanning = asyncio.create_task(self.rescan())
+
+    async def rescan(self):
+        "Rebuilds the index by listing the folder in a writer thread"
+        folder = self.folder
+        self.index.clear()
+        if folder is None:
+            return
+        loop = asyncio.get_running_loop()
+        try:
+            found = await loop.run_in_executor(self.executor, scanfolder, folder)
+        except OSError:
+            logger.exception("Unable to list the BLOB folder")
+            return
+        if folder != self.folder:
+            # the folder has changed while listing
+            return
+        # files written while listing are newer than those listed, so are added after them
+        written = list(self.index.files.items())
+        self.index.clear()
+        for filename, size, mtime in found:
+            self.index.add(filename, size, mtime)
+        for filename, blobfile in written:
+            self.index.add(filename, blobfile.size, blobfile.mtime, blobfile.devicename)
+
+    def reserve(self, membername, timestamp, suffix):
+        """Returns a file name, made as the parent IPyClient does from the member name and
+           timestamp, which is not used by an existing or queued file"""
+        timestampstring = timestamp.strftime('%Y%m%d_%H_%M_%S')
+        filename = membername + "_" + timestampstring + suffix
+        counter = 0
+        while filename in self.index or filename in self._reserved:
+            counter += 1
+            filename = membername + "_" + timestampstring + "_" + str(counter) + suffix
+        self._reserved.add(filename)
+        return filename
+
+    async def put(self, devicename, membername, timestamp, suffix, payload, done):
+        """Queue a BLOB to be written, waiting if the queue is full. When the file is
+           complete done(filename) is called, with None if the write failed"""
+        filename = self.reserve(membername, timestamp, suffix)
+        await self.queue.put((self.folder, devicename, filename, payload, done))
+
+    def setretention(self, maxbytes=0, maxage=0, keeplast=0):
+        "Sets the retention limits, zero for no limit, these are applied by the retention task"
+        self.maxbytes = maxbytes
+        self.maxage = maxage
+        self.keeplast = keeplast
+        self._written.set()
+
+    async def run(self):
+        "Await this to run the writers and the retention task"
+        if self.folder is not None and self._scanning is None:
+            await self.rescan()
+        await asyncio.gather(self._retain(), *(self._writer() for n in range(self.writers)))
+
+    async def _retain(self):
+        """Deletes the oldest files exceeding the retention limits, a batch at a time,
+           whenever a file is written, or the limits are changed, or every RETENTIONINTERVAL"""
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                await asyncio.wait_for(self._written.wait(), timeout=RETENTIONINTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            self._written.clear()
+            while self.folder is not None:
+                folder = self.folder
+                expired = self.index.expired(self.maxbytes, self.maxage, self.keeplast)
+                if not expired:
+                    break
+                try:
+                    deleted = await loop.run_in_executor(self.executor, deletefiles, folder, expired)
+                except Exception:
+                    logger.exception("Exception report from BLOB retention")
+                    break
+                if folder != self.folder:
+                    break
+                for filename in deleted:
+                    self.index.remove(filename)
+                if len(deleted) < len(expired):
+                    # files could not be deleted, try again later
+                    break
+
+    async def close(self, timeout=10.0):
+        "Waits, for at most timeout seconds, for queued BLOBs to be written"
+        try:
+            await asyncio.wait_for(self.queue.join(), timeout=timeout)
+        except asyncio.TimeoutError:
+            logger.error("BLOB files were not written before shutdown")
+        self.executor.shutdown(wait=False)
+
+    async def _writer(self):
+        "Takes BLOBs from the queue and writes each in a thread of the executor"
+        loop = asyncio.get_running_loop()
+        while True:
+            folder, devicename, filename, payload, done = await self.queue.get()
+            savedname = None
+            try:
+                savedname, size, mtime = await loop.run_in_executor(self.executor, writeblob, folder, filename, payload)
+                if folder == self.folder:
+                    self.index.add(savedname, size, mtime, devicename)
+                    self._written.set()
+            except Exception:
+                logger.exception(f"Unable to write BLOB file {filename}")
+            finally:
+                self._reserved.discard(filename)
+                self.queue.task_done()
+            try:
+                done(savedname)
+            except Exception:
+                logger.exception("Exception report from BLOB write completion")
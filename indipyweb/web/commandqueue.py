@@ -0,0 +1,118 @@
+"""
+Queues the commands submitted to each vector, so rapid submissions do not flood a slow driver.
+
+A command submitted while the vector is Busy is held rather than sent, and
+once the vector is no longer Busy, or QUEUEWAIT seconds have passed, the held
+command is sent. Only the latest command is held, a command submitted while
+another is held replaces it, latest wins, and the replaced command is counted
+as dropped.
+
+A switch command equal to the one held, or while nothing is held, equal to
+the last sent which the vector is still Busy with, is dropped as a duplicate,
+so repeated clicks on a switch send it once.
+
+The numbers queued and dropped since the vector was last free are given in
+the result shown to the user.
+"""
+
+import asyncio, logging
+
+from .userdata import waitfor
+
+
+logger = logging.getLogger("indipyweb")
+
+
+# maximum seconds a command is held while the vector stays Busy, it is then sent regardless
+QUEUEWAIT = 30.0
+
+
+class CommandQueue:
+    "Holds the latest command submitted to a vector while it is Busy"
+
+    __slots__ = ("pending", "lastsent", "queued", "dropped", "task")
+
+    def __init__(self):
+        # dictionary of member name to value of the held command, or None
+        self.pending = None
+        # the members of the last command sent
+        self.lastsent = None
+        # commands held, and held commands dropped, since the vector was last free
+        self.queued = 0
+        self.dropped = 0
+        # the task sending the held command
+        self.task = None
+
+    def isduplicate(self, vectorobj, members):
+        "Returns True if members is a switch command already held, or already sent and still Busy"
+        if vectorobj.vectortype != "SwitchVector":
+            return False
+        if self.pending is not None:
+            return members == self.pending
+        return vectorobj.state == "Busy" and members == self.lastsent
+
+    async def submit(self, iclient, vectorobj, members):
+        """Sends the command, or holds it until the vector is no longer Busy.
+           Returns True if sent, False if held or dropped"""
+        if self.pending is None and vectorobj.state != "Busy":
+            self.queued = 0
+            self.dropped = 0
+            self.lastsent = members
+            await iclient.send_newVector(vectorobj.devicename, vectorobj.name, members=members)
+            return True
+        if self.isduplicate(vectorobj, members):
+            self.dropped += 1
+            return False
+        if self.pending is not None:
+            # latest wins
+            self.dropped += 1
+        self.pending = members
+        self.queued += 1
+        if self.task is None:
+            self.task = asyncio.create_task(self.drain(iclient, vectorobj))
+        return False
+
+    async def drain(self, iclient, vectorobj):
+        "Sends each held command once the vector is no longer Busy"
+        try:
+            while self.pending is not None:
+                await waitfor(vectorobj, lambda v: v.state != "Busy", QUEUEWAIT)
+                if iclient.stop or not vectorobj.enable:
+                    self.pending = None
+                    break
+                members, self.pending = self.pending, None
+                self.lastsent = members
+                await iclient.send_newVector(vectorobj.devicename, vectorobj.name, members=members)
+        except Exception:
+            self.pending = None
+            logger.exception("Exception report from the command queue")
+        finally:
+            self.task = None
+
+
+# dictionary of vector itemid to CommandQueue
+COMMANDQUEUES = {}
+
+
+def get_commandqueue(vectorobj):
+    "Returns the CommandQueue of the vector, created if not present"
+    commandqueue = COMMANDQUEUES.get(vectorobj.itemid)
+    if commandqueue is None:
+        commandqueue = CommandQueue()
+        COMMANDQUEUES[vectorobj.itemid] = commandqueue
+    return commandqueue
+
+
+def remove_commandqueue(itemid):
+    "Called when a vector is deleted, its held command is discarded"
+    commandqueue = COMMANDQUEUES.pop(itemid, None)
+    if commandqueue is not None and commandqueue.task is not None:
+        commandqueue.task.cancel()
+
+
+def clear_commandqueues():
+    "Called when the INDI connection is made or lost, held commands are discarded"
+    for commandqueue in COMMANDQUEUES.values():
+        if commandqueue.task is not None:
+            commandqueue.task.cancel()
+    COMMANDQUEUES.clear()
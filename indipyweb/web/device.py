@@ -6,31 +6,172 @@ import asyncio
 
 from asyncio.exceptions import TimeoutError
 
-from itertools import cycle
+from collections import OrderedDict
+
+from secrets import token_urlsafe
 
 from litestar import Litestar, get, post, Request, Router
 from litestar.plugins.htmx import HTMXTemplate, ClientRedirect
-from litestar.response import Template, Redirect
+from litestar.response import Template, Redirect, Response
 from litestar.datastructures import State
+from litestar.exceptions import NotAuthorizedException
 
 from litestar.response import ServerSentEvent, ServerSentEventMessage
 
-from .userdata import localtimestring, get_device_event, get_indiclient, getuserauth, get_deviceobj
+from .sendqueue import SendQueue
+
+from .messagelog import livelines
+
+from .publiccache import ispublic, deviceversion, publicresponse, rendertemplate
+
+from .userdata import get_device_event, get_indiclient, getuserauth, getuserinfo, get_deviceobj, get_groupindex
+
+# number of device messages shown on the device page
+DEVICELINES = 3
+
+# maximum number of device page subscriptions held, the oldest not in use by an SSE connection are discarded
+MAXSUBSCRIPTIONS = 1000
+
+# dictionary of subscription key to Subscription, oldest first
+SUBSCRIPTIONS = OrderedDict()
+
+
+class Subscription:
+    """The vectors a device page is showing, either a group, or an explicit set of vector ids.
+       Each device page is given a key, which its SSE connection and group tab requests
+       carry, so switching tabs changes which vectors the connection sends events for."""
+
+    __slots__ = ("version", "group", "vectorids", "timestamps", "connections")
+
+    def __init__(self, group=None, vectorids=None):
+        self.version = 0
+        # number of SSE connections using this subscription, it is not discarded while any are open
+        self.connections = 0
+        self.select(group, vectorids)
+
+    def select(self, group=None, vectorids=None, rendered=()):
+        """Sets the group or vector ids being viewed, rendered is the vectors just sent to
+           the browser, whose timestamps are recorded so they are not sent again unchanged"""
+        self.group = group
+        self.vectorids = None if vectorids is None else frozenset(vectorids)
+        self.timestamps = {vectorobj.itemid:vectorobj.timestamp for vectorobj in rendered}
+        self.version += 1
+
+
+def get_subscription(key, group=None, rendered=()):
+    "Returns the Subscription for key, created if not present, and selects group if given"
+    subscription = SUBSCRIPTIONS.get(key)
+    if subscription is None:
+        subscription = Subscription(group)
+        SUBSCRIPTIONS[key] = subscription
+        excess = len(SUBSCRIPTIONS) - MAXSUBSCRIPTIONS
+        if excess > 0:
+            unused = [oldkey for oldkey, oldsubscription in SUBSCRIPTIONS.items() if not oldsubscription.connections]
+            for oldkey in unused[:excess]:
+                del SUBSCRIPTIONS[oldkey]
+    else:
+        SUBSCRIPTIONS.move_to_end(key)
+    if group is not None:
+        subscription.select(group, rendered=rendered)
+    return subscription
+
+
+async def subscribedmessages(deviceobj, key, lasteventid):
+    """Yields the SSE messages of the device, for the page subscription key.
+       The subscription is taken when the connection starts, and held until it closes,
+       so the page's later group requests select the vectors of this same subscription"""
+    subscription = get_subscription(key)
+    subscription.connections += 1
+    messages = SendQueue(DeviceEvent(deviceobj, subscription, lasteventid)).messages()
+    try:
+        async for message in messages:
+            yield message
+    finally:
+        subscription.connections -= 1
+        await messages.aclose()
+
 
 class DeviceEvent:
-    """Iterate whenever a device change happens."""
+    """Iterate whenever a device change happens.
+       Updated vectors are sent as a single vectors event, its data being the vector ids.
+       If a subscription is given, only vectors it selects are included."""
 
-    def __init__(self, deviceobj):
+    __slots__ = ("lasttimestamp", "deviceobj", "subscription", "version", "selected", "resumed",
+                 "device_event", "serial", "iclient", "vectors", "currentvectorids", "tocheck")
+
+    def __init__(self, deviceobj, subscription=None, lasteventid=None):
         self.lasttimestamp = None
         self.deviceobj = deviceobj
+        self.subscription = subscription
+        self.version = None      # the subscription version applied
+        self.selected = None     # set of selected itemids, None for all vectors
+        self.resumed = False     # True if resumed, until the first notification is handled
         self.device_event = get_device_event(deviceobj.devicename)
+        self.serial = self.device_event.serial
         self.iclient = get_indiclient()
+        # record vectors and time of last change, as a dictionary of itemid:[timestamp, vectorobj]
+        self.vectors = {vectorobj.itemid:[None, vectorobj] for vectorobj in self.deviceobj.values() if vectorobj.enable}
         # record current vector ids for this device
-        self.currentvectorids = set(vectorobj.itemid for vectorobj in self.deviceobj.values() if vectorobj.enable)
-        # record vectors and time of last change
-        self.vectors = tuple([None, vectorobj] for vectorobj in self.deviceobj.values() if vectorobj.enable)
-        self.number = len(self.vectors)  # number of vectors
-        self.rotator = cycle(self.vectors)
+        self.currentvectorids = set(self.vectors)
+        # the itemids of vectors which may have changed, and are yet to be checked
+        self.tocheck = set(self.vectors)
+        if lasteventid:
+            self._resume(lasteventid)
+
+
+    def _resume(self, lasteventid):
+        """The browser has reconnected, giving the id of the last event it received,
+           if the notifications since then are held, only vectors changed since are sent"""
+        lastserial = self.device_event.parseid(lasteventid)
+        if lastserial is None:
+            return
+        missed = self.device_event.since(lastserial)
+        if missed is None:
+            return
+        changed, structure = missed
+        if structure:
+            # vectors have been defined or deleted, so a newvectors event is sent
+            self.currentvectorids = None
+        for itemid, vector in self.vectors.items():
+            vector[0] = None if itemid in changed else vector[1].timestamp
+        self.tocheck = set(changed).intersection(self.vectors)
+        self.resumed = True
+        if self.subscription is not None:
+            # the page has the vectors, so the timestamps recorded when it was rendered are not applied
+            self.version = self.subscription.version
+            self._select()
+
+
+    def _select(self):
+        "Sets self.selected from the subscription, None if every vector is selected"
+        subscription = self.subscription
+        if subscription is None:
+            return
+        if subscription.vectorids is not None:
+            self.selected = set(subscription.vectorids)
+        elif subscription.group is not None:
+            groupindex = get_groupindex(self.deviceobj.devicename)
+            self.selected = set(vectorobj.itemid for vectorobj in groupindex.getgroup(subscription.group))
+        else:
+            self.selected = None
+        if self.version != subscription.version:
+            # the browser has just been sent these vectors, so record their timestamps
+            for itemid, timestamp in subscription.timestamps.items():
+                if itemid in self.vectors:
+                    self.vectors[itemid][0] = timestamp
+            self.version = subscription.version
+            self.tocheck.update(self.vectors)
+        if self.selected is not None:
+            self.tocheck.intersection_update(self.selected)
+
+
+    def merge(self, waiting, message):
+        """Called by SendQueue if an event is received while one of the same name is waiting
+           to be sent, returns the message to send in place of both"""
+        if message.event != "vectors":
+            return message
+        itemids = set(waiting.data.split(",")) | set(message.data.split(","))
+        return ServerSentEventMessage(data=",".join(sorted(itemids, key=int)), event="vectors", id=message.id)
 
 
     def __aiter__(self):
@@ -69,42 +210,131 @@ class DeviceEvent:
                 self.currentvectorids = newvectorids
 
                 # if there has been a change, reset the following
-                self.vectors = tuple([vectorobj.timestamp, vectorobj] for vectorobj in self.deviceobj.values() if vectorobj.enable)
-                self.number = len(self.vectors)  # number of vectors
-                self.rotator = cycle(self.vectors)
-                return ServerSentEventMessage(event="newvectors")
-
-            # check if a vector has been updated by checking its timestamp
-            for i in range(self.number):
-                nextvector = next(self.rotator)
+                self.vectors = {vectorobj.itemid:[vectorobj.timestamp, vectorobj] for vectorobj in self.deviceobj.values() if vectorobj.enable}
+                self.tocheck.clear()
+                # the vectors of the selected group may have changed
+                self._select()
+                return ServerSentEventMessage(event="newvectors", id=self.device_event.eventid(self.serial))
+
+            if (self.subscription is not None) and (self.version != self.subscription.version):
+                # the page has switched group tab
+                self._select()
+
+            # check if changed vectors have been updated by checking their timestamps
+            # and send one vectors event listing every updated vector
+            updated = []
+            while self.tocheck:
+                nextvector = self.vectors.get(self.tocheck.pop())
+                if nextvector is None:
+                    continue
                 lasttimestamp = nextvector[0]
                 currenttimestamp = nextvector[1].timestamp
                 if (lasttimestamp is None) or (lasttimestamp != currenttimestamp):
                     # the vector has been updated
                     nextvector[0] = currenttimestamp
-                    return ServerSentEventMessage(event= f"vector_{nextvector[1].itemid}")
+                    updated.append(nextvector[1].itemid)
+            if updated:
+                # the event id records that every notification up to self.serial has been sent
+                return ServerSentEventMessage(data=",".join(str(itemid) for itemid in sorted(updated)),
+                                              event="vectors",
+                                              id=self.device_event.eventid(self.serial))
+
+            # gather the vectors changed by any notifications received since the last check
+            if self.device_event.serial != self.serial:
+                if self.device_event.serial == self.serial + 1:
+                    # only the last notification has been missed, which carries the changed itemids
+                    changed = self.device_event.changed
+                else:
+                    missed = self.device_event.since(self.serial)
+                    # if the notifications are no longer held, check every vector
+                    changed = set(self.vectors) if missed is None else missed[0]
+                if self.resumed:
+                    # changes made before resuming, but notified after, have not been sent
+                    for itemid in changed:
+                        if itemid in self.vectors:
+                            self.vectors[itemid][0] = None
+                    self.resumed = False
+                self.tocheck.update(changed)
+                if self.selected is not None:
+                    self.tocheck.intersection_update(self.selected)
+                self.serial = self.device_event.serial
+                continue
 
             # No change, wait, at most 5 seconds, for a device event
             try:
                 await asyncio.wait_for(self.device_event.wait(), timeout=5)
             except TimeoutError:
-                pass
+                # check every selected vector
+                self.tocheck.update(self.vectors if self.selected is None else self.selected)
             # either a device message event has occurred, or 5 seconds since the last has passed
             # so continue the while loop to check for any new messages
 
 
+def deviceindex(deviceobj):
+    """Returns the GroupIndex of the device, maintained as vectors are defined and deleted.
+       If it is empty, though the device is enabled, it is rebuilt"""
+    groupindex = get_groupindex(deviceobj.devicename)
+    if not groupindex.groups and deviceobj.enable:
+        groupindex.rebuild(deviceobj)
+    return groupindex
+
+
 # SSE Handler
 @get(path="/devicechange/{deviceid:int}", exclude_from_auth=True, sync_to_thread=False)
-def devicechange(deviceid:int, request: Request[str, str, State]) -> ServerSentEvent|ClientRedirect:
-    "This monitors whenever a device changes"
+def devicechange(deviceid:int, request: Request[str, str, State],
+                 sub:str|None=None, vectors:str|None=None) -> ServerSentEvent|ClientRedirect:
+    """This monitors whenever a device changes.
+       sub is the key of the page subscription, whose group is kept updated as tabs are chosen,
+       or vectors can be a comma separated list of vector ids, if neither is given all vectors are monitored.
+       A reconnecting browser, sending a Last-Event-ID header, is sent only the changes it has missed"""
     deviceobj = get_deviceobj(deviceid)
     if deviceobj is None:
         return ClientRedirect("../../")
-    return ServerSentEvent(DeviceEvent(deviceobj))
+    # a browser reconnecting gives the id of the last event received
+    lasteventid = request.headers.get("last-event-id")
+    subscription = None
+    if vectors is not None:
+        try:
+            vectorids = set(int(vectorid) for vectorid in vectors.split(",") if vectorid.strip())
+        except ValueError:
+            vectorids = set()
+        subscription = Subscription(vectorids=vectorids)
+    elif sub:
+        return ServerSentEvent(subscribedmessages(deviceobj, sub, lasteventid))
+    return ServerSentEvent(SendQueue(DeviceEvent(deviceobj, subscription, lasteventid)).messages())
+
+
+def blobstatus(iclient, deviceobj, admin):
+    """Returns the context of the blobenable.html template, showing whether BLOBs are
+       requested from the device, or None if the device has no BLOB vectors"""
+    if not any(vectorobj.enable and vectorobj.vectortype == "BLOBVector" for vectorobj in deviceobj.values()):
+        return
+    return {"reasons":iclient.blobreasons(deviceobj.devicename),
+            "subscribed":deviceobj.devicename in iclient.blobsubscribed,
+            "admin":admin}
+
+
+def devicecontext(deviceobj, sub, loggedin, blobcontext, blobfolder):
+    "Returns the context of the device page, showing its first group, sub being the page subscription key"
+    groupindex = deviceindex(deviceobj)
+    groups = groupindex.groups
+    group = groups[0]
+    vectorsingroup = groupindex.getgroup(group)   # sorted by label
+    if sub:
+        get_subscription(sub, group, vectorsingroup)
+    return {"deviceobj":deviceobj,
+            "sub":sub,
+            "group":group,
+            "groups":groups,
+            "loggedin":loggedin,
+            "vectors": vectorsingroup,
+            "devicelines":DEVICELINES,
+            "blobstatus":blobcontext,
+            "blobfolder":blobfolder}
 
 
 @get("/choosedevice/{deviceid:int}", exclude_from_auth=True, sync_to_thread=False)
-def choosedevice(deviceid:int, request: Request[str, str, State]) -> Template|Redirect:
+def choosedevice(deviceid:int, request: Request[str, str, State]) -> Template|Redirect|Response:
     """A device has been selected"""
 
     # have to check device exists
@@ -115,51 +345,46 @@ def choosedevice(deviceid:int, request: Request[str, str, State]) -> Template|Re
         return Redirect("../../")
     # Check if user is logged in
     loggedin = False
+    admin = False
     cookie = request.cookies.get('token', '')
     if cookie:
         userauth = getuserauth(cookie)
         if userauth is not None:
             loggedin = True
+            userinfo = getuserinfo(userauth.user)
+            admin = userinfo is not None and userinfo.auth == "admin"
     iclient = get_indiclient()
     blobfolder = True if iclient.BLOBfolder else False
-    groups = list(set(vectorobj.group for vectorobj in deviceobj.values() if vectorobj.enable))
-    groups.sort()
-    group = groups[0]
-    vectorsingroup = list(vectorobj for vectorobj in deviceobj.values() if vectorobj.group == group and vectorobj.enable)
-    vectorsingroup.sort(key=lambda x: x.label)   # sort by label
-    context = {"deviceobj":deviceobj,
-               "group":group,
-               "groups":groups,
-               "loggedin":loggedin,
-               "vectors": vectorsingroup,
-               "blobfolder":blobfolder}
-
+    if ispublic(loggedin):
+        # the page shared by every anonymous viewer, so without a page subscription
+        return publicresponse(request, ("choosedevice", deviceid),
+                              (deviceversion(deviceobj.devicename), blobfolder),
+                              lambda: rendertemplate(request, "devicepage.html",
+                                                     devicecontext(deviceobj, "", False, None, blobfolder)))
+    # the page subscription, so the SSE connection only sends events for the group shown
+    context = devicecontext(deviceobj, token_urlsafe(8), loggedin,
+                            blobstatus(iclient, deviceobj, admin) if loggedin else None, blobfolder)
     return Template(template_name="devicepage.html", context=context)
 
 
 @get("/updatemessages/{deviceid:int}", exclude_from_auth=True, sync_to_thread=False)
-def updatemessages(deviceid:int, request: Request[str, str, State]) -> Template|ClientRedirect:
-    "Updates the messages on the device page, and redirects to / if device deleted"
+def updatemessages(deviceid:int, request: Request[str, str, State], after:int=0) -> Template|ClientRedirect:
+    """Updates the messages on the device page, and redirects to / if device deleted.
+       Only the messages with an id greater than after are returned, and these are
+       appended to those already shown"""
     deviceobj = get_deviceobj(deviceid)
     if deviceobj is None:
         return ClientRedirect("../../")
     if not deviceobj.enable:
         return Redirect("../../")
-    messages = list(deviceobj.messages)
-    if not messages:
-        return HTMXTemplate(template_name="messages.html", context={"messages":["Device messages : Waiting.."]})
-    messagelist = list(localtimestring(t) + "  " + m for t,m in messages)
-    messagelist.reverse()
-    # Show last three messages
-    if len(messagelist) > 3:
-        messagelist = messagelist[-3:]
+    messagelist = livelines(deviceobj.devicename, after, DEVICELINES)
     return HTMXTemplate(template_name="messages.html", context={"messages":messagelist})
 
 
 
 @get("/getgroup/{deviceid:int}/{group:str}", exclude_from_auth=True, sync_to_thread=False)
-def getgroup(deviceid:int, group:str, request: Request[str, str, State]) -> Template|ClientRedirect:
-    "Set chosen group, populate group tabs and group vectors"
+def getgroup(deviceid:int, group:str, request: Request[str, str, State], sub:str="") -> Template|ClientRedirect|Response:
+    "Set chosen group, populate group tabs and group vectors, and update the page subscription"
     deviceobj = get_deviceobj(deviceid)
     if deviceobj is None:
         return ClientRedirect("../../../")
@@ -172,25 +397,54 @@ def getgroup(deviceid:int, group:str, request: Request[str, str, State]) -> Temp
         userauth = getuserauth(cookie)
         if userauth is not None:
             loggedin = True
-    groups = list(set(vectorobj.group for vectorobj in deviceobj.values() if vectorobj.enable ))
-    groups.sort()
-    if group not in groups:
+    groupindex = deviceindex(deviceobj)
+    groups = groupindex.groups
+    if not groups:
+        return ClientRedirect("../../../")
+    if group not in groupindex.vectors:
         group = groups[0]
-    # get vectors in this group
-    vectorsingroup = list(vectorobj for vectorobj in deviceobj.values() if vectorobj.group == group and vectorobj.enable)
-    vectorsingroup.sort(key=lambda x: x.label)   # sort by label
+    # get vectors in this group, sorted by label
+    vectorsingroup = groupindex.getgroup(group)
     context = { "deviceobj": deviceobj,
+                "sub":sub,
                 "vectors":vectorsingroup,
                 "groups":groups,
                 "selectedgp":group,
                 "loggedin":loggedin,
                 "blobfolder":blobfolder}
+    if ispublic(loggedin) and not sub:
+        # shared by every anonymous viewer, whose pages have no subscription
+        return publicresponse(request, ("getgroup", deviceid, group),
+                              (deviceversion(deviceobj.devicename), blobfolder),
+                              lambda: rendertemplate(request, "group.html", context))
+    if sub:
+        get_subscription(sub, group, vectorsingroup)
     return HTMXTemplate(template_name="group.html", context=context)
 
 
 
+@post("/blobsubscribe/{deviceid:int}")
+async def blobsubscribe(deviceid:int, request: Request[str, str, State]) -> Template|ClientRedirect:
+    "An admin subscribes to, or unsubscribes from, the BLOBs of the device"
+    if request.auth != "admin":
+        raise NotAuthorizedException()
+    deviceobj = get_deviceobj(deviceid)
+    if deviceobj is None or not deviceobj.enable:
+        return ClientRedirect("../../")
+    iclient = get_indiclient()
+    status = blobstatus(iclient, deviceobj, True)
+    if status is None:
+        # the device has no BLOB vectors
+        return ClientRedirect("../../")
+    form_data = await request.form()
+    iclient.subscribeblobs(deviceobj.devicename, form_data.get("subscribe") == "true")
+    context = {"deviceobj":deviceobj, **blobstatus(iclient, deviceobj, True)}
+    return HTMXTemplate(template_name="blobenable.html", context=context)
+
+
 device_router = Router(path="/device", route_handlers=[choosedevice,
                                                        devicechange,
                                                        updatemessages,
-                                                       getgroup
+                                                       getgroup,
+                                                       blobsubscribe
                                                        ])
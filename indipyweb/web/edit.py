@@ -12,12 +12,16 @@ from litestar.response import ServerSentEvent, ServerSentEventMessage
 
 from . import userdata
 
+from .sendqueue import SendQueue
+
 
 ##################
 
 class TableChange:
     """Iterate whenever a user table change happens."""
 
+    __slots__ = ()
+
     def __aiter__(self):
         return self
 
@@ -30,7 +34,7 @@ class TableChange:
 # SSE Handler
 @get(path="/tablechange", exclude_from_auth=True, sync_to_thread=False)
 def tablechange(request: Request[str, str, State]) -> ServerSentEvent:
-    return ServerSentEvent(TableChange())
+    return ServerSentEvent(SendQueue(TableChange()).messages())
 
 
 #################
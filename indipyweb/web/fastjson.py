@@ -0,0 +1,147 @@
+"""
+Encodes the INDI client, devices and vectors as JSON for the /api routes.
+
+The JSON is the same as that given by the indipyclient snapshot dictdump()
+methods, but is created directly from the live objects without taking a
+snapshot copy, using msgspec or orjson if available, with the standard
+library json module as a fallback.
+
+The encoded bytes of each member, and of each vector's own fields, are
+cached, and are only encoded again when their values change. So a request
+for the whole client mostly joins cached fragments, rather than encoding
+every member of every vector.
+"""
+
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+import json
+
+
+if msgspec is not None:
+    encode = msgspec.json.Encoder().encode
+elif orjson is not None:
+    encode = orjson.dumps
+else:
+    def encode(obj):
+        "Returns obj encoded as JSON bytes"
+        return json.dumps(obj, separators=(',', ':')).encode()
+
+
+# dictionary of member itemid to (key, encoded bytes), the bytes being "membername":{...}
+MEMBERCACHE = {}
+
+# dictionary of vector itemid to (key, encoded bytes), the bytes being the vector
+# fields other than its members, without the closing brace
+VECTORCACHE = {}
+
+
+def clear_cache():
+    "Called when the INDI connection is made or lost, as the devices are then cleared"
+    MEMBERCACHE.clear()
+    VECTORCACHE.clear()
+
+
+def memberkey(vectortype, memberobj):
+    "Returns a tuple of the member values which are encoded"
+    if vectortype == "NumberVector":
+        return (memberobj.label, memberobj._membervalue, memberobj.format,
+                memberobj.min, memberobj.max, memberobj.step)
+    if vectortype == "BLOBVector":
+        return (memberobj.label, memberobj.filename, memberobj.blobsize, memberobj.blobformat)
+    return (memberobj.label, memberobj._membervalue)
+
+
+def memberdict(vectortype, memberobj):
+    "Returns the member as a dictionary, as given by the snapshot dictdump() method"
+    if vectortype == "NumberVector":
+        return {"label": memberobj.label,
+                "format": memberobj.format,
+                "min": memberobj.min,
+                "max": memberobj.max,
+                "step": memberobj.step,
+                "value": memberobj._membervalue,
+                "floatvalue": memberobj.getfloatvalue(),
+                "formattedvalue": memberobj.getformattedvalue()}
+    if vectortype == "BLOBVector":
+        # BLOB values are not included
+        return {"label": memberobj.label,
+                "filename": memberobj.filename,
+                "blobsize": memberobj.blobsize,
+                "blobformat": memberobj.blobformat,
+                "value": None}
+    return {"label": memberobj.label,
+            "value": memberobj._membervalue}
+
+
+def memberjson(vectortype, memberobj):
+    "Returns the member encoded as JSON bytes, prefixed by its name, from the cache if unchanged"
+    key = memberkey(vectortype, memberobj)
+    cached = MEMBERCACHE.get(memberobj.itemid)
+    if cached is not None and cached[0] == key:
+        return cached[1]
+    encoded = encode(memberobj.name) + b":" + encode(memberdict(vectortype, memberobj))
+    MEMBERCACHE[memberobj.itemid] = (key, encoded)
+    return encoded
+
+
+def vectorjson(vectorobj):
+    "Returns the vector encoded as JSON bytes, members which are unchanged are taken from the cache"
+    key = (vectorobj.label, vectorobj.enable, vectorobj.message, vectorobj.message_timestamp,
+           vectorobj.group, vectorobj.state, vectorobj.timeout, vectorobj.timestamp,
+           vectorobj.rule, vectorobj.perm)
+    cached = VECTORCACHE.get(vectorobj.itemid)
+    if cached is not None and cached[0] == key:
+        head = cached[1]
+    else:
+        vecdict = {"vectortype":vectorobj.vectortype,
+                   "name":vectorobj.name,
+                   "devicename":vectorobj.devicename,
+                   "label":vectorobj.label,
+                   "enable":vectorobj.enable,
+                   "message":vectorobj.message,
+                   "message_timestamp":vectorobj.message_timestamp.isoformat(sep='T'),
+                   "group":vectorobj.group,
+                   "state":vectorobj.state,
+                   "timeout":vectorobj.timeout,
+                   "timestamp":vectorobj.timestamp.isoformat(sep='T')}
+        if vectorobj.rule:
+            vecdict["rule"] = vectorobj.rule
+        if vectorobj.perm:
+            vecdict["perm"] = vectorobj.perm
+        # remove the closing brace, so the members can be appended
+        head = encode(vecdict)[:-1]
+        VECTORCACHE[vectorobj.itemid] = (key, head)
+    vectortype = vectorobj.vectortype
+    members = b",".join([memberjson(vectortype, memberobj) for memberobj in vectorobj.data.values()])
+    return head + b',"members":{' + members + b'}}'
+
+
+def messagesjson(messages):
+    "Returns a deque of (timestamp, message) encoded as a JSON list"
+    return encode([[timestamp.isoformat(sep='T'), message] for timestamp, message in messages])
+
+
+def devicejson(deviceobj):
+    "Returns the device encoded as JSON bytes"
+    vectors = b",".join([encode(name) + b":" + vectorjson(vectorobj)
+                         for name, vectorobj in deviceobj.data.items()])
+    return (encode({"devicename":deviceobj.devicename, "enable":deviceobj.enable})[:-1]
+            + b',"messages":' + messagesjson(deviceobj.messages)
+            + b',"vectors":{' + vectors + b'}}')
+
+
+def clientjson(iclient):
+    "Returns the client, with all its devices, encoded as JSON bytes"
+    devices = b",".join([encode(devicename) + b":" + devicejson(deviceobj)
+                         for devicename, deviceobj in iclient.data.items()])
+    return (encode({"indihost":iclient.indihost, "indiport":iclient.indiport, "connected":iclient.connected})[:-1]
+            + b',"messages":' + messagesjson(iclient.messages)
+            + b',"devices":{' + devices + b'}}')
@@ -0,0 +1,213 @@
+"""
+Handles all routes beneath /live, showing the latest image received by a BLOB member.
+
+As each image BLOB is received, its payload is kept in memory as the latest
+frame of the member, replacing the previous one, so a viewer is sent the
+frame without reading it back from the BLOB folder, which need not be set.
+While a live view is open, the client asks the device to send its BLOBs.
+
+/live/{vectorid}/{memberid} is a page showing the frame, which is told of
+each new frame by an SSE frame event carrying the frame id. The frame is
+then fetched from /live/frame/{vectorid}/{memberid}/{frameid}, as the id
+changes with every frame, the URL can be cached indefinitely. The page
+only fetches the newest frame once the one loading has arrived, and SSE
+frame events waiting to be sent are collapsed into the newest, so a slow
+connection skips frames rather than falling behind.
+
+/live/mjpeg/{vectorid}/{memberid} sends the frames as a multipart stream,
+which can be used as the src of an img element, or by other applications.
+Each part is the newest frame once the previous part is sent, so again a
+slow connection skips frames.
+"""
+
+import asyncio
+
+from asyncio.exceptions import TimeoutError
+
+from secrets import token_urlsafe
+
+from litestar import get, Router
+from litestar.response import Template, Response, Redirect, Stream, ServerSentEvent, ServerSentEventMessage
+from litestar.exceptions import NotFoundException
+
+from .sendqueue import SendQueue
+
+from .userdata import get_indiclient, get_vectorobj
+
+
+# BLOB formats which a browser can show, and their media types
+IMAGETYPES = {'.jpeg':'image/jpeg',
+              '.jpg':'image/jpeg',
+              '.png':'image/png',
+              '.apng':'image/apng',
+              '.gif':'image/gif',
+              '.webp':'image/webp',
+              '.avif':'image/avif',
+              '.svg':'image/svg+xml',
+              '.jxl':'image/jxl'}
+
+# boundary between the parts of the multipart stream
+BOUNDARY = "indipywebframe"
+
+# frame ids start with this, which changes on every restart, so a cached frame
+# of an earlier run of the server is never taken as the current frame
+EPOCH = token_urlsafe(6)
+
+
+class LiveFrame:
+    "The latest image received by a BLOB member, and the viewers waiting for the next"
+
+    __slots__ = ("payload", "media_type", "serial", "viewers", "_event")
+
+    def __init__(self):
+        self.payload = None
+        self.media_type = None
+        self.serial = 0
+        self.viewers = 0
+        self._event = asyncio.Event()
+
+    @property
+    def frameid(self):
+        return f"{EPOCH}-{self.serial}"
+
+    def update(self, payload, media_type):
+        "Called as each image is received, replacing the frame and waking the viewers"
+        self.payload = payload
+        self.media_type = media_type
+        self.serial += 1
+        self._event.set()
+        self._event.clear()
+
+    async def wait(self, timeout):
+        "Wait, for at most timeout seconds, for a new frame, returns True if one is received"
+        try:
+            await asyncio.wait_for(self._event.wait(), timeout=timeout)
+        except TimeoutError:
+            return False
+        return True
+
+
+# dictionary of member itemid to LiveFrame
+LIVEFRAMES = {}
+
+
+def get_liveframe(memberid):
+    "Returns the LiveFrame of the member, created if not present"
+    liveframe = LIVEFRAMES.get(memberid)
+    if liveframe is None:
+        liveframe = LiveFrame()
+        LIVEFRAMES[memberid] = liveframe
+    return liveframe
+
+
+def clear_liveframes():
+    "Called when the INDI connection is made or lost, as the members are then replaced"
+    LIVEFRAMES.clear()
+
+
+def newframe(memberobj, payload, blobformat):
+    "Called by the client rxevent with each BLOB received, keeps it as the latest frame if it is an image"
+    media_type = IMAGETYPES.get(blobformat.lower())
+    if media_type is None:
+        return
+    get_liveframe(memberobj.itemid).update(payload, media_type)
+
+
+def get_blobmember(vectorid, memberid):
+    "Returns the BLOB member object, or raises NotFoundException"
+    vectorobj = get_vectorobj(vectorid)
+    if vectorobj is None or not vectorobj.enable or vectorobj.vectortype != "BLOBVector":
+        raise NotFoundException()
+    for memberobj in vectorobj.members().values():
+        if memberobj.itemid == memberid:
+            return vectorobj, memberobj
+    raise NotFoundException()
+
+
+async def frameevents(liveframe, memberid, devicename):
+    "Yields an SSE frame event, with the frame id, whenever a new frame is received"
+    iclient = get_indiclient()
+    serial = None
+    liveframe.viewers += 1
+    # while viewed, enableBLOB Also is sent to the device, even if no BLOB folder is set
+    iclient.addblobviewer(devicename)
+    try:
+        while not iclient.stop and liveframe is LIVEFRAMES.get(memberid):
+            if liveframe.payload is not None and liveframe.serial != serial:
+                serial = liveframe.serial
+                yield ServerSentEventMessage(data=liveframe.frameid, event="frame")
+                continue
+            await liveframe.wait(timeout=5.0)
+    finally:
+        liveframe.viewers -= 1
+        iclient.removeblobviewer(devicename)
+
+
+@get("/{vectorid:int}/{memberid:int}", sync_to_thread=False)
+def liveview(vectorid:int, memberid:int) -> Template:
+    "The page showing the latest frame of a BLOB member"
+    vectorobj, memberobj = get_blobmember(vectorid, memberid)
+    liveframe = LIVEFRAMES.get(memberid)
+    frameid = liveframe.frameid if liveframe is not None and liveframe.payload is not None else ""
+    context = {"vectorobj":vectorobj,
+               "memberobj":memberobj,
+               "frameid":frameid}
+    return Template(template_name="live.html", context=context)
+
+
+@get("/events/{vectorid:int}/{memberid:int}", sync_to_thread=False)
+def liveevents(vectorid:int, memberid:int) -> ServerSentEvent:
+    "SSE connection, sending a frame event with the frame id as each frame is received"
+    vectorobj, memberobj = get_blobmember(vectorid, memberid)
+    return ServerSentEvent(SendQueue(frameevents(get_liveframe(memberid), memberid, vectorobj.devicename)).messages())
+
+
+@get("/frame/{vectorid:int}/{memberid:int}/{frameid:str}", sync_to_thread=False)
+def getframe(vectorid:int, memberid:int, frameid:str) -> Response|Redirect:
+    """Returns the frame, if the frame id is not the latest, redirects to the
+       latest frame, as only the latest is held"""
+    get_blobmember(vectorid, memberid)
+    liveframe = LIVEFRAMES.get(memberid)
+    if liveframe is None or liveframe.payload is None:
+        raise NotFoundException()
+    if frameid != liveframe.frameid:
+        return Redirect(liveframe.frameid, headers={"Cache-Control":"no-store"})
+    # the frame id changes with each frame, so the response never changes, and can be cached
+    return Response(content=liveframe.payload, media_type=liveframe.media_type,
+                    headers={"Cache-Control":"private, max-age=31536000, immutable"})
+
+
+async def multipart(liveframe, memberid, devicename):
+    "Yields each part of the multipart stream, always the newest frame once the last is sent"
+    iclient = get_indiclient()
+    serial = None
+    liveframe.viewers += 1
+    # while viewed, enableBLOB Also is sent to the device, even if no BLOB folder is set
+    iclient.addblobviewer(devicename)
+    try:
+        while not iclient.stop and liveframe is LIVEFRAMES.get(memberid):
+            if liveframe.payload is not None and liveframe.serial != serial:
+                serial = liveframe.serial
+                payload = liveframe.payload
+                yield (f"--{BOUNDARY}\r\nContent-Type: {liveframe.media_type}\r\n"
+                       f"Content-Length: {len(payload)}\r\n\r\n").encode()
+                # the payload is sent as it is, rather than copied into a part
+                yield payload
+                yield b"\r\n"
+                continue
+            await liveframe.wait(timeout=5.0)
+    finally:
+        liveframe.viewers -= 1
+        iclient.removeblobviewer(devicename)
+
+
+@get("/mjpeg/{vectorid:int}/{memberid:int}", sync_to_thread=False)
+def livestream(vectorid:int, memberid:int) -> Stream:
+    "Sends each frame as a part of a multipart/x-mixed-replace stream"
+    vectorobj, memberobj = get_blobmember(vectorid, memberid)
+    return Stream(multipart(get_liveframe(memberid), memberid, vectorobj.devicename),
+                  media_type=f"multipart/x-mixed-replace; boundary={BOUNDARY}",
+                  headers={"Cache-Control":"no-store"})
+
+
+live_router = Router(path="/live", route_handlers=[liveview, liveevents, getframe, livestream])
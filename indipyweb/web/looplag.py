@@ -0,0 +1,128 @@
+"""
+Monitors the asyncio event loop for scheduling lag.
+
+The web server and the INDI client share a single event loop, so any blocking
+call (password hashing, sqlite, a large directory listing) stalls everything.
+
+A LoopMonitor coroutine repeatedly sleeps for a short interval and records how
+late it was woken, these lag samples are kept so percentiles can be shown on
+the admin setup page.
+
+Since a blocking call cannot be observed from the loop it is blocking, a
+watchdog thread checks a heartbeat set by the coroutine, and if the heartbeat
+goes stale beyond a threshold, the stack of the event loop thread is captured
+while the block is still in progress, and is logged.
+"""
+
+import asyncio, sys, threading, time, traceback, logging
+
+from collections import deque
+
+from datetime import datetime, timezone
+
+
+logger = logging.getLogger("indipyweb")
+
+
+# seconds between each lag measurement
+INTERVAL = 0.1
+
+# a stall, the loop being blocked for this many seconds, is logged together with the
+# blocking stack. The heartbeat is renewed every INTERVAL, so a stall is a heartbeat
+# older than THRESHOLD + INTERVAL, and the watchdog, checking every INTERVAL, captures
+# the stack while the block is between THRESHOLD and THRESHOLD + INTERVAL seconds long
+THRESHOLD = 0.25
+
+# number of lag samples held, at INTERVAL of 0.1 this is about five minutes
+SAMPLES = 3000
+
+# number of stall reports held for display on the setup page
+REPORTS = 5
+
+
+class LoopMonitor:
+    "Measures event loop lag, and reports the stack of calls blocking the loop"
+
+    def __init__(self, interval=INTERVAL, threshold=THRESHOLD):
+        self.interval = interval
+        self.threshold = threshold
+        # lag samples in seconds, newest on the right
+        self.lags = deque(maxlen=SAMPLES)
+        # stall reports of (timestamp, blocked seconds, task name, stack text), newest first
+        self.reports = deque(maxlen=REPORTS)
+        self.heartbeat = time.monotonic()
+        self._loop = None
+        self._threadid = None
+        self._stop = False
+        self._watchdog = None
+
+
+    async def run(self):
+        "Await this to run the monitor, it ends when stop() is called"
+        self._stop = False
+        self._loop = asyncio.get_running_loop()
+        self._threadid = threading.get_ident()
+        self.heartbeat = time.monotonic()
+        self._watchdog = threading.Thread(target=self._watch, name="indipyweb-looplag", daemon=True)
+        self._watchdog.start()
+        try:
+            while not self._stop:
+                start = time.monotonic()
+                await asyncio.sleep(self.interval)
+                now = time.monotonic()
+                self.heartbeat = now
+                self.lags.append(max(0.0, now - start - self.interval))
+        finally:
+            self._stop = True
+
+
+    def stop(self):
+        "Stops the monitor coroutine and the watchdog thread"
+        self._stop = True
+
+
+    def _watch(self):
+        "Runs in the watchdog thread, captures the loop thread stack whenever the heartbeat goes stale"
+        # stalled is set to the heartbeat value of a stall already reported
+        stalled = None
+        while not self._stop:
+            time.sleep(self.interval)
+            heartbeat = self.heartbeat
+            # the heartbeat is up to interval old while the loop runs freely,
+            # so the time blocked is at least its age less the interval
+            blocked = time.monotonic() - heartbeat - self.interval
+            if blocked < self.threshold:
+                continue
+            if stalled == heartbeat:
+                # this stall has already been reported
+                continue
+            stalled = heartbeat
+            frame = sys._current_frames().get(self._threadid)
+            if frame is None:
+                continue
+            stack = "".join(traceback.format_stack(frame))
+            taskname = ""
+            try:
+                task = asyncio.current_task(self._loop)
+            except RuntimeError:
+                task = None
+            if task is not None:
+                taskname = f"{task.get_name()} {task.get_coro()!r}"
+            self.reports.appendleft((datetime.now(tz=timezone.utc), blocked, taskname, stack))
+            logger.warning(f"Event loop blocked for at least {blocked:.3f} seconds, in task {taskname}\n{stack}")
+
+
+    def percentiles(self):
+        """Returns a dictionary of lag statistics in milliseconds,
+           with keys count, p50, p90, p99 and max"""
+        lags = sorted(self.lags)
+        number = len(lags)
+        if not number:
+            return {"count":0, "p50":0.0, "p90":0.0, "p99":0.0, "max":0.0}
+        def pc(p):
+            return lags[min(number-1, int(p * number / 100))] * 1000
+        return {"count":number,
+                "p50":pc(50),
+                "p90":pc(90),
+                "p99":pc(99),
+                "max":lags[-1] * 1000}
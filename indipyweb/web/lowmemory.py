@@ -0,0 +1,42 @@
+"""
+The low memory profile, for small boards running beside the INDI server.
+
+Set with the --lowmemory option, or make_app(lowmemory=True), this lowers
+the limits of the buffers which otherwise grow to a fixed, but generous,
+size. It is applied before the client and app are created, as several of
+these limits are read as their objects are made.
+
+Each entry of LIMITS is (module name, attribute, low memory value):
+
+  sendqueue.QUEUESIZE          events waiting on each SSE connection
+  sendqueue.MAXCONNECTIONS     concurrent SSE connections, further browsers are asked to retry later
+  userdata.REPLAYSIZE          notifications held per device, for reconnecting SSE connections
+  messagelog.RECENTLINES       recent message lines held per device for the live panels
+  messagelog.BATCHSIZE         messages gathered before a batch write to the message log
+  looplag.SAMPLES              event loop lag samples held
+  blobstore.WRITERS            BLOB writer threads
+  blobstore.MAXINFLIGHT        received BLOBs waiting to be written
+  app.TEMPLATECACHESIZE        compiled templates held, the least recently used are discarded
+  publiccache.PUBLICCACHESIZE  pages and fragments shared by anonymous viewers, with the --public option
+"""
+
+import importlib
+
+
+LIMITS = [("sendqueue", "QUEUESIZE", 16),
+          ("sendqueue", "MAXCONNECTIONS", 16),
+          ("userdata", "REPLAYSIZE", 32),
+          ("messagelog", "RECENTLINES", 10),
+          ("messagelog", "BATCHSIZE", 100),
+          ("looplag", "SAMPLES", 300),
+          ("blobstore", "WRITERS", 1),
+          ("blobstore", "MAXINFLIGHT", 1),
+          ("app", "TEMPLATECACHESIZE", 16),
+          ("publiccache", "PUBLICCACHESIZE", 32)]
+
+
+def apply():
+    "Sets each limit of the low memory profile"
+    for modulename, attribute, value in LIMITS:
+        module = importlib.import_module(f".{modulename}", __package__)
+        setattr(module, attribute, value)
@@ -0,0 +1,277 @@
+"""
+Keeps a persistent, searchable log of system and device messages.
+
+The INDI client only holds the last eight messages of the system and of
+each device, so every message received is also appended to an sqlite
+database, indipyweb_messages.sqlite, in the database folder. This is kept
+apart from the user database, so it is not copied by the admin backup.
+
+Messages are gathered in memory and written in batches by a single writer
+thread, so the event loop never waits on the disk. Recent lines of each
+device are also held in memory, each with its database id, so the live
+panels on the landing and device pages only request the lines newer than
+the last they were given, and append them.
+
+Routes beneath /messages show the log a page at a time, with full text
+search if the sqlite build includes FTS5, otherwise a simple LIKE match.
+"""
+
+import asyncio, sqlite3
+
+from concurrent.futures import ThreadPoolExecutor
+
+from collections import deque
+
+from datetime import datetime, timezone
+
+from litestar import get, Request, Router
+from litestar.plugins.htmx import HTMXTemplate
+from litestar.response import Template
+from litestar.datastructures import State
+
+from .userdata import getconfig, localtimestring
+
+
+# file name of the message log, created in the database folder. This must not end
+# in '.db', as app.getbackup() serves such files as backups of the user database
+MESSAGELOGNAME = "indipyweb_messages.sqlite"
+
+# seconds between each batch of writes
+BATCHINTERVAL = 1.0
+
+# a batch is written early if this number of messages are waiting
+BATCHSIZE = 500
+
+# number of recent lines held in memory for each device, and for the system messages
+RECENTLINES = 50
+
+# number of lines in each page of the message log view
+PAGELINES = 50
+
+
+class MessageLog:
+    """Appends messages to the sqlite message log. The connection is only used by
+       the single thread of self.executor, so reads and writes never overlap"""
+
+    def __init__(self, path):
+        self.path = path
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="messagelog")
+        self.fts = False
+        self._con = None
+        # list of rows awaiting the next batch write
+        self._pending = []
+        self._wake = asyncio.Event()
+        self._stop = False
+        # dictionary of devicename, '' for system messages, to a deque of (id, timestamp, message)
+        self.recent = {}
+        # the id given to the last message, ids are assigned here, so are known before
+        # the row is written, and are used by the live panels to request newer lines
+        self.lastid = self.executor.submit(self._open).result()
+
+
+    def _open(self):
+        "Create the database if it does not exist, and return the last message id"
+        self._con = sqlite3.connect(self.path)
+        with self._con:
+            self._con.execute("CREATE TABLE IF NOT EXISTS messages(id INTEGER PRIMARY KEY, timestamp REAL NOT NULL, devicename TEXT NOT NULL, message TEXT NOT NULL)")
+            self._con.execute("CREATE INDEX IF NOT EXISTS messages_timestamp ON messages(timestamp)")
+            self._con.execute("CREATE INDEX IF NOT EXISTS messages_device ON messages(devicename, timestamp)")
+        try:
+            with self._con:
+                # an external content table, indexing the message column, kept up to date by a trigger
+                self._con.execute("CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(message, content='messages', content_rowid='id')")
+                self._con.execute("""CREATE TRIGGER IF NOT EXISTS messages_ai AFTER INSERT ON messages BEGIN
+                                        INSERT INTO messages_fts(rowid, message) VALUES (new.id, new.message);
+                                     END""")
+            self.fts = True
+        except sqlite3.OperationalError:
+            # this sqlite build does not include FTS5, searches will use LIKE
+            self.fts = False
+        lastid = self._con.execute("SELECT max(id) FROM messages").fetchone()[0]
+        return lastid or 0
+
+
+    def add(self, timestamp, devicename, message, system=False):
+        """Called from the client rxevent with each message received, devicename is None
+           for a system message. If system is True a device message is also shown with
+           the system messages, as is done when a whole device is deleted"""
+        devicename = devicename or ""
+        self.lastid += 1
+        line = (self.lastid, timestamp, message)
+        self.recent.setdefault(devicename, deque(maxlen=RECENTLINES)).append(line)
+        if system and devicename:
+            self.recent.setdefault("", deque(maxlen=RECENTLINES)).append(line)
+        self._pending.append((self.lastid, timestamp.timestamp(), devicename, message))
+        if len(self._pending) >= BATCHSIZE:
+            self._wake.set()
+
+
+    def newlines(self, devicename, after=0, limit=RECENTLINES):
+        """Returns a list of up to limit (id, timestamp, message), oldest first, of the
+           recent lines of the device ('' for system messages) with an id greater than after"""
+        recent = self.recent.get(devicename or "")
+        if not recent:
+            return []
+        lines = [line for line in recent if line[0] > after]
+        return lines[-limit:]
+
+
+    def _take(self):
+        "Return the rows awaiting a write, and start a new list"
+        rows = self._pending
+        self._pending = []
+        self._wake.clear()
+        return rows
+
+
+    def _write(self, rows):
+        "Called in the writer thread, appends the rows in a single transaction"
+        if rows:
+            with self._con:
+                self._con.executemany("INSERT INTO messages VALUES(?, ?, ?, ?)", rows)
+
+
+    async def run(self):
+        "Await this to write batches of messages, it ends when close() is called"
+        loop = asyncio.get_running_loop()
+        while not self._stop:
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout=BATCHINTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            rows = self._take()
+            if rows:
+                await loop.run_in_executor(self.executor, self._write, rows)
+
+
+    async def close(self):
+        "Write any remaining messages, and close the database"
+        self._stop = True
+        self._wake.set()
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self.executor, self._write, self._take())
+        await loop.run_in_executor(self.executor, self._con.close)
+        self.executor.shutdown(wait=False)
+
+
+    def _query(self, rows, devicename, search, before, after, limit):
+        """Called in the writer thread, first writes any waiting rows so they can be found,
+           then returns a list of (id, timestamp, devicename, message), newest first"""
+        self._write(rows)
+        conditions = []
+        parameters = []
+        if devicename is not None:
+            conditions.append("m.devicename = ?")
+            parameters.append(devicename)
+        if search:
+            if self.fts:
+                # each word is quoted, so punctuation is not taken as FTS5 query syntax
+                words = " ".join('"' + word.replace('"', '""') + '"' for word in search.split())
+                conditions.append("m.id IN (SELECT rowid FROM messages_fts WHERE messages_fts MATCH ?)")
+                parameters.append(words)
+            else:
+                conditions.append("m.message LIKE ?")
+                parameters.append(f"%{search}%")
+        if before:
+            conditions.append("m.id < ?")
+            parameters.append(before)
+        if after:
+            conditions.append("m.id > ?")
+            parameters.append(after)
+        where = ("WHERE " + " AND ".join(conditions)) if conditions else ""
+        # when paging forward from after, take the oldest lines first, then reverse them
+        order = "ASC" if after and not before else "DESC"
+        sql = f"SELECT m.id, m.timestamp, m.devicename, m.message FROM messages AS m {where} ORDER BY m.id {order} LIMIT ?"
+        parameters.append(limit)
+        try:
+            result = self._con.execute(sql, parameters).fetchall()
+        except sqlite3.OperationalError:
+            # an unparseable search
+            result = []
+        if order == "ASC":
+            result.reverse()
+        return result
+
+
+    def _devicenames(self):
+        "Called in the writer thread, returns a sorted list of the devicenames in the log"
+        return [row[0] for row in self._con.execute("SELECT DISTINCT devicename FROM messages WHERE devicename != '' ORDER BY devicename")]
+
+
+    async def query(self, devicename=None, search="", before=0, after=0, limit=PAGELINES):
+        """Returns a list of up to limit (id, timestamp, devicename, message), newest first.
+           devicename None gives all messages, '' gives system messages only, search is
+           a set of words which must all be present. before and after are message ids
+           used to page back and forward from the lines currently shown"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, self._query, self._take(),
+                                          devicename, search, before, after, limit)
+
+
+    async def devicenames(self):
+        "Returns a sorted list of the devicenames which have logged messages"
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, self._devicenames)
+
+
+def get_messagelog():
+    return getconfig("messagelog")
+
+
+def logtimestring(t):
+    "Return a string of the local date and time of a log timestamp, in seconds since the epoch"
+    localtime = datetime.fromtimestamp(t, tz=timezone.utc).astimezone(tz=None)
+    return f"{localtime.strftime('%Y-%m-%d')} {localtimestring(localtime)}"
+
+
+def livelines(devicename, after, limit):
+    """Returns a list of (id, text) of the messages of the device newer than after,
+       for the live message panels"""
+    messagelog = get_messagelog()
+    return [(lineid, localtimestring(timestamp) + "  " + message)
+            for lineid, timestamp, message in messagelog.newlines(devicename, after, limit)]
+
+
+async def logcontext(device, search, before, after):
+    "Returns the context for the messageresults.html template"
+    messagelog = get_messagelog()
+    search = search.strip()
+    # the device selector gives '*' for all messages, and '' for system messages
+    devicename = None if device == "*" else device
+    lines = await messagelog.query(devicename, search, before, after)
+    if after and len(lines) < PAGELINES:
+        # paging forward has reached the newest lines, so show a full page of those
+        after = 0
+        lines = await messagelog.query(devicename, search)
+    messages = [(lineid, logtimestring(timestamp), devicename, message)
+                for lineid, timestamp, devicename, message in lines]
+    # ids to page from, older lines continue from the last shown, newer from the first
+    older = messages[-1][0] if len(messages) == PAGELINES else 0
+    newer = messages[0][0] if messages and (before or after) else 0
+    return {"messages":messages,
+            "device":device,
+            "search":search,
+            "older":older,
+            "newer":newer,
+            "fts":messagelog.fts}
+
+
+@get("/", exclude_from_auth=True)
+async def messagepage(request: Request[str, str, State], device:str="*", search:str="") -> Template:
+    "The message log page, with a search form, showing the newest messages"
+    devicenames = await get_messagelog().devicenames()
+    if device not in ("*", "") and device not in devicenames:
+        devicenames.append(device)
+    context = await logcontext(device, search, 0, 0)
+    context["devicenames"] = devicenames
+    return Template(template_name="messagelog.html", context=context)
+
+
+@get("/results", exclude_from_auth=True)
+async def messageresults(device:str="*", search:str="", before:int=0, after:int=0) -> Template:
+    "Returns a page of the message log, older than before, or newer than after"
+    context = await logcontext(device, search, before, after)
+    return HTMXTemplate(template_name="messageresults.html", context=context)
+
+
+messages_router = Router(path="/messages", route_handlers=[messagepage, messageresults])
@@ -0,0 +1,97 @@
+"""
+Shares the device pages and fragments shown to viewers who are not logged in.
+
+Set with the --public option, or make_app(public=True), for sites with many
+anonymous viewers. Viewers who are not logged in cannot change a vector, so
+each is shown the same device page, group tabs and vector updates. These are
+rendered once per state version of the device, and the rendered bytes held
+and sent to every such viewer, so the number of viewers does not set the
+number of renders.
+
+The state version of a device is the id of its latest change notification,
+which changes whenever a vector of the device is defined, deleted or updated.
+
+Each response carries an ETag, with Cache-Control 'no-cache', so a browser
+asking again for an unchanged page or fragment is answered with a 304 Not
+Modified and no body. The shared responses are marked public, varying by
+Cookie, so a caching proxy may also hold them for anonymous viewers, but
+never gives them to a logged in user.
+
+Anonymous device pages are not given a page subscription, see device.py, as
+these are per page, so their SSE connections send events for every vector of
+the device, and every viewer then asks for the same vector updates.
+"""
+
+import hashlib
+
+from collections import OrderedDict
+
+from litestar import MediaType
+from litestar.response import Response
+
+from .userdata import getconfig, get_device_event
+
+
+# number of rendered pages and fragments held, the least recently used are discarded
+PUBLICCACHESIZE = 256
+
+
+class PublicPage:
+    "A rendered page or fragment, and the state version it was rendered from"
+
+    __slots__ = ("version", "body", "etag", "headers")
+
+    def __init__(self, version, body, headers):
+        self.version = version
+        self.body = body
+        self.etag = '"' + hashlib.sha256(body).hexdigest()[:16] + '"'
+        # htmx response headers, such as HX-Retarget
+        self.headers = headers
+
+
+# dictionary of key to PublicPage, least recently used first
+PUBLICPAGES = OrderedDict()
+
+
+def clear_publiccache():
+    "Called when the INDI connection is made or lost, as the pages held are then out of date"
+    PUBLICPAGES.clear()
+
+
+def ispublic(loggedin):
+    "Returns True if the response to this viewer is shared"
+    return not loggedin and getconfig("public")
+
+
+def deviceversion(devicename):
+    "Returns the state version of the device, changed with every notification of a change to it"
+    device_event = get_device_event(devicename)
+    return device_event.eventid(device_event.serial)
+
+
+def publicresponse(request, key, version, render, headers=None):
+    """Returns a Response of the shared page or fragment held under key. render() is only
+       called, returning the rendered string, if the page held is not of the given state
+       version. headers are any htmx headers of the response"""
+    page = PUBLICPAGES.get(key)
+    if page is None or page.version != version:
+        page = PublicPage(version, render().encode(), headers or {})
+        PUBLICPAGES[key] = page
+        while len(PUBLICPAGES) > PUBLICCACHESIZE:
+            PUBLICPAGES.popitem(last=False)
+    else:
+        PUBLICPAGES.move_to_end(key)
+    return sharedresponse(request, page)
+
+
+def rendertemplate(request, template_name, context):
+    "Returns the template rendered with the context"
+    return request.app.template_engine.get_template(template_name).render(**context)
+
+
+def sharedresponse(request, page):
+    "Returns the Response of the page, or 304 Not Modified if the browser holds it"
+    headers = {**page.headers, "ETag": page.etag, "Cache-Control": "public, no-cache", "Vary": "Cookie"}
+    if request.headers.get("if-none-match") == page.etag:
+        return Response(content=b"", status_code=304, headers=headers)
+    return Response(content=page.body, media_type=MediaType.HTML, headers=headers)
@@ -0,0 +1,132 @@
+"""
+Provides SendQueue, a bounded outgoing queue for each SSE connection.
+
+The iterators which create SSE events (DeviceEvent, LandingPageChange and
+TableChange) are run by a producer task, which places the events into a
+queue read by the connection. As most events carry no data other than their
+name, a duplicate of an event already waiting in the queue is collapsed
+into the waiting one. The vectors event of a device does carry a list of
+vector ids, so the source merges the two lists.
+
+The queue is bounded, and if a browser falls behind, so the queue cannot be
+emptied for longer than a limit, the connection is ended. The browser
+will then reconnect, and start again with a fresh state, so one slow
+viewer cannot grow server memory or hold back events for others.
+
+If MAXCONNECTIONS is set, a connection beyond that number is sent only a
+retry interval, and closed, so the browser tries again later.
+"""
+
+import asyncio, time
+
+from asyncio.exceptions import TimeoutError
+
+from collections import OrderedDict
+
+from litestar.response import ServerSentEventMessage
+
+
+# maximum number of distinct events waiting to be sent on a connection
+QUEUESIZE = 64
+
+# seconds a connection may be unable to empty its queue before being ended
+MAXBEHIND = 30.0
+
+# maximum number of concurrent SSE connections, zero for no limit
+MAXCONNECTIONS = 0
+
+# milliseconds a browser refused a connection waits before reconnecting
+RETRYLATER = 15000
+
+
+class SendQueue:
+    "Runs an SSE event source into a bounded queue which collapses duplicate events"
+
+    __slots__ = ("source", "maxsize", "maxbehind", "pending", "behind", "slow", "dropped", "_ready", "_space")
+
+    # number of connections currently sending messages
+    connections = 0
+
+    def __init__(self, source, maxsize=None, maxbehind=MAXBEHIND):
+        self.source = source                  # async iterator of ServerSentEventMessage objects
+        self.maxsize = maxsize or QUEUESIZE
+        self.maxbehind = maxbehind
+        self.pending = OrderedDict()          # event name : ServerSentEventMessage, oldest first
+        self.behind = None                    # monotonic time since the queue was last empty
+        self.slow = False                     # set True if the connection is to be ended
+        self.dropped = 0                      # number of duplicate events collapsed
+        self._ready = asyncio.Event()         # set when an event is added to the queue
+        self._space = asyncio.Event()         # set when an event is taken from the queue
+
+
+    def _isbehind(self):
+        "Returns True if the queue has not been emptied for longer than maxbehind"
+        return (self.behind is not None) and (time.monotonic() - self.behind > self.maxbehind)
+
+
+    async def _produce(self):
+        "Read events from the source, and place them into the queue"
+        merge = getattr(self.source, "merge", None)
+        try:
+            async for message in self.source:
+                if self._isbehind():
+                    self.slow = True
+                    return
+                if message.event in self.pending:
+                    # collapse this duplicate into the one already waiting to be sent,
+                    # a source with a merge method combines the data of the two messages
+                    if merge is not None:
+                        message = merge(self.pending[message.event], message)
+                    self.pending[message.event] = message
+                    self.dropped += 1
+                    continue
+                while len(self.pending) >= self.maxsize:
+                    # the queue is full, wait for the connection to take an event
+                    self._space.clear()
+                    try:
+                        await asyncio.wait_for(self._space.wait(), timeout=self.maxbehind)
+                    except TimeoutError:
+                        pass
+                    if self._isbehind():
+                        self.slow = True
+                        return
+                if self.behind is None:
+                    self.behind = time.monotonic()
+                self.pending[message.event] = message
+                self._ready.set()
+        finally:
+            # ensure the reader is woken when the producer ends
+            self._ready.set()
+
+
+    async def messages(self):
+        """An async generator of the queued messages, to be given to a ServerSentEvent response.
+           When the connection is closed, the generator is closed and the producer cancelled"""
+        if MAXCONNECTIONS and SendQueue.connections >= MAXCONNECTIONS:
+            # too many connections, the browser is asked to reconnect later
+            yield ServerSentEventMessage(data=None, comment="too many connections", retry=RETRYLATER)
+            return
+        SendQueue.connections += 1
+        producer = asyncio.create_task(self._produce())
+        try:
+            while True:
+                if self.slow:
+                    # the browser has fallen too far behind, end the connection
+                    return
+                if not self.pending:
+                    if producer.done():
+                        # the source has ended, or the connection is too slow,
+                        # calling result() raises any exception from the source
+                        producer.result()
+                        return
+                    self._ready.clear()
+                    await self._ready.wait()
+                    continue
+                eventname, message = self.pending.popitem(last=False)
+                if not self.pending:
+                    self.behind = None
+                self._space.set()
+                yield message
+        finally:
+            SendQueue.connections -= 1
+            producer.cancel()
@@ -0,0 +1,334 @@
+"""
+Handles all routes beneath /sequences, which store and run sequences of vector operations.
+
+A sequence is a list of steps, held in the user database as JSON, such as
+
+[{"device": "Telescope", "vector": "EQUATORIAL_EOD_COORD", "members": {"RA": 5.5, "DEC": 22}},
+ {"device": "Telescope", "vector": "EQUATORIAL_EOD_COORD", "state": "Ok", "timeout": 120},
+ {"pause": 2},
+ {"device": "CCD", "vector": "CCD_EXPOSURE", "members": {"CCD_EXPOSURE_VALUE": 30}, "state": "Ok"}]
+
+A step with members sets the vector, the members being checked as they are for
+the JSON api. A step with a state waits, for at most timeout seconds (default
+STEPTIMEOUT), until the vector has that state, and fails if the vector instead
+becomes Alert. A step may have both, setting the vector then waiting. A pause
+step waits for a number of seconds.
+
+Each run is an asyncio task within the server, which waits on the device
+notifications, so the next step starts as soon as the INDI service responds,
+without a browser or script in the loop. Progress is recorded as lines in a
+SequenceRun, and an SSE connection tells the sequence page of each new line.
+
+Any logged in user may run or stop a sequence, administrators may also create,
+edit and delete them. A run is stopped if the INDI connection is lost.
+"""
+
+import asyncio, json
+
+from asyncio.exceptions import TimeoutError
+
+from litestar import get, post, Request, Router
+from litestar.plugins.htmx import HTMXTemplate, ClientRedirect
+from litestar.response import Template, ServerSentEvent, ServerSentEventMessage
+from litestar.datastructures import State
+from litestar.exceptions import HTTPException, NotAuthorizedException, NotFoundException
+
+from . import userdata
+from .api import get_apivector, apimembers
+from .sendqueue import SendQueue
+
+
+# default seconds a step may wait for a vector state
+STEPTIMEOUT = 60.0
+
+# vector states a step may wait for
+STATES = ('Idle', 'Ok', 'Busy', 'Alert')
+
+
+def parsesteps(text):
+    """Parses the JSON text of a sequence, returns a list of step dictionaries,
+       or raises ValueError with a message giving the fault"""
+    try:
+        steps = json.loads(text)
+    except json.JSONDecodeError as e:
+        raise ValueError(f"Invalid JSON: {e}")
+    if not isinstance(steps, list) or not steps:
+        raise ValueError("The sequence should be a list of steps")
+    for number, step in enumerate(steps, start=1):
+        if not isinstance(step, dict):
+            raise ValueError(f"Step {number} should be an object")
+        if "pause" in step:
+            if not isinstance(step["pause"], (int, float)) or step["pause"] < 0:
+                raise ValueError(f"Step {number} pause should be a number of seconds")
+            continue
+        if not isinstance(step.get("device"), str) or not isinstance(step.get("vector"), str):
+            raise ValueError(f"Step {number} requires a device and a vector")
+        if "members" not in step and "state" not in step:
+            raise ValueError(f"Step {number} requires members to set, or a state to wait for")
+        if "members" in step and (not isinstance(step["members"], dict) or not step["members"]):
+            raise ValueError(f"Step {number} members should be an object of member names to values")
+        if "state" in step and step["state"] not in STATES:
+            raise ValueError(f"Step {number} state should be one of Idle, Ok, Busy or Alert")
+        if "timeout" in step and (not isinstance(step["timeout"], (int, float)) or step["timeout"] <= 0):
+            raise ValueError(f"Step {number} timeout should be a number of seconds")
+    return steps
+
+
+def describe(step):
+    "Returns a line of text describing the step"
+    if "pause" in step:
+        return f"Pause for {step['pause']} seconds"
+    text = f"{step['device']} : {step['vector']}"
+    if "members" in step:
+        values = ", ".join(f"{name}={value}" for name, value in step["members"].items())
+        text = f"Set {text} : {values}"
+        if "state" in step:
+            text += f", and wait for {step['state']}"
+        return text
+    return f"Wait for {text} to be {step['state']}"
+
+
+class StepFailed(Exception):
+    "Raised when a step cannot be completed, stopping the run"
+
+
+class SequenceRun:
+    "A run of a stored sequence, which is kept once finished so its progress can be shown"
+
+    __slots__ = ("name", "steps", "user", "step", "status", "lines", "task", "stopreason")
+
+    def __init__(self, name, steps, user):
+        self.name = name
+        self.steps = steps
+        self.user = user
+        # the number of the step being run, starting at 1
+        self.step = 0
+        # one of Running, Completed, Failed, Stopped
+        self.status = "Running"
+        # list of (timestring, text) progress lines
+        self.lines = []
+        self.task = None
+        self.stopreason = ""
+
+    @property
+    def running(self):
+        return self.status == "Running"
+
+    def log(self, text):
+        "Adds a progress line, and tells the sequence pages"
+        self.lines.append((userdata.localtimestring(), text))
+        notify()
+
+    async def dostep(self, iclient, step):
+        "Runs a single step, raises StepFailed if it cannot be completed"
+        if "pause" in step:
+            await asyncio.sleep(step["pause"])
+            return
+        if not iclient.connected:
+            raise StepFailed("Not connected to the INDI service")
+        try:
+            # a vector not found, or stale, not yet defined by the INDI service, fails the step
+            vectorobj = get_apivector(step["device"], step["vector"])
+            if "members" in step:
+                if vectorobj.perm == "ro":
+                    raise StepFailed("This is a Read Only vector")
+                members = apimembers(vectorobj, step["members"])
+                # this sets the vector state to Busy, until the driver responds
+                await iclient.send_newVector(vectorobj.devicename, vectorobj.name, members=members)
+        except HTTPException as e:
+            raise StepFailed(e.detail)
+        if "state" not in step:
+            return
+        state = step["state"]
+        timeout = step.get("timeout", STEPTIMEOUT)
+        # an Alert ends the wait, unless Alert is the state awaited
+        if not await userdata.waitfor(vectorobj, lambda v: v.state in (state, "Alert") or not v.enable, timeout):
+            raise StepFailed(f"Timed out after {timeout} seconds, the vector is {vectorobj.state}")
+        if not vectorobj.enable:
+            raise StepFailed("The vector has been deleted")
+        if vectorobj.state != state:
+            raise StepFailed(f"The vector is {vectorobj.state}")
+
+    async def run(self, iclient):
+        "Runs each step in turn, recording progress"
+        self.log(f"Started by {self.user}")
+        try:
+            for number, step in enumerate(self.steps, start=1):
+                self.step = number
+                self.log(f"Step {number}: {describe(step)}")
+                await self.dostep(iclient, step)
+        except StepFailed as e:
+            self.status = "Failed"
+            self.log(f"Step {self.step} failed: {e}")
+        except asyncio.CancelledError:
+            self.status = "Stopped"
+            self.log(self.stopreason or "Stopped")
+        except Exception as e:
+            self.status = "Failed"
+            self.log(f"Step {self.step} failed: {e}")
+        else:
+            self.status = "Completed"
+            self.log("Completed")
+        finally:
+            self.task = None
+
+    def stop(self, reason):
+        "Cancels the run"
+        if self.task is not None:
+            self.stopreason = reason
+            self.task.cancel()
+
+
+# dictionary of sequence name to its latest SequenceRun
+SEQUENCERUNS = {}
+
+# set and cleared on every progress line, waking the SSE connections of the sequence pages
+PROGRESS_EVENT = asyncio.Event()
+
+
+def notify():
+    PROGRESS_EVENT.set()
+    PROGRESS_EVENT.clear()
+
+
+def stop_sequences(reason):
+    "Called when the INDI connection is made or lost, stopping every run"
+    for sequencerun in SEQUENCERUNS.values():
+        sequencerun.stop(reason)
+
+
+def getsteps(name):
+    "Returns the stored JSON text of the sequence, or raises NotFoundException"
+    text = userdata.getsequence(name)
+    if text is None:
+        raise NotFoundException()
+    return text
+
+
+async def progressevents(name):
+    "Yields an SSE progress event whenever the run of the sequence records a line"
+    iclient = userdata.get_indiclient()
+    last = None
+    while not iclient.stop:
+        sequencerun = SEQUENCERUNS.get(name)
+        current = (id(sequencerun), len(sequencerun.lines)) if sequencerun is not None else None
+        if current != last:
+            last = current
+            yield ServerSentEventMessage(event="progress")
+            continue
+        try:
+            await asyncio.wait_for(PROGRESS_EVENT.wait(), timeout=5.0)
+        except TimeoutError:
+            pass
+
+
+@get("/", sync_to_thread=False)
+def sequences(request: Request[str, str, State]) -> Template:
+    "The page listing the stored sequences"
+    names = userdata.sequencenames()
+    statuses = {name:SEQUENCERUNS[name].status for name in names if name in SEQUENCERUNS}
+    context = {"names":names,
+               "statuses":statuses,
+               "admin":request.auth == "admin"}
+    return Template(template_name="sequences/sequences.html", context=context)
+
+
+@get("/show/{name:str}", sync_to_thread=False)
+def sequence(name:str, request: Request[str, str, State]) -> Template:
+    "The page showing a sequence and the progress of its latest run"
+    text = getsteps(name)
+    try:
+        steps = [describe(step) for step in parsesteps(text)]
+    except ValueError as e:
+        steps = [str(e)]
+    context = {"name":name,
+               "text":text,
+               "steps":steps,
+               "sequencerun":SEQUENCERUNS.get(name),
+               "admin":request.auth == "admin"}
+    return Template(template_name="sequences/sequence.html", context=context)
+
+
+@get("/progress/{name:str}", sync_to_thread=False)
+def progress(name:str) -> Template:
+    "Returns the progress of the latest run of the sequence"
+    getsteps(name)
+    return HTMXTemplate(template_name="sequences/progress.html",
+                        context={"name":name, "sequencerun":SEQUENCERUNS.get(name)})
+
+
+@get("/events/{name:str}", sync_to_thread=False)
+def events(name:str) -> ServerSentEvent:
+    "SSE connection, sending a progress event as each progress line is recorded"
+    getsteps(name)
+    return ServerSentEvent(SendQueue(progressevents(name)).messages())
+
+
+@post("/run/{name:str}")
+async def runsequence(name:str, request: Request[str, str, State]) -> Template:
+    "Starts a run of the sequence, if it is not already running"
+    try:
+        steps = parsesteps(getsteps(name))
+    except ValueError as e:
+        return HTMXTemplate(None, template_str="<p id=\"sequenceconfirm\" class=\"vanish\" style=\"color:red\">${error|h}</p>",
+                            re_target="#sequenceconfirm", context={"error":str(e)})
+    sequencerun = SEQUENCERUNS.get(name)
+    if sequencerun is None or not sequencerun.running:
+        sequencerun = SequenceRun(name, steps, request.user)
+        SEQUENCERUNS[name] = sequencerun
+        sequencerun.task = asyncio.create_task(sequencerun.run(userdata.get_indiclient()))
+    return HTMXTemplate(template_name="sequences/progress.html",
+                        context={"name":name, "sequencerun":sequencerun})
+
+
+@post("/stop/{name:str}")
+async def stopsequence(name:str, request: Request[str, str, State]) -> Template:
+    "Stops the run of the sequence"
+    getsteps(name)
+    sequencerun = SEQUENCERUNS.get(name)
+    if sequencerun is not None and sequencerun.running:
+        # the task records the stop, which is then shown by the progress event
+        sequencerun.stop(f"Stopped by {request.user}")
+    return HTMXTemplate(template_name="sequences/progress.html",
+                        context={"name":name, "sequencerun":sequencerun})
+
+
+@post("/save")
+async def savesequence(request: Request[str, str, State]) -> Template|ClientRedirect:
+    "An admin is creating or editing a sequence"
+    if request.auth != "admin":
+        raise NotAuthorizedException()
+    form_data = await request.form()
+    name = form_data.get("name", "").strip()
+    text = form_data.get("steps", "")
+    try:
+        parsesteps(text)
+    except ValueError as e:
+        error = str(e)
+    else:
+        error = userdata.setsequence(name, text)
+    if error:
+        return HTMXTemplate(None, template_str="<p id=\"sequenceconfirm\" class=\"vanish\" style=\"color:red\">${error|h}</p>",
+                            context={"error":error})
+    # the form is posted from both the list and the sequence page, so the redirect path is absolute
+    basepath = userdata.getconfig("basepath")
+    if basepath:
+        return ClientRedirect(basepath + f"sequences/show/{name}")
+    return ClientRedirect(f"/sequences/show/{name}")
+
+
+@post("/delete/{name:str}")
+async def deletesequence(name:str, request: Request[str, str, State]) -> ClientRedirect:
+    "An admin is deleting a sequence"
+    if request.auth != "admin":
+        raise NotAuthorizedException()
+    sequencerun = SEQUENCERUNS.pop(name, None)
+    if sequencerun is not None:
+        sequencerun.stop(f"Deleted by {request.user}")
+    userdata.delsequence(name)
+    return ClientRedirect("../")
+
+
+sequences_router = Router(path="/sequences", route_handlers=[sequences, sequence, progress, events,
+                                                              runsequence, stopsequence,
+                                                              savesequence, deletesequence])
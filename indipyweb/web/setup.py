@@ -47,7 +47,10 @@ def setup(request: Request[str, str, State]) -> Template:
                "currentindiport":userdata.getconfig("indiport"),
                "storedindiport":userdata.get_stored_item('indiport'),
                "currentblobfolder":currentblobfolder,
-               "storedblobfolder":storedblobfolder
+               "storedblobfolder":storedblobfolder,
+               "blobmaxsize":userdata.getconfig("blobmaxsize") or 0,
+               "blobmaxage":userdata.getconfig("blobmaxage") or 0,
+               "blobkeeplast":userdata.getconfig("blobkeeplast") or 0
               }
     return Template(template_name="setup/setuppage.html", context=context)
 
@@ -67,6 +70,20 @@ def backupdb(request: Request[str, str, State]) -> Template|Redirect:
 
 
 
+@get("/looplag", sync_to_thread=False)
+def looplag(request: Request[str, str, State]) -> Template|Redirect:
+    """Shows event loop lag percentiles, and any recent reports of calls blocking the loop"""
+    if request.auth != "admin":
+        return logout(request)
+    monitor = userdata.getconfig("loopmonitor")
+    reports = list((userdata.localtimestring(t), f"{duration:.3f}", taskname, stack) for t, duration, taskname, stack in monitor.reports)
+    context = {"lags":monitor.percentiles(),
+               "threshold":monitor.threshold,
+               "reports":reports}
+    return HTMXTemplate(template_name="setup/looplag.html", context=context)
+
+
+
 @post("/webhost")
 async def webhost(request: Request[str, str, State]) -> Template:
     "An admin is setting the webhost"
@@ -155,11 +172,37 @@ async def blobfolder(request: Request[str, str, State]) -> Template:
 
 
 
+@post("/blobretention")
+async def blobretention(request: Request[str, str, State]) -> Template:
+    "An admin is setting the BLOB retention limits, these take effect immediately"
+    if request.auth != "admin":
+        return logout(request)
+    form_data = await request.form()
+    limits = {}
+    for item in ('blobmaxsize', 'blobmaxage', 'blobkeeplast'):
+        value = form_data.get(item + "input")
+        try:
+            value = int(value) if value else 0
+            if value < 0:
+                raise ValueError
+        except Exception:
+            return HTMXTemplate(None,
+                        template_str="<p id=\"blobretentionconfirm\" class=\"vanish\" style=\"color:red\">Invalid value, use whole numbers, 0 for no limit</p>")
+        limits[item] = value
+    for item, value in limits.items():
+        userdata.set_stored_item(item, value)
+        userdata.setconfig(item, value)
+    userdata.setblobretention()
+    return HTMXTemplate(template_name="setup/blobretention.html", context=limits)
+
+
 setup_router = Router(path="/setup", route_handlers=[setup,
                                                      backupdb,
+                                                     looplag,
                                                      webhost,
                                                      webport,
                                                      indihost,
                                                      indiport,
-                                                     blobfolder
+                                                     blobfolder,
+                                                     blobretention
                                                     ])
@@ -35,3 +35,57 @@ function btntogglenhide(btn, btnshowtext, btnhidetext, hideid, clearid) {
     }
 
 }
+
+
+function lastlineid(elt) {
+  // returns the message log id of the last message line in elt, or 0 if there is none
+  var lines = elt.querySelectorAll("[data-lineid]");
+  if (lines.length) {
+    return lines[lines.length-1].dataset.lineid;
+    }
+  return 0;
+}
+
+
+function trimlines(elt, maxlines) {
+  // once message lines are present, removes lines without an id, such as 'Waiting..',
+  // then removes the oldest lines so at most maxlines remain
+  var lines = elt.querySelectorAll("[data-lineid]");
+  if (!lines.length) {
+    return;
+    }
+  for (const child of Array.from(elt.children)) {
+    if (!child.dataset.lineid) {
+      child.remove();
+      }
+    }
+  for (let i = 0; i < lines.length - maxlines; i++) {
+    lines[i].remove();
+    }
+}
+
+
+function liveframe(img, url) {
+  // shows the frame at url in img, if an image is still loading, the url is held, and
+  // only the newest url held is loaded once it completes, so older frames are skipped
+  if (img.dataset.loading) {
+    img.dataset.next = url;
+    return;
+    }
+  var empty = document.getElementById("liveempty");
+  if (empty) {
+    empty.remove();
+    }
+  img.dataset.loading = "1";
+  img.onload = img.onerror = function() {
+    delete img.dataset.loading;
+    var next = img.dataset.next;
+    if (next) {
+      delete img.dataset.next;
+      if (next != img.getAttribute("src")) {
+        liveframe(img, next);
+        }
+      }
+    };
+  img.src = url;
+}
@@ -0,0 +1,102 @@
+"""
+Holds the static files, CSS, javascript and icon, in memory.
+
+Each file is read and compressed once, when the app is created, with gzip
+and, if the optional brotli package is installed, with brotli. Requests are
+then answered with the stored encoding the browser accepts, so no CPU is
+spent compressing these files per request.
+
+Each file is also given a name containing a hash of its content, which the
+templates use via the static('filename') template callable. As the content
+of a hashed name can never change, these are served with year long,
+immutable caching, so repeat page loads make no static file requests.
+"""
+
+import gzip, hashlib, mimetypes
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+# file suffixes worth compressing
+COMPRESSIBLE = ('.js', '.css', '.ico', '.svg', '.html', '.json', '.txt')
+
+# dictionary of filename to StaticAsset, populated by loadassets(folder)
+ASSETS = {}
+
+# dictionary of content hashed filename to StaticAsset, populated by loadassets(folder)
+HASHED = {}
+
+
+class StaticAsset:
+    "A static file held in memory, with precompressed copies"
+
+    def __init__(self, path):
+        self.name = path.name
+        self.content = path.read_bytes()
+        self.media_type = mimetypes.guess_type(self.name)[0] or "application/octet-stream"
+        digest = hashlib.sha256(self.content).hexdigest()
+        self.etag = '"' + digest[:16] + '"'
+        # the filename with a content hash inserted before the suffix, such as w3.0123456789.css
+        self.hashedname = f"{path.stem}.{digest[:10]}{path.suffix}"
+        # dictionary of encoding to compressed bytes, only held if smaller than the original
+        self.encodings = {}
+        if path.suffix.lower() not in COMPRESSIBLE:
+            return
+        if brotli is not None:
+            compressed = brotli.compress(self.content, quality=11)
+            if len(compressed) < len(self.content):
+                self.encodings["br"] = compressed
+        compressed = gzip.compress(self.content, compresslevel=9, mtime=0)
+        if len(compressed) < len(self.content):
+            self.encodings["gzip"] = compressed
+
+    def encoded(self, accept_encoding):
+        """Given the request Accept-Encoding header, returns a tuple (content, encoding)
+           where encoding is None if the content is not compressed"""
+        accepted = acceptedencodings(accept_encoding)
+        for encoding in ("br", "gzip"):
+            if encoding in accepted and encoding in self.encodings:
+                return self.encodings[encoding], encoding
+        return self.content, None
+
+
+def acceptedencodings(accept_encoding):
+    "Returns the set of encodings given in an Accept-Encoding header, excluding any with q=0"
+    accepted = set()
+    if not accept_encoding:
+        return accepted
+    for part in accept_encoding.split(","):
+        token, _, params = part.partition(";")
+        params = params.replace(" ", "")
+        if params in ("q=0", "q=0.0", "q=0.00", "q=0.000"):
+            continue
+        accepted.add(token.strip().lower())
+    return accepted
+
+
+def loadassets(folder):
+    "Reads and compresses every file in folder into ASSETS and HASHED"
+    ASSETS.clear()
+    HASHED.clear()
+    for path in folder.iterdir():
+        if path.is_file() and not path.name.startswith("."):
+            asset = StaticAsset(path)
+            ASSETS[asset.name] = asset
+            HASHED[asset.hashedname] = asset
+
+
+def static(ctx, filename):
+    """Template callable, used in templates as ${static('w3.css')}
+       returns the content hashed name of the static file"""
+    asset = ASSETS.get(filename)
+    if asset is None:
+        return filename
+    return asset.hashedname
+
+
+def register_callables(engine):
+    "Set as the template engine_callback, so templates can call static()"
+    engine.register_template_callable(key="static", template_callable=static)
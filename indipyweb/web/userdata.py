@@ -4,7 +4,7 @@
    You should immediately log in as this user and change the password.
    """
 
-import sqlite3, os, time, asyncio
+import sqlite3, os, time, asyncio, bisect
 
 from datetime import datetime, timezone
 
@@ -18,6 +18,8 @@ from dataclasses import dataclass
 
 from functools import lru_cache
 
+from collections import deque
+
 
 _PARAMETERS = {
                 "host":None,
@@ -25,21 +27,214 @@ _PARAMETERS = {
                 "indihost":"localhost",
                 "indiport":7624,
                 "blobfolder":None,
+                "blobmaxsize":0,
+                "blobmaxage":0,
+                "blobkeeplast":0,
                 "indiclient":None,
                 "dbfolder":None,
                 "dbase":None,
                 "runclient":None,
+                "loopmonitor":None,
+                "looplagtask":None,
+                "messagelog":None,
+                "messagelogtask":None,
+                "blobsinktask":None,
+                "snapshottask":None,
                 "securecookie":False,
-                "basepath":None
+                "basepath":None,
+                "lowmemory":False,
+                "public":False,
+                "templatecache":None,
+                "warmup":False,
+                "warmuptask":None
               }
 
 
 # this event is triggered when an event is received that will affect the landing page
 LANDING_EVENT = asyncio.Event()
 
-# dictionary of devicename to asyncio.Event(), populated by get_device_event(devicename)
+
+class LandingState:
+    """Holds the state shown on the landing page, computed once per change rather
+       than once per connected browser. Each SSE connection only has to compare
+       the version numbers with those it last sent."""
+
+    def __init__(self):
+        self.connected = False
+        self.instruments = []           # enabled device objects, sorted by devicename
+        self.instrumentnames = ()
+        self.stalenames = ()            # devicenames of the last known state, not yet defined
+        self.messagestamp = None        # timestamp of the latest system message
+        self.instruments_version = 0
+        self.messages_version = 0
+        self.checked = time.monotonic()
+
+    def update(self, iclient):
+        """Recompute the landing state from the client, increment the version numbers
+           of any changed items and if there is a change, trigger the LANDING_EVENT"""
+        self.checked = time.monotonic()
+        changed = False
+        connected = iclient.connected
+        instruments = list(deviceobj for deviceobj in iclient.values() if deviceobj.enable)
+        instruments.sort(key=lambda x: x.devicename)
+        instrumentnames = tuple(deviceobj.devicename for deviceobj in instruments)
+        stalenames = tuple(deviceobj.devicename for deviceobj in instruments if deviceobj.itemid in iclient.stale)
+        if connected != self.connected or instrumentnames != self.instrumentnames or stalenames != self.stalenames:
+            self.instruments_version += 1
+            changed = True
+        # always keep the latest device objects, as these may be replaced on reconnection
+        self.connected = connected
+        self.instruments = instruments
+        self.instrumentnames = instrumentnames
+        self.stalenames = stalenames
+        messagestamp = iclient.messages[0][0] if iclient.messages else None
+        if messagestamp != self.messagestamp:
+            self.messagestamp = messagestamp
+            self.messages_version += 1
+            changed = True
+        if changed:
+            LANDING_EVENT.set()
+            LANDING_EVENT.clear()
+
+    def refresh(self, iclient, interval=5.0):
+        """Called on SSE timeouts, recomputes the state if it has not been
+           checked within interval seconds, so this is done once for all connections"""
+        if time.monotonic() - self.checked > interval:
+            self.update(iclient)
+
+
+# the single shared landing state, maintained by IPyWebClient.rxevent
+LANDING_STATE = LandingState()
+
+# number of notifications held by each DeviceNotice, so a reconnecting SSE connection can resume
+REPLAYSIZE = 256
+
+
+class DeviceNotice:
+    """Notifies waiting SSE connections of changes to a device. Each notification
+       carries the itemids of the vectors changed since the previous notification,
+       and an incrementing serial number, so a waiter can tell if it has missed any.
+
+       The recent notifications are held, so a connection which ends and reconnects,
+       giving the id of the last event it received, is only sent what it missed."""
+
+    def __init__(self):
+        self._event = asyncio.Event()
+        self.serial = 0
+        self.changed = frozenset()
+        # a random string which starts each event id, changed when the history is lost
+        self.epoch = token_urlsafe(6)
+        # recent notifications, as tuples (serial, changed, structure)
+        self.history = deque(maxlen=REPLAYSIZE)
+
+    def notify(self, changed=(), structure=False):
+        """Wakes all waiters, changed is an iterable of changed vector itemids,
+           structure is True if vectors have been defined or deleted"""
+        self.serial += 1
+        self.changed = frozenset(changed)
+        self.history.append((self.serial, self.changed, structure))
+        self._event.set()
+        self._event.clear()
+
+    async def wait(self):
+        "Wait for the next notification"
+        await self._event.wait()
+
+    def reset(self):
+        "Called when the INDI connection is made or lost, so earlier event ids cannot be resumed"
+        self.epoch = token_urlsafe(6)
+        self.history.clear()
+
+    def eventid(self, serial):
+        "Returns an SSE event id, for an event sent after notification serial has been handled"
+        return f"{self.epoch}-{serial}"
+
+    def parseid(self, eventid):
+        "Returns the serial of an event id given by this DeviceNotice, or None if not recognised"
+        epoch, _, serial = eventid.rpartition("-")
+        if epoch != self.epoch or not serial.isdigit():
+            return None
+        return int(serial)
+
+    def since(self, serial):
+        """Returns a tuple (changed, structure) combining the notifications after serial,
+           or None if these are no longer held"""
+        if serial == self.serial:
+            return frozenset(), False
+        if serial > self.serial or not self.history or self.history[0][0] > serial + 1:
+            return None
+        changed = set()
+        structure = False
+        for notified, notifiedchanged, notifiedstructure in reversed(self.history):
+            if notified <= serial:
+                break
+            changed.update(notifiedchanged)
+            structure = structure or notifiedstructure
+        return changed, structure
+
+
+# dictionary of devicename to DeviceNotice, populated by get_device_event(devicename)
 DEVICE_EVENTS = {}
 
+class GroupIndex:
+    """Holds a device's sorted list of groups, and for each group its enabled vectors
+       sorted by label. This is maintained incrementally as vectors are defined and
+       deleted, so showing a group does not require the device vectors to be sorted."""
+
+    def __init__(self):
+        self.groups = []          # sorted group names
+        self.vectors = {}         # group name : list of vector objects sorted by label
+        self._groupof = {}        # vector itemid : group name the vector is indexed under
+
+    def add(self, vectorobj):
+        "Adds or re-positions an enabled vector, its group or label may have changed on re-definition"
+        self.remove(vectorobj)
+        group = vectorobj.group
+        if group not in self.vectors:
+            bisect.insort(self.groups, group)
+            self.vectors[group] = []
+        bisect.insort(self.vectors[group], vectorobj, key=lambda x: x.label)
+        self._groupof[vectorobj.itemid] = group
+
+    def groupof(self, vectorobj):
+        "Returns the group the vector is indexed under, or None if it is not indexed"
+        return self._groupof.get(vectorobj.itemid)
+
+    def remove(self, vectorobj):
+        "Removes a vector from the index, removing its group if it becomes empty"
+        group = self._groupof.pop(vectorobj.itemid, None)
+        if group is None:
+            return
+        vectorsingroup = self.vectors[group]
+        for index, vector in enumerate(vectorsingroup):
+            # test identity, as vectors are mappings which compare equal by value
+            if vector is vectorobj:
+                del vectorsingroup[index]
+                break
+        if not vectorsingroup:
+            del self.vectors[group]
+            self.groups.remove(group)
+
+    def clear(self):
+        self.groups.clear()
+        self.vectors.clear()
+        self._groupof.clear()
+
+    def rebuild(self, deviceobj):
+        "Rebuilds the index from all the vectors of the device"
+        self.clear()
+        for vectorobj in deviceobj.values():
+            if vectorobj.enable:
+                self.add(vectorobj)
+
+    def getgroup(self, group):
+        "Returns the list of vectors in the group, sorted by label"
+        return self.vectors.get(group, [])
+
+
+# dictionary of devicename to GroupIndex, populated by get_groupindex(devicename)
+GROUP_INDEXES = {}
+
 # This event is set whenever the table of users needs updating
 TABLE_EVENT = asyncio.Event()
 
@@ -55,7 +250,7 @@ IDLETIMEOUT = 3600
 # to pass a bundle of user information. Since a cache is used the objects are usually static,
 # and if changed, the cache must be cleared.
 
-@dataclass
+@dataclass(slots=True)
 class UserInfo():
     "Class used to hold user details"
     user:str
@@ -68,7 +263,7 @@ class UserInfo():
 # These store the user associated with the cookie
 
 
-@dataclass
+@dataclass(slots=True)
 class UserAuth():
     "Class used to hold a logged in user details"
     user:str             # The username
@@ -89,8 +284,6 @@ def get_deviceobj(deviceid):
     iclient = _PARAMETERS["indiclient"]
     if iclient.stop:
         return
-    if not iclient.connected:
-        return
     if not deviceid:
         return
     for deviceobj in iclient.values():
@@ -103,8 +296,6 @@ def get_vectorobj(vectorid, deviceid=None):
     iclient = _PARAMETERS["indiclient"]
     if iclient.stop:
         return
-    if not iclient.connected:
-        return
     if not vectorid:
         return
     if deviceid:
@@ -155,13 +346,62 @@ def localtimestring(t=None):
     return f"{localtime.strftime('%H:%M:%S')}.{ms:0>2d}"
 
 
+def setblobretention(iclient=None):
+    """Sets the BLOB retention limits of the client from the configuration, the
+       maximum size is held in megabytes, and the maximum age in hours"""
+    if iclient is None:
+        iclient = _PARAMETERS["indiclient"]
+    iclient.blobsink.setretention(maxbytes = (_PARAMETERS["blobmaxsize"] or 0) * 1000000,
+                                  maxage = (_PARAMETERS["blobmaxage"] or 0) * 3600,
+                                  keeplast = _PARAMETERS["blobkeeplast"] or 0)
+
+
 def get_device_event(devicename):
     global DEVICE_EVENTS
     if devicename not in DEVICE_EVENTS:
-        DEVICE_EVENTS[devicename] = asyncio.Event()
+        DEVICE_EVENTS[devicename] = DeviceNotice()
     return DEVICE_EVENTS[devicename]
 
 
+async def waitfor(vectorobj, condition, timeout):
+    """Waits until condition(vectorobj) returns True, checking each time the device is notified
+       of a change, returns True if the condition holds, or False if timeout seconds pass first"""
+    if condition(vectorobj):
+        return True
+    device_event = get_device_event(vectorobj.devicename)
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    while True:
+        remaining = deadline - loop.time()
+        if remaining <= 0:
+            return False
+        try:
+            await asyncio.wait_for(device_event.wait(), timeout=remaining)
+        except asyncio.TimeoutError:
+            pass
+        if condition(vectorobj):
+            return True
+
+
+def get_groupindex(devicename):
+    global GROUP_INDEXES
+    if devicename not in GROUP_INDEXES:
+        GROUP_INDEXES[devicename] = GroupIndex()
+    return GROUP_INDEXES[devicename]
+
+
+def clear_groupindexes():
+    "Called when the INDI connection is made or lost, as all devices are then cleared"
+    for groupindex in GROUP_INDEXES.values():
+        groupindex.clear()
+
+
+def reset_device_events():
+    "Called when the INDI connection is made or lost, as SSE connections cannot then resume"
+    for device_event in DEVICE_EVENTS.values():
+        device_event.reset()
+
+
 def get_stored_item(item):
     "Gets stored item from the database"
     con = sqlite3.connect(_PARAMETERS["dbase"])
@@ -176,6 +416,12 @@ def get_stored_item(item):
         cur.execute("SELECT indiport FROM parameters")
     elif item == "blobfolder":
         cur.execute("SELECT blobfolder FROM parameters")
+    elif item == "blobmaxsize":
+        cur.execute("SELECT blobmaxsize FROM parameters")
+    elif item == "blobmaxage":
+        cur.execute("SELECT blobmaxage FROM parameters")
+    elif item == "blobkeeplast":
+        cur.execute("SELECT blobkeeplast FROM parameters")
     else:
         cur.close()
         con.close()
@@ -202,6 +448,12 @@ def set_stored_item(item, value):
             cur.execute("UPDATE parameters SET indiport = ?", (value,))
         elif item == "blobfolder":
             cur.execute("UPDATE parameters SET blobfolder = ?", (value,))
+        elif item == "blobmaxsize":
+            cur.execute("UPDATE parameters SET blobmaxsize = ?", (value,))
+        elif item == "blobmaxage":
+            cur.execute("UPDATE parameters SET blobmaxage = ?", (value,))
+        elif item == "blobkeeplast":
+            cur.execute("UPDATE parameters SET blobkeeplast = ?", (value,))
     cur.close()
     con.close()
 
@@ -228,7 +480,10 @@ def setupdbase(host, port, dbfolder):
                 'port':8000,
                 'indihost':'localhost',
                 'indiport':7624,
-                'blobfolder':None}
+                'blobfolder':None,
+                'blobmaxsize':0,
+                'blobmaxage':0,
+                'blobkeeplast':0}
 
 
     if not dbase.is_file():
@@ -254,8 +509,9 @@ def setupdbase(host, port, dbfolder):
             con.execute("INSERT INTO users VALUES(:username, :password, :auth, :salt, :fullname)",
                   {'username':'admin', 'password':encoded_password, 'auth':'admin', 'salt':salt, 'fullname':'Default Administrator'})
 
-            con.execute("CREATE TABLE parameters(host, port, indihost, indiport, blobfolder)")
-            con.execute("INSERT INTO parameters VALUES(:host, :port, :indihost, :indiport, :blobfolder)", defaults)
+            con.execute("CREATE TABLE parameters(host, port, indihost, indiport, blobfolder, blobmaxsize, blobmaxage, blobkeeplast)")
+            con.execute("INSERT INTO parameters VALUES(:host, :port, :indihost, :indiport, :blobfolder, :blobmaxsize, :blobmaxage, :blobkeeplast)", defaults)
+            con.execute("CREATE TABLE sequences(name PRIMARY KEY, steps NOT NULL) WITHOUT ROWID")
         con.close()
 
         if not _PARAMETERS["host"]:        # command line argument has priority if it exists
@@ -267,15 +523,22 @@ def setupdbase(host, port, dbfolder):
         _PARAMETERS["blobfolder"] = defaults['blobfolder']
 
     else:
-        # dbase exists, so read host, port, indihost, indiport, blobfolder
+        # dbase exists, so read host, port, indihost, indiport, blobfolder and retention limits
 
         con = sqlite3.connect(dbase)
+        with con:
+            # a database created by an earlier version has no BLOB retention columns
+            columns = [row[1] for row in con.execute("PRAGMA table_info(parameters)")]
+            for column in ('blobmaxsize', 'blobmaxage', 'blobkeeplast'):
+                if column not in columns:
+                    con.execute(f"ALTER TABLE parameters ADD COLUMN {column} DEFAULT 0")
+            # nor a table of stored sequences
+            con.execute("CREATE TABLE IF NOT EXISTS sequences(name PRIMARY KEY, steps NOT NULL) WITHOUT ROWID")
         cur = con.cursor()
-        cur.execute("SELECT host, port, indihost, indiport, blobfolder FROM parameters")
+        cur.execute("SELECT host, port, indihost, indiport, blobfolder, blobmaxsize, blobmaxage, blobkeeplast FROM parameters")
         result = cur.fetchone()
         cur.close()
         con.close()
-        webhost, webport, indihost, indiport, blobfolder = result
 
         if not _PARAMETERS["host"]:        # command line argument has priority if it exists
             _PARAMETERS["host"] = result[0]
@@ -284,6 +547,9 @@ def setupdbase(host, port, dbfolder):
         _PARAMETERS["indihost"] = result[2]
         _PARAMETERS["indiport"] = result[3]
         _PARAMETERS["blobfolder"] = result[4]
+        _PARAMETERS["blobmaxsize"] = result[5]
+        _PARAMETERS["blobmaxage"] = result[6]
+        _PARAMETERS["blobkeeplast"] = result[7]
 
 
 ########### Functions to set and read user information from the database
@@ -590,6 +856,55 @@ def userlist(thispage:int, requestedpage:str = "", numinpage:int = 10) -> dict|N
     return {"users":users, "nextpage":nextpage, "prevpage":prevpage, "thispage":newpage, "lastpage":lastpage}
 
 
+########### Functions to set and read stored sequences
+
+def sequencenames() -> list:
+    "Returns a sorted list of the names of the stored sequences"
+    con = sqlite3.connect(_PARAMETERS["dbase"])
+    cur = con.cursor()
+    cur.execute("SELECT name FROM sequences ORDER BY name COLLATE NOCASE")
+    names = [row[0] for row in cur.fetchall()]
+    cur.close()
+    con.close()
+    return names
+
+
+def getsequence(name:str) -> str|None:
+    "Returns the steps of the named sequence, as a JSON string, or None if not found"
+    con = sqlite3.connect(_PARAMETERS["dbase"])
+    cur = con.cursor()
+    cur.execute("SELECT steps FROM sequences WHERE name = ?", (name,))
+    result = cur.fetchone()
+    cur.close()
+    con.close()
+    if not result:
+        return
+    return result[0]
+
+
+def setsequence(name:str, steps:str) -> str|None:
+    """Stores the steps of a sequence, replacing any of the same name,
+       returns None on success, on failure returns an error message"""
+    if not name:
+        return "No sequence name given"
+    elif len(name)>30:
+        return "The sequence name should be at most 30 characters"
+    elif not name.replace("_", "").replace("-", "").isalnum():
+        return "The sequence name should be letters, digits, - and _ only"
+    con = sqlite3.connect(_PARAMETERS["dbase"])
+    with con:
+        con.execute("INSERT OR REPLACE INTO sequences VALUES(?, ?)", (name, steps))
+    con.close()
+
+
+def delsequence(name:str) -> None:
+    "Deletes the named sequence"
+    con = sqlite3.connect(_PARAMETERS["dbase"])
+    with con:
+        con.execute("DELETE FROM sequences WHERE name = ?", (name,))
+    con.close()
+
+
 def dbbackup() -> str|None:
     "Create database backup file, return the file name, or None on failure"
     global _PARAMETERS
@@ -10,64 +10,166 @@ from typing import Annotated
 
 from litestar import Litestar, get, post, Request, Router, MediaType
 from litestar.plugins.htmx import HTMXTemplate, ClientRedirect, ClientRefresh
-from litestar.response import Template, Redirect
+from litestar.response import Template, Redirect, Response
 from litestar.datastructures import State, UploadFile
 from litestar.enums import RequestEncodingType
 from litestar.params import Body
 from litestar.response import ServerSentEvent, ServerSentEventMessage
 
 from .userdata import localtimestring, get_indiclient, getuserauth, get_vectorobj
+from .commandqueue import get_commandqueue
+from .publiccache import ispublic, deviceversion, publicresponse, rendertemplate
 
 
 
 
-@get("/update/{vectorid:int}", exclude_from_auth=True, sync_to_thread=False)
-def update(vectorid:int, request: Request[str, str, State]) -> Template|ClientRedirect|ClientRefresh:
-    "Update vector"
-    iclient = get_indiclient()
-    # check valid vector
-    vectorobj = get_vectorobj(vectorid)
-    if vectorobj is None:
-        return ClientRedirect("../../")
-    # Check if user is looged in
-    loggedin = False
-    cookie = request.cookies.get('token', '')
-    if cookie:
-        userauth = getuserauth(cookie)
-        if userauth is not None:
-            loggedin = True
+def fragment(vectorobj, loggedin, blobfolder):
+    """Returns a tuple (template_name, re_target, context) giving the update of a vector,
+       re_target is None if the whole vector is to be replaced"""
     if vectorobj.user_string:
         # This is not a full update, just an update of the result and state fields
-        return HTMXTemplate(template_name="vector/result.html",
-                            re_target=f"#stateandtime_{vectorobj.itemid}",
-                            context={"vectorobj":vectorobj,
-                                     "state":vectorobj.state,
-                                     "timestamp":localtimestring(vectorobj.timestamp),
-                                     "message_timestamp":localtimestring(vectorobj.message_timestamp),
-                                     "result":vectorobj.user_string})
+        return ("vector/result.html",
+                f"#stateandtime_{vectorobj.itemid}",
+                {"vectorobj":vectorobj,
+                 "state":vectorobj.state,
+                 "timestamp":localtimestring(vectorobj.timestamp),
+                 "message_timestamp":localtimestring(vectorobj.message_timestamp),
+                 "result":vectorobj.user_string})
     if vectorobj.vectortype == "TextVector":
         # update members only, not entire vector as input fields do not update well
-        return HTMXTemplate(template_name="vector/textvalues.html",
-                            re_target=f"#stateandtime_{vectorobj.itemid}",
-                            context={"vectorobj":vectorobj,
-                                     "state":vectorobj.state,
-                                     "timestamp":localtimestring(vectorobj.timestamp),
-                                     "message_timestamp":localtimestring(vectorobj.message_timestamp)})
+        return ("vector/textvalues.html",
+                f"#stateandtime_{vectorobj.itemid}",
+                {"vectorobj":vectorobj,
+                 "state":vectorobj.state,
+                 "timestamp":localtimestring(vectorobj.timestamp),
+                 "message_timestamp":localtimestring(vectorobj.message_timestamp)})
     if vectorobj.vectortype == "NumberVector":
         # update members only, not entire vector as input fields do not update well
-        return HTMXTemplate(template_name="vector/numbervalues.html",
-                            re_target=f"#stateandtime_{vectorobj.itemid}",
-                            context={"vectorobj":vectorobj,
-                                     "state":vectorobj.state,
-                                     "timestamp":localtimestring(vectorobj.timestamp),
-                                     "message_timestamp":localtimestring(vectorobj.message_timestamp)})
+        return ("vector/numbervalues.html",
+                f"#stateandtime_{vectorobj.itemid}",
+                {"vectorobj":vectorobj,
+                 "state":vectorobj.state,
+                 "timestamp":localtimestring(vectorobj.timestamp),
+                 "message_timestamp":localtimestring(vectorobj.message_timestamp)})
 
     # have to return a vector html template here
-    return HTMXTemplate(template_name="vector/getvector.html", context={"vectorobj":vectorobj,
-                                                                        "timestamp":localtimestring(vectorobj.timestamp),
-                                                                        "loggedin":loggedin,
-                                                                        "blobfolder":str(iclient.BLOBfolder),
-                                                                        "message_timestamp":localtimestring(vectorobj.message_timestamp)})
+    return ("vector/getvector.html",
+            None,
+            {"vectorobj":vectorobj,
+             "timestamp":localtimestring(vectorobj.timestamp),
+             "loggedin":loggedin,
+             "blobfolder":blobfolder,
+             "message_timestamp":localtimestring(vectorobj.message_timestamp)})
+
+
+def isloggedin(request):
+    "Returns True if the request comes from a logged in user"
+    cookie = request.cookies.get('token', '')
+    if cookie:
+        if getuserauth(cookie) is not None:
+            return True
+    return False
+
+
+@get("/update/{vectorid:int}", exclude_from_auth=True, sync_to_thread=False)
+def update(vectorid:int, request: Request[str, str, State]) -> Template|ClientRedirect|ClientRefresh|Response:
+    "Update vector"
+    iclient = get_indiclient()
+    # check valid vector
+    vectorobj = get_vectorobj(vectorid)
+    if vectorobj is None:
+        return ClientRedirect("../../")
+    loggedin = isloggedin(request)
+    blobfolder = str(iclient.BLOBfolder)
+    if ispublic(loggedin):
+        # shared by every anonymous viewer, rendered once per change to the device
+        template_name, re_target, context = fragment(vectorobj, False, blobfolder)
+        return publicresponse(request, ("update", vectorid),
+                              (deviceversion(vectorobj.devicename), blobfolder),
+                              lambda: rendertemplate(request, template_name, context),
+                              headers={"HX-Retarget":re_target} if re_target else None)
+    template_name, re_target, context = fragment(vectorobj, loggedin, blobfolder)
+    if re_target is None:
+        return HTMXTemplate(template_name=template_name, context=context)
+    return HTMXTemplate(template_name=template_name, re_target=re_target, context=context)
+
+
+@get("/updates", exclude_from_auth=True, sync_to_thread=False)
+def updates(request: Request[str, str, State], ids:str="") -> Response:
+    """Update several vectors in one response, ids being a comma separated list of vector ids.
+       Each vector update is returned as htmx out of band swaps, so the response
+       replaces the vectors wherever they are on the page"""
+    iclient = get_indiclient()
+    loggedin = isloggedin(request)
+    blobfolder = str(iclient.BLOBfolder)
+    vectorobjs = []
+    for vectorid in ids.split(","):
+        try:
+            vectorobj = get_vectorobj(int(vectorid))
+        except ValueError:
+            continue
+        if vectorobj is None or not vectorobj.enable:
+            # deleted vectors are removed by the newvectors event
+            continue
+        vectorobjs.append(vectorobj)
+    if ispublic(loggedin):
+        # shared by every anonymous viewer, rendered once per change to the devices
+        versions = tuple(sorted(set(deviceversion(vectorobj.devicename) for vectorobj in vectorobjs)))
+        return publicresponse(request, ("updates", ids), (versions, blobfolder),
+                              lambda: renderupdates(request, vectorobjs, False, blobfolder))
+    return Response(renderupdates(request, vectorobjs, loggedin, blobfolder), media_type=MediaType.HTML)
+
+
+def renderupdates(request, vectorobjs, loggedin, blobfolder):
+    "Returns the updates of the vectors, as htmx out of band swaps"
+    engine = request.app.template_engine
+    parts = []
+    for vectorobj in vectorobjs:
+        template_name, re_target, context = fragment(vectorobj, loggedin, blobfolder)
+        if re_target is None:
+            parts.append(f'<div id="vector_{vectorobj.itemid}" hx-swap-oob="innerHTML">')
+            parts.append(engine.get_template(template_name).render(**context))
+            parts.append('</div>')
+        else:
+            # the fragment's state block is itself set as an out of band swap
+            context["oob"] = True
+            parts.append(engine.get_template(template_name).render(**context))
+    return "\n".join(parts)
+
+
+def checkswitches(vectorobj, members):
+    """members is a dictionary of switch name to 'On' or 'Off' for every member of the vector,
+       returns an error string if the vector rule is broken, or None if the switches are valid"""
+    if vectorobj.rule == 'AnyOfMany':
+        return
+    # 'OneOfMany', and 'AtMostOne' rules have a max oncount of 1
+    oncount = list(members.values()).count("On")
+    if vectorobj.rule == "OneOfMany" and oncount != 1:
+        return "OneOfMany rule requires one switch only to be On"
+    if vectorobj.rule == "AtMostOne" and oncount > 1:
+        return "AtMostOne rule requires no more than one On switch"
+
+
+def checknumbers(vectorobj, members):
+    """Applies the minimum, maximum and step rules to a dictionary of number member name to value,
+       returns a new dictionary of member name to float, raises an exception if a value cannot be parsed"""
+    checked = {}
+    for name, value in members.items():
+        memberobj = vectorobj.member(name)
+        minfloat = memberobj.getfloat(memberobj.min)
+        floatval = memberobj.getfloat(value)
+        # check step, and round floatval to nearest step value
+        stepvalue = memberobj.getfloat(memberobj.step)
+        if stepvalue:
+            floatval = round(floatval / stepvalue) * stepvalue
+        if memberobj.max != memberobj.min:
+            maxfloat = memberobj.getfloat(memberobj.max)
+            if floatval > maxfloat:
+                floatval = maxfloat
+            elif floatval < minfloat:
+                floatval = minfloat
+        checked[name] = floatval
+    return checked
 
 
 @post("/submit/{vectorid:int}")
@@ -83,37 +185,29 @@ async def submit(vectorid:int, request: Request[str, str, State]) -> Template|Cl
     if vectorobj.perm == "ro":
         return HTMXTemplate(None, template_str="<p>INVALID: This is a Read Only vector!</p>")
 
+    if vectorobj.itemid in iclient.stale:
+        return HTMXTemplate(None, template_str="<p>INVALID: This vector is stale, not yet defined by the INDI service!</p>")
+
     form_data = await request.form()
 
     # deal with switch vectors
     if vectorobj.vectortype  == "SwitchVector":
         members = {}
-        oncount = 0
         for mbr in vectorobj.members().values():
             fm = f"member_{mbr.itemid}"
             if fm in form_data:
                 members[mbr.name] = "On"
-                oncount += 1
             else:
                 members[mbr.name] = "Off"
-        if vectorobj.rule != 'AnyOfMany':
-            # 'OneOfMany', and 'AtMostOne' rules have a max oncount of 1
-            if vectorobj.rule == "OneOfMany" and oncount != 1:
-                return HTMXTemplate(template_name="vector/result.html",
-                                    re_target=f"#stateandtime_{vectorobj.itemid}",
-                                    context={"state":"Alert",
-                                             "vectorobj":vectorobj,
-                                             "timestamp":localtimestring(),
-                                             "message_timestamp":localtimestring(vectorobj.message_timestamp),
-                                             "result":"OneOfMany rule requires one switch only to be On"})
-            if vectorobj.rule == "AtMostOne" and oncount > 1:
-                return HTMXTemplate(template_name="vector/result.html",
-                                    re_target=f"#stateandtime_{vectorobj.itemid}",
-                                    context={"state":"Alert",
-                                             "vectorobj":vectorobj,
-                                             "timestamp":localtimestring(),
-                                             "message_timestamp":localtimestring(vectorobj.message_timestamp),
-                                             "result":"AtMostOne rule requires no more than one On switch"})
+        error = checkswitches(vectorobj, members)
+        if error:
+            return HTMXTemplate(template_name="vector/result.html",
+                                re_target=f"#stateandtime_{vectorobj.itemid}",
+                                context={"state":"Alert",
+                                         "vectorobj":vectorobj,
+                                         "timestamp":localtimestring(),
+                                         "message_timestamp":localtimestring(vectorobj.message_timestamp),
+                                         "result":error})
     else:
         # text and number members
         members = {}
@@ -129,23 +223,7 @@ async def submit(vectorid:int, request: Request[str, str, State]) -> Template|Cl
     # deal with number vectors
     try:
         if vectorobj.vectortype  == "NumberVector":
-            # Have to apply minimum and maximum rules
-            for name, value in members.items():
-                memberobj = vectorobj.member(name)
-                minfloat = memberobj.getfloat(memberobj.min)
-                floatval = memberobj.getfloat(value)
-                # check step, and round floatval to nearest step value
-                stepvalue = memberobj.getfloat(memberobj.step)
-                if stepvalue:
-                    floatval = round(floatval / stepvalue) * stepvalue
-                if memberobj.max != memberobj.min:
-                    maxfloat = memberobj.getfloat(memberobj.max)
-                    if floatval > maxfloat:
-                        floatval = maxfloat
-                    elif floatval < minfloat:
-                        floatval = minfloat
-                members[name] = floatval
-
+            members = checknumbers(vectorobj, members)
     except Exception as e:
         return HTMXTemplate(template_name="vector/result.html",
                             re_target=f"#stateandtime_{vectorobj.itemid}",
@@ -156,15 +234,19 @@ async def submit(vectorid:int, request: Request[str, str, State]) -> Template|Cl
                                      "result":"Unable to parse number value"})
 
 
-    # and send the vector
-    await iclient.send_newVector(vectorobj.devicename, vectorobj.name, members=members)
+    # and send the vector, or if it is Busy, hold the changes until it is not
+    commandqueue = get_commandqueue(vectorobj)
+    if await commandqueue.submit(iclient, vectorobj, members):
+        result = "Vector changes sent"
+    else:
+        result = f"Waiting while Busy: {commandqueue.queued} queued, {commandqueue.dropped} dropped"
     return HTMXTemplate(template_name="vector/result.html",
                         re_target=f"#stateandtime_{vectorobj.itemid}",
                         context={"state":"Busy",
                                  "vectorobj":vectorobj,
                                  "timestamp":localtimestring(),
                                  "message_timestamp":localtimestring(vectorobj.message_timestamp),
-                                 "result":"Vector changes sent"})
+                                 "result":result})
 
 
 
@@ -184,6 +266,9 @@ async def blobsend(
     if vectorobj.perm == "ro":
         return HTMXTemplate(None, template_str="<p>INVALID: This is a Read Only vector!</p>")
 
+    if vectorobj.itemid in iclient.stale:
+        return HTMXTemplate(None, template_str="<p>INVALID: This vector is stale, not yet defined by the INDI service!</p>")
+
     memberobj = None
 
     for mbr in vectorobj.members().values():
@@ -214,4 +299,4 @@ async def blobsend(
 
 
 
-vector_router = Router(path="/vector", route_handlers=[update, submit, blobsend])
+vector_router = Router(path="/vector", route_handlers=[update, updates, submit, blobsend])
@@ -0,0 +1,183 @@
+"""
+Keeps a snapshot of the devices and vectors on disk, so pages can be shown at once on startup.
+
+Every SNAPSHOTINTERVAL seconds, if any vector has changed, the definitions
+and latest values of the enabled vectors are written to the file
+indipyweb_state.xml.gz in the database folder. The snapshot holds the INDI
+def elements which the client would receive, gzip compressed, so it is
+compact, and is read back by the client's own parser.
+
+On startup the snapshot is loaded, if it was taken of the same INDI service,
+so the landing and device pages show the last known state before the
+connection is made, with each device and vector marked as stale.
+
+The client keeps its devices when the connection is made or lost, rather than
+clearing them, marking them stale. As the INDI service defines each vector,
+the existing vector is updated and its stale marker removed, and as the page
+structure is unchanged, browsers are only sent its new values. Vectors still
+stale RECONCILEWAIT seconds after the last definition is received are taken
+as no longer present, and are deleted.
+"""
+
+import asyncio, gzip, os, logging
+
+import xml.etree.ElementTree as ET
+
+from datetime import timezone
+
+from indipyclient.ipyclient import Device
+
+from .commandqueue import remove_commandqueue
+
+from .userdata import getconfig, get_indiclient, get_groupindex, LANDING_STATE
+
+
+logger = logging.getLogger("indipyweb")
+
+
+# file name of the snapshot, created in the database folder
+SNAPSHOTNAME = "indipyweb_state.xml.gz"
+
+# seconds between snapshots, a snapshot is only written if a vector has changed
+SNAPSHOTINTERVAL = 60.0
+
+# seconds after the last definition is received before stale vectors are deleted
+RECONCILEWAIT = 10.0
+
+# def element tags, and their member tags, of each vector type
+DEFTAGS = {"SwitchVector": ("defSwitchVector", "defSwitch"),
+           "LightVector": ("defLightVector", "defLight"),
+           "TextVector": ("defTextVector", "defText"),
+           "NumberVector": ("defNumberVector", "defNumber"),
+           "BLOBVector": ("defBLOBVector", "defBLOB")}
+
+
+def snapshotpath():
+    return getconfig("dbfolder") / SNAPSHOTNAME
+
+
+def stale(ctx, item):
+    """Template callable, used in templates as ${stale(vectorobj)}, returns True if the
+       device or vector is of the last known state, not yet defined by the INDI service"""
+    return item.itemid in get_indiclient().stale
+
+
+def defelement(vectorobj):
+    "Returns an ElementTree Element, the INDI definition of the vector, with its current values"
+    vectortag, membertag = DEFTAGS[vectorobj.vectortype]
+    timestamp = vectorobj.timestamp.astimezone(timezone.utc).replace(tzinfo=None)
+    element = ET.Element(vectortag, {"device":vectorobj.devicename,
+                                     "name":vectorobj.name,
+                                     "label":vectorobj.label,
+                                     "group":vectorobj.group,
+                                     "state":vectorobj.state,
+                                     "timestamp":timestamp.isoformat(timespec="milliseconds")})
+    if vectorobj.perm:
+        element.set("perm", vectorobj.perm)
+    if vectorobj.rule:
+        element.set("rule", vectorobj.rule)
+    if vectorobj.timeout:
+        element.set("timeout", str(vectorobj.timeout))
+    for memberobj in vectorobj.members().values():
+        member = ET.SubElement(element, membertag, {"name":memberobj.name, "label":memberobj.label})
+        if vectorobj.vectortype == "NumberVector":
+            member.set("format", memberobj.format)
+            member.set("min", memberobj.min)
+            member.set("max", memberobj.max)
+            member.set("step", memberobj.step)
+        if vectorobj.vectortype != "BLOBVector":
+            member.text = memberobj.membervalue or ""
+    return element
+
+
+def writesnapshot(path, indihost, indiport, elements):
+    "Called in a thread, writes the elements to a part file, then renames it to path"
+    root = ET.Element("snapshot", {"indihost":str(indihost), "indiport":str(indiport)})
+    root.extend(elements)
+    partpath = path.with_name(f".{path.name}.part")
+    try:
+        partpath.write_bytes(gzip.compress(ET.tostring(root, encoding="utf-8")))
+    except OSError:
+        partpath.unlink(missing_ok=True)
+        raise
+    os.replace(partpath, path)
+
+
+def readsnapshot(path, indihost, indiport):
+    "Returns a list of the def elements of the snapshot, empty if it is absent or of another INDI service"
+    try:
+        root = ET.fromstring(gzip.decompress(path.read_bytes()))
+    except FileNotFoundError:
+        return []
+    except Exception:
+        logger.exception("Unable to read the snapshot of the last known state")
+        return []
+    if root.get("indihost") != str(indihost) or root.get("indiport") != str(indiport):
+        return []
+    return list(root)
+
+
+def load(iclient):
+    """Called on startup, before the client runs, defines the vectors of the snapshot,
+       each being marked stale"""
+    for element in readsnapshot(snapshotpath(), iclient.indihost, iclient.indiport):
+        devicename = element.get("device")
+        deviceobj = iclient.data.get(devicename)
+        if deviceobj is None:
+            deviceobj = Device(devicename, iclient)
+        try:
+            event = deviceobj.rxvector(element)
+        except Exception:
+            # ParseException, a malformed element is ignored
+            continue
+        iclient.data[devicename] = deviceobj
+        iclient.stale.add(deviceobj.itemid)
+        iclient.stale.add(event.vector.itemid)
+        get_groupindex(devicename).add(event.vector)
+    LANDING_STATE.update(iclient)
+
+
+async def save(iclient):
+    "Writes the snapshot if any vector has changed since the last was written"
+    if not iclient.snapshotchanged:
+        return
+    iclient.snapshotchanged = False
+    elements = []
+    for deviceobj in list(iclient.values()):
+        for vectorobj in list(deviceobj.values()):
+            if vectorobj.enable:
+                elements.append(defelement(vectorobj))
+    try:
+        await asyncio.to_thread(writesnapshot, snapshotpath(), iclient.indihost, iclient.indiport, elements)
+    except Exception:
+        logger.exception("Unable to write the snapshot of the last known state")
+
+
+async def run(iclient):
+    "Await this to write the snapshot every SNAPSHOTINTERVAL seconds"
+    while True:
+        await asyncio.sleep(SNAPSHOTINTERVAL)
+        await save(iclient)
+
+
+async def reconcile(iclient):
+    """Started when the connection is made, once RECONCILEWAIT seconds pass with no
+       definition received, deletes the vectors which are still stale"""
+    loop = asyncio.get_running_loop()
+    while iclient.connected:
+        remaining = iclient.lastdefine + RECONCILEWAIT - loop.time()
+        if remaining <= 0:
+            break
+        await asyncio.sleep(remaining)
+    if not iclient.connected:
+        # the vectors remain as the last known state
+        return
+    for deviceobj in list(iclient.values()):
+        for vectorobj in list(deviceobj.values()):
+            if vectorobj.itemid in iclient.stale:
+                vectorobj.enable = False
+                get_groupindex(deviceobj.devicename).remove(vectorobj)
+                remove_commandqueue(vectorobj.itemid)
+                iclient.snapshotchanged = True
+                iclient._pending(deviceobj.devicename, vectorobj.itemid, landing=True, structure=True)
+    iclient.stale.clear()